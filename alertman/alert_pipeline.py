@@ -0,0 +1,125 @@
+import asyncio
+
+from alertman.log import getCustomLogger
+from alertman.message_codecs import decodeMessageBody
+from alertman.pipeline import Pipeline, Stage
+from alertman.retry import getRetryAlertTypes
+
+
+log = getCustomLogger(__name__)
+
+
+# Tracks one delivery through the alert pipeline, done resolves once every
+# alert type of the message was sent, dropped or failed.
+class AlertJob(object):
+    def __init__(self, message, loop=None):
+        self.message = message
+        self.content = None
+        self.alertTypes = []
+        self.results = {}
+        self.decodeError = None
+        self._pending = 0
+        self.done = (loop or asyncio.get_event_loop()).create_future()
+
+    def start(self, content, alertTypes):
+        self.content = content
+        self.alertTypes = list(alertTypes)
+        self._pending = len(self.alertTypes)
+        if self._pending == 0:
+            self._resolve()
+
+    # an alert type routed to several receivers finishes once all of them did
+    def expand(self, alertType, count):
+        if count == 0:
+            self.finishAlert(alertType)
+        else:
+            self._pending += count - 1
+
+    def finishAlert(self, alertType, exc=None):
+        # the first failure of an alert type sticks
+        if exc is not None or alertType not in self.results:
+            self.results[alertType] = exc
+        self._pending -= 1
+        if self._pending == 0:
+            self._resolve()
+
+    def fail(self, exc):
+        self.decodeError = exc
+        self._resolve()
+
+    def _resolve(self):
+        if not self.done.done():
+            self.done.set_result(self)
+
+
+# Builds the decode -> prepare -> render -> send pipeline. Decoding and
+# rendering of large bodies run through the executor when one is given, routing
+# an alert type to its (alertProcessor, alertRequest) pairs is injected by
+# the worker.
+def buildAlertPipeline(routeAlert, workers, queueSize=100, executor=None,
+        offloadMinBytes=65536):
+
+    async def decode(stage, job):
+        message = job.message
+        if len(message.body) >= offloadMinBytes:
+            messageObj = await stage.offload(
+                decodeMessageBody, message.body, message.content_type
+            )
+        else:
+            messageObj = decodeMessageBody(message.body, message.content_type)
+        content = messageObj['message']
+        job.start(content, getRetryAlertTypes(message) or content['alertTypes'])
+        return [(job, alertType) for alertType in job.alertTypes]
+
+    async def prepare(stage, item):
+        job, alertType = item
+        routedAlerts = routeAlert(alertType, job.content, job.message.routing_key)
+        job.expand(alertType, len(routedAlerts))
+        nextItems = []
+        for alertProcessor, alertRequest in routedAlerts:
+            try:
+                prepared = await alertProcessor.prepare(alertRequest)
+            except Exception as exc:
+                job.finishAlert(alertType, exc)
+                continue
+            if prepared is None:
+                job.finishAlert(alertType)
+                continue
+            alert, dedupKey = prepared
+            nextItems.append((job, alertType, alertProcessor, alert, dedupKey))
+        return nextItems
+
+    async def render(stage, item):
+        job, alertType, alertProcessor, alert, dedupKey = item
+        renderer = alertProcessor.getRenderer()
+        if renderer is not None:
+            try:
+                # small alerts render faster inline than the executor hop costs
+                if len(job.message.body) >= offloadMinBytes:
+                    alert.rendered = await stage.offload(renderer, alert)
+                else:
+                    alert.rendered = renderer(alert)
+            except Exception as exc:
+                await alertProcessor.abort(dedupKey)
+                raise exc
+        return [item]
+
+    async def send(stage, item):
+        job, alertType, alertProcessor, alert, dedupKey = item
+        await alertProcessor.deliver(alert, alertType, dedupKey)
+        job.finishAlert(alertType)
+        return None
+
+    def onError(stage, item, exc):
+        if isinstance(item, AlertJob):
+            item.fail(exc)
+        else:
+            item[0].finishAlert(item[1], exc)
+
+    stages = [
+        Stage('decode', decode, workers['decode'], queueSize, executor),
+        Stage('prepare', prepare, workers['prepare'], queueSize),
+        Stage('render', render, workers['render'], queueSize, executor),
+        Stage('send', send, workers['send'], queueSize),
+    ]
+    return Pipeline(stages, onError)
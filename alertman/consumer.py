@@ -0,0 +1,401 @@
+import asyncio
+import inspect
+import math
+import os
+import queue
+import time
+from collections import OrderedDict
+
+from alertman.log import getCustomLogger
+from alertman.metrics import PREFETCH_COUNT, STAGE_LATENCY
+
+
+log = getCustomLogger(__name__)
+
+
+# Wraps a message callback so that at most maxInFlight deliveries are being
+# processed at the same time. The broker prefetch decides how many deliveries
+# are buffered locally, the semaphore decides how many of them do work.
+class BoundedConsumer(object):
+    def __init__(self, on_message, maxInFlight=1, ackBatcher=None):
+        self._on_message = on_message
+        self._maxInFlight = maxInFlight
+        self._slots = asyncio.Semaphore(maxInFlight)
+        self._ackBatcher = ackBatcher
+        self._inFlight = 0
+        self._waiting = 0
+        self._processed = 0
+        self._failed = 0
+
+    async def __call__(self, message):
+        # deliveries have to be tracked in delivery order, so before waiting
+        if self._ackBatcher is not None:
+            message = self._ackBatcher.track(message)
+        self._waiting += 1
+        async with self._slots:
+            self._waiting -= 1
+            self._inFlight += 1
+            try:
+                await self._on_message(message)
+            except Exception as exc:
+                self._failed += 1
+                log.error("BoundedConsumer on_message raised exception: %s", exc)
+            finally:
+                self._inFlight -= 1
+                self._processed += 1
+
+    @property
+    def inFlight(self):
+        return self._inFlight
+
+    def stats(self):
+        stats = {
+            'maxInFlight': self._maxInFlight,
+            'inFlight': self._inFlight,
+            'waiting': self._waiting,
+            'processed': self._processed,
+            'failed': self._failed
+        }
+        if self._ackBatcher is not None:
+            stats['acks'] = self._ackBatcher.stats()
+        return stats
+
+
+# Stands in for a delivery handed to the message callback, acks go to the
+# AckBatcher while everything else is read from the real delivery. Settling
+# is a coroutine like on an aio_pika 10 delivery, so callers await it the
+# same way whether acks are batched or not.
+class BatchedAckMessage(object):
+    def __init__(self, message, batcher):
+        self._message = message
+        self._batcher = batcher
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    async def ack(self, multiple=False):
+        self._batcher.ack(self._message)
+
+    async def reject(self, requeue=False):
+        self._batcher.settle(self._message, self._message.reject(requeue=requeue))
+
+    async def nack(self, multiple=False, requeue=True):
+        self._batcher.settle(self._message, self._message.nack(requeue=requeue))
+
+
+# Acks deliveries of one channel in batches. Completed deliveries are
+# collected and the highest delivery tag up to which every delivery is
+# settled gets a single ack with multiple=True, once maxBatch acks are ready,
+# nothing else is in progress, or flushInterval seconds passed. Deliveries
+# completed behind one still in progress get acked on their own after
+# waiting a whole interval, so a slow alert can't hold the prefetch window.
+class AckBatcher(object):
+    SETTLED = object()
+
+    def __init__(self, maxBatch=100, flushInterval=0.05):
+        self._maxBatch = max(1, maxBatch)
+        self._flushInterval = flushInterval
+        # delivery tag -> None while in progress, the delivery once it can be
+        # acked, SETTLED once it was acked, rejected or nacked on its own
+        self._pending = OrderedDict()
+        self._ready = 0
+        self._settled = 0
+        self._lastTag = None
+        self._waited = set()
+        self._flushHandle = None
+        self._sending = set()
+        self._batches = 0
+        self._acked = 0
+
+    def track(self, message):
+        tag = message.delivery_tag
+        if self._lastTag is not None and tag <= self._lastTag:
+            # delivery tags start over on a reopened channel, the deliveries
+            # of the old channel can't be acked on the new one anymore
+            self._reset()
+        self._lastTag = tag
+        self._pending[tag] = None
+        return BatchedAckMessage(message, self)
+
+    def ack(self, message):
+        tag = message.delivery_tag
+        if self._pending.get(tag, self.SETTLED) is not None:
+            self._send(message.ack())
+            return
+        self._pending[tag] = message
+        self._ready += 1
+        if self._ready >= self._maxBatch or self._isIdle():
+            self._flush()
+        elif self._flushHandle is None:
+            self._scheduleFlush()
+
+    def settle(self, message, result):
+        if self._pending.get(message.delivery_tag, self.SETTLED) is None:
+            self._pending[message.delivery_tag] = self.SETTLED
+            self._settled += 1
+        self._send(result)
+        if self._ready and self._isIdle():
+            self._flush()
+
+    async def close(self):
+        self._flush()
+        self._ackWaiting(set(self._pending))
+        if self._sending:
+            await asyncio.wait(self._sending)
+
+    def stats(self):
+        return {
+            'ready': self._ready,
+            'acked': self._acked,
+            'batches': self._batches
+        }
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _flush(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        last = None
+        count = 0
+        while self._pending:
+            tag, state = next(iter(self._pending.items()))
+            if state is None:
+                break
+            self._pending.popitem(last=False)
+            self._waited.discard(tag)
+            if state is self.SETTLED:
+                self._settled -= 1
+            else:
+                last = state
+                count += 1
+        if last is not None:
+            self._ready -= count
+            self._acked += count
+            self._batches += 1
+            self._send(last.ack(multiple=True))
+        if self._ready:
+            self._scheduleFlush()
+
+    def _onTimer(self):
+        self._flushHandle = None
+        self._flush()
+        # whatever is still ready was ready at the previous tick already
+        self._ackWaiting(self._waited)
+        self._waited = set(
+            tag for tag, state in self._pending.items()
+            if state is not None and state is not self.SETTLED
+        )
+
+    def _ackWaiting(self, tags):
+        for tag in list(tags):
+            state = self._pending.get(tag)
+            if state is None or state is self.SETTLED:
+                continue
+            self._pending[tag] = self.SETTLED
+            self._settled += 1
+            self._ready -= 1
+            self._acked += 1
+            self._send(state.ack())
+
+    def _scheduleFlush(self):
+        if self._flushHandle is None:
+            self._flushHandle = asyncio.get_event_loop().call_later(
+                self._flushInterval, self._onTimer
+            )
+
+    def _isIdle(self):
+        # no delivery in progress, so nothing would join the batch anymore
+        return self._ready + self._settled == len(self._pending)
+
+    def _reset(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        self._pending = OrderedDict()
+        self._ready = 0
+        self._settled = 0
+        self._waited = set()
+
+    def _send(self, result):
+        # older aio_pika acks right away, newer ones return a coroutine
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._sending.add(task)
+            task.add_done_callback(self._onSent)
+
+    def _onSent(self, task):
+        self._sending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("AckBatcher could not settle delivery: %s", task.exception())
+
+
+# The BoundedConsumers of all the lanes a worker consumes, every lane keeps
+# its own reserved in flight slots so a backlog in one lane can never take
+# the concurrency another lane needs.
+class ConsumerGroup(object):
+    def __init__(self, consumers):
+        self._consumers = consumers
+
+    @property
+    def inFlight(self):
+        return sum(consumer.inFlight for consumer in self._consumers.values())
+
+    def stats(self):
+        lanes = dict(
+            (name, consumer.stats()) for name, consumer in self._consumers.items()
+        )
+        stats = {}
+        for key in ('maxInFlight', 'inFlight', 'waiting', 'processed', 'failed'):
+            stats[key] = sum(laneStats[key] for laneStats in lanes.values())
+        stats['lanes'] = lanes
+        return stats
+
+
+async def logConsumerStats(consumer, interval, statsQueue=None, workerIndex=0,
+        pipeline=None):
+    while True:
+        await asyncio.sleep(interval)
+        stats = consumer.stats()
+        if pipeline is not None:
+            stats['pipelineDepths'] = pipeline.depths()
+        log.info("worker stats: %s", stats)
+        # when running under the WorkerSupervisor report stats to the parent
+        if statsQueue is not None:
+            try:
+                statsQueue.put_nowait((workerIndex, os.getpid(), stats))
+            except queue.Full:
+                pass
+
+
+# Lowers the broker prefetch while any sender is throttled, so that the
+# broker stops pushing alerts which would only pile up as waiting coroutines,
+# and restores it once no sender is throttled anymore.
+class ConsumerBackpressure(object):
+    def __init__(self, client, prefetchCount, throttledPrefetchCount=1):
+        self._client = client
+        self._prefetchCount = prefetchCount
+        self._throttledPrefetchCount = throttledPrefetchCount
+        self._throttled = 0
+        self._appliedPrefetchCount = prefetchCount
+        self._applying = None
+        PREFETCH_COUNT.labels().set(prefetchCount)
+
+    def throttle(self):
+        self._throttled += 1
+        if self._throttled == 1:
+            log.info("Consumer throttled, lowering prefetch to %d",
+                self._throttledPrefetchCount)
+            self._scheduleApply()
+
+    def release(self):
+        self._throttled -= 1
+        if self._throttled == 0:
+            log.info("Consumer recovered, restoring prefetch to %d",
+                self._prefetchCount)
+            self._scheduleApply()
+
+    @property
+    def throttled(self):
+        return self._throttled > 0
+
+    # the prefetch to use while no sender is throttled
+    def setPrefetchCount(self, prefetchCount):
+        if prefetchCount != self._prefetchCount:
+            self._prefetchCount = prefetchCount
+            self._scheduleApply()
+
+    @property
+    def targetPrefetchCount(self):
+        return self._prefetchCount
+
+    @property
+    def prefetchCount(self):
+        return self._appliedPrefetchCount
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _getWantedPrefetchCount(self):
+        if self._throttled > 0:
+            return min(self._throttledPrefetchCount, self._prefetchCount)
+        return self._prefetchCount
+
+    def _scheduleApply(self):
+        # a single task applies the latest wanted value, so quick throttle /
+        # release flips can never reach the broker out of order
+        if self._applying is None or self._applying.done():
+            self._applying = asyncio.ensure_future(self._apply())
+
+    async def _apply(self):
+        while self._appliedPrefetchCount != self._getWantedPrefetchCount():
+            prefetchCount = self._getWantedPrefetchCount()
+            try:
+                await self._client.set_qos(prefetchCount)
+            except Exception as exc:
+                log.error("ConsumerBackpressure set_qos raised exception: %s", exc)
+                return
+            self._appliedPrefetchCount = prefetchCount
+            PREFETCH_COUNT.labels().set(prefetchCount)
+
+
+# Tunes the prefetch with Little's law: the deliveries a worker needs at hand
+# is the rate alerts are sent at times how long a send takes, both read from
+# the send stage latency histogram. Every interval the prefetch moves towards
+# that concurrency, converted from sends to deliveries and given headroom,
+# within [minPrefetch, maxPrefetch]. When the prefetch itself limits the
+# throughput the measured concurrency is close to it, so the headroom keeps
+# growing it until sends are no longer starved.
+class AdaptivePrefetch(object):
+    def __init__(self, backpressure, consumer, minPrefetch=1, maxPrefetch=1000,
+            interval=5.0, headroom=1.5, smoothing=0.5):
+        self._backpressure = backpressure
+        self._consumer = consumer
+        self._minPrefetch = max(1, minPrefetch)
+        self._maxPrefetch = max(self._minPrefetch, maxPrefetch)
+        self._interval = interval
+        self._headroom = headroom
+        self._smoothing = smoothing
+
+    async def run(self):
+        lastSends, lastSendSeconds = STAGE_LATENCY.totals(stage='send')
+        lastDeliveries = self._consumer.stats()['processed']
+        lastAt = time.monotonic()
+        while True:
+            await asyncio.sleep(self._interval)
+            sends, sendSeconds = STAGE_LATENCY.totals(stage='send')
+            deliveries = self._consumer.stats()['processed']
+            now = time.monotonic()
+            try:
+                self.adjust(
+                    sends - lastSends, sendSeconds - lastSendSeconds,
+                    deliveries - lastDeliveries, now - lastAt
+                )
+            except Exception as exc:
+                log.error("AdaptivePrefetch raised exception: %s", exc)
+            lastSends, lastSendSeconds = sends, sendSeconds
+            lastDeliveries, lastAt = deliveries, now
+
+    def adjust(self, sends, sendSeconds, deliveries, elapsed):
+        current = self._backpressure.targetPrefetchCount
+        if sends <= 0 or elapsed <= 0:
+            # nothing was sent, there is nothing to learn from
+            return current
+        # average number of sends in progress, L = lambda * W
+        concurrency = sendSeconds / elapsed
+        if deliveries > 0:
+            # a delivery can carry several alerts sent concurrently
+            concurrency = concurrency * deliveries / sends
+        wanted = concurrency * self._headroom + 1
+        wanted = current + self._smoothing * (wanted - current)
+        prefetchCount = int(min(
+            self._maxPrefetch, max(self._minPrefetch, math.ceil(wanted))
+        ))
+        if prefetchCount != current:
+            log.info("AdaptivePrefetch: %.1f sends/s taking %.3fs, prefetch %d -> %d",
+                sends / elapsed, sendSeconds / sends, current, prefetchCount)
+            self._backpressure.setPrefetchCount(prefetchCount)
+        return prefetchCount
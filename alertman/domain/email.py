@@ -1,30 +1,38 @@
-import time
-
+from alertman.domain.ids import newAlertID
 from alertman.domain.sms import SMSMessage
 
 
+# Slotted, hundreds of thousands of alerts can be queued in memory at once.
+# rendered holds the message rendered ahead of sending, if any.
 class EmailMessage(object):
-    def __init__(self, sender, receiver, subject='Email Subject', body=''):
-        self.emailID = int(time.time()*1000)
+    __slots__ = ('alertID', 'sender', 'receiver', 'subject', 'body', 'rendered')
+
+    def __init__(self, sender, receiver, subject='Email Subject', body='', alertID=None):
+        self.alertID = newAlertID() if alertID is None else alertID
         self.sender = sender
         self.receiver = receiver
         self.subject = subject
         self.body = body
+        self.rendered = None
+
+    @property
+    def emailID(self):
+        return self.alertID
     
     def __repr__(self):
-        return '{{ EmailMessage: {{ from: {0}, to: {1}, subject: {2} }} }}'.format(
-            self.sender, self.receiver, self.subject)
+        return '{{ EmailMessage: {{ id: {0}, from: {1}, to: {2}, subject: {3} }} }}'.format(
+            self.alertID, self.sender, self.receiver, self.subject)
     
 
-def createAlertObject(alertMsg, alertType):
+def createAlertObject(alertMsg, alertType, alertID=None):
     if alertType == 'email':
         return EmailMessage(alertMsg['sender'], alertMsg['receiver'],
-            alertMsg['subject'], alertMsg['body']
+            alertMsg['subject'], alertMsg['body'], alertID
         )
 
     elif alertType == 'sms':
         return SMSMessage(alertMsg['sender'], 
-            alertMsg['receiver'], alertMsg['body']
+            alertMsg['receiver'], alertMsg['body'], alertID
         )
     else:
         raise Exception("Alerttype: {} not available".format(alertType))
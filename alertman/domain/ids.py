@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+# 2020-01-01 00:00:00 UTC in milliseconds, 41 bits of milliseconds from here
+# last until 2089
+EPOCH_MS = 1577836800000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+# Snowflake style 64 bit ids, milliseconds since EPOCH_MS, then the node id
+# then a per millisecond sequence, so ids sort by creation time and never
+# collide between nodes. Ids only ever go up: when the wall clock steps back
+# the generator stays on its last millisecond, and when the 4096 ids of a
+# millisecond are used up it moves on to the next one ahead of the clock
+# instead of sleeping.
+class IDGenerator(object):
+    def __init__(self, nodeID=0):
+        if not 0 <= nodeID <= MAX_NODE_ID:
+            raise Exception("IDGenerator node id: {} not in 0..{}".format(
+                nodeID, MAX_NODE_ID))
+        self.nodeID = nodeID
+        self._lastMs = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            nowMs = int(time.time() * 1000) - EPOCH_MS
+            if nowMs > self._lastMs:
+                self._lastMs = nowMs
+                self._sequence = 0
+            elif self._sequence < MAX_SEQUENCE:
+                self._sequence += 1
+            else:
+                self._lastMs += 1
+                self._sequence = 0
+            return (self._lastMs << (NODE_BITS + SEQUENCE_BITS)) | \
+                (self.nodeID << SEQUENCE_BITS) | self._sequence
+
+
+def getIDTimestamp(alertID):
+    # seconds since the unix epoch the id was created at
+    return ((alertID >> (NODE_BITS + SEQUENCE_BITS)) + EPOCH_MS) / 1000.0
+
+
+def getIDNode(alertID):
+    return (alertID >> SEQUENCE_BITS) & MAX_NODE_ID
+
+
+idGenerator = IDGenerator()
+
+
+# every worker process has to use a node id of its own, eg: its worker index
+def configureIDGenerator(nodeID):
+    global idGenerator
+    idGenerator = IDGenerator(nodeID)
+
+
+def newAlertID():
+    return idGenerator.next()
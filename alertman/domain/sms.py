@@ -1,20 +1,30 @@
 import abc
-import time
+
+from alertman.domain.ids import newAlertID
 
 
 class AlertMessage(object):
+    __slots__ = ('_messageBody', 'messageType')
+
     def __init__(self, messageBody, messageType):
         self._messageBody = messageBody
         self.messageType = messageType
 
 
 class SMSMessage(object):
-    def __init__(self, sender, receiver, body=''):
-        self.smsID = self.emailID = int(time.time()*1000)
+    __slots__ = ('alertID', 'sender', 'receiver', 'body', 'rendered')
+
+    def __init__(self, sender, receiver, body='', alertID=None):
+        self.alertID = newAlertID() if alertID is None else alertID
         self.sender = sender
         self.receiver = receiver
         self.body = body
+        self.rendered = None
+
+    @property
+    def smsID(self):
+        return self.alertID
     
     def __repr__(self):
-        return '{{ SMSMessage: {{ from: {0}, to: {1} }}'.format(
-            self.sender, self.receiver)
+        return '{{ SMSMessage: {{ id: {0}, from: {1}, to: {2} }} }}'.format(
+            self.alertID, self.sender, self.receiver)
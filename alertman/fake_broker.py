@@ -0,0 +1,289 @@
+import asyncio
+import time
+
+from aio_pika.exceptions import ChannelPreconditionFailed, MessageProcessError
+
+from alertman.log import getCustomLogger
+from alertman.message_codecs import getCodec
+from alertman.rabbitmq_client import RabbitMQClient
+
+
+log = getCustomLogger(__name__)
+
+
+# Settles like an aio_pika 10 delivery: ack, reject and nack are coroutines
+# and settling a delivery a second time raises.
+class FakeIncomingMessage(object):
+    def __init__(self, client, queue, deliveryTag, body, routing_key='',
+            headers=None, content_type=None, timestamp=None, priority=None):
+        self._client = client
+        self._queue = queue
+        self.delivery_tag = deliveryTag
+        self.body = body
+        self.routing_key = routing_key
+        self.headers = headers or {}
+        self.content_type = content_type
+        self.timestamp = timestamp
+        self.priority = priority
+        self.publishedAt = time.perf_counter()
+        self.redelivered = False
+        self.consumer = None
+        self._processed = False
+
+    async def ack(self, multiple=False):
+        self._process()
+        self._client._settle(self, 'ack', multiple)
+
+    async def reject(self, requeue=False):
+        self._process()
+        self._client._settle(self, 'reject', False, requeue)
+
+    async def nack(self, multiple=False, requeue=True):
+        self._process()
+        self._client._settle(self, 'nack', multiple, requeue)
+
+    def _process(self):
+        if self._processed:
+            raise MessageProcessError("Message already processed", self)
+        self._processed = True
+
+
+# A consumer keeps the prefetch count it was started with, like a per
+# consumer basic.qos on rabbitmq only applies to consumers started after it.
+class FakeConsumer(object):
+    def __init__(self, queue, on_message, prefetchCount=0):
+        self.queue = queue
+        self.on_message = on_message
+        self.prefetchCount = prefetchCount
+        self.unacked = 0
+        self.deliverable = asyncio.Event()
+        self.deliverable.set()
+
+    def update(self):
+        if self.prefetchCount and self.unacked >= self.prefetchCount:
+            self.deliverable.clear()
+        else:
+            self.deliverable.set()
+
+
+class FakeQueue(object):
+    def __init__(self, name, arguments=None):
+        self.name = name
+        self.arguments = arguments or {}
+        # like rabbitmq, higher priorities first and fifo within a priority
+        self.maxPriority = self.arguments.get('x-max-priority', 0)
+        self.messages = asyncio.PriorityQueue()
+        self.unacked = {}
+        self._sequence = 0
+
+    def put(self, message):
+        priority = min(message.priority or 0, self.maxPriority)
+        self._sequence += 1
+        self.messages.put_nowait((-priority, self._sequence, message))
+
+    async def get(self):
+        _, _, message = await self.messages.get()
+        return message
+
+
+# In process stand-in for the RabbitMQClient interface, used by benchmarks
+# and the load generator when no broker is around. It routes through direct,
+# topic and fanout exchanges, honours the prefetch count of every consumer,
+# and calls onSettle for every ack / reject so callers can measure end to
+# end latency. Settling an unknown delivery tag fails like on the broker.
+class FakeRabbitMQClient(RabbitMQClient):
+    def __init__(self, codec='json', onSettle=None):
+        self._codec = getCodec(codec)
+        self._onSettle = onSettle
+        self._exchanges = {}
+        self._queues = {}
+        self._prefetchCount = 0
+        self._deliveryTag = 0
+        self._unackedCount = 0
+        self._settleFrames = 0
+        self._consumerTasks = []
+        self._routes = {}
+
+    async def publish(self, msgToPublish, exchange='default_exchange',
+            routing_key='', options=None):
+        options = options or {}
+        codec = self._codec
+        if 'codec' in options:
+            codec = getCodec(options['codec'])
+        body = codec.encode({'message': msgToPublish})
+        self._route(body, exchange, routing_key, dict(options, contentType=codec.contentType))
+
+    async def publish_many(self, msgsToPublish, exchange='default_exchange',
+            routing_key='', options=None):
+        results = []
+        for msgToPublish in msgsToPublish:
+            try:
+                results.append(await self.publish(msgToPublish, exchange, routing_key, options))
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+    async def publish_raw(self, body, exchange='', routing_key='', options=None):
+        self._route(body, exchange, routing_key, options or {})
+
+    async def declare_queue(self, queue, options=None):
+        options = options or {}
+        if queue not in self._queues:
+            arguments = dict(options.get('queueArguments') or {})
+            if options.get('maxPriority'):
+                arguments['x-max-priority'] = options['maxPriority']
+            self._queues[queue] = FakeQueue(queue, arguments)
+        return self._queues[queue]
+
+    async def set_qos(self, prefetchCount):
+        # running consumers keep their prefetch, see FakeConsumer
+        self._prefetchCount = prefetchCount
+
+    async def consume(self, queue, exchange, on_message, options=None):
+        options = options or {}
+        if 'set_qos' in options:
+            await self.set_qos(options['set_qos'])
+        fakeQueue = await self.declare_queue(queue, options)
+        bindingKeys = options.get('bindingKey', None)
+        if isinstance(bindingKeys, str):
+            bindingKeys = [bindingKeys]
+        for bindingKey in bindingKeys or []:
+            self.bind(queue, exchange, bindingKey, options.get('exchangeType', 'topic'))
+        consumer = FakeConsumer(fakeQueue, on_message, self._prefetchCount)
+        self._consumerTasks.append(asyncio.ensure_future(self._dispatch(consumer)))
+
+    def bind(self, queue, exchange, bindingKey, exchangeType='topic'):
+        self._exchanges.setdefault(exchange, {'type': exchangeType, 'bindings': []})
+        self._exchanges[exchange]['bindings'].append((bindingKey, queue))
+        self._routes = {}
+
+    async def setup(self):
+        return self
+
+    async def close(self):
+        for task in self._consumerTasks:
+            task.cancel()
+        self._consumerTasks = []
+
+    def queueDepth(self, queue):
+        fakeQueue = self._queues.get(queue)
+        return fakeQueue.messages.qsize() if fakeQueue else 0
+
+    @property
+    def unackedCount(self):
+        return self._unackedCount
+
+    # number of ack / reject / nack frames a real broker would have received
+    @property
+    def settleFrames(self):
+        return self._settleFrames
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _getQueues(self, exchange, routing_key):
+        # routing results are cached per exchange and routing key until the
+        # next bind, so the hot path is a single dict lookup
+        key = (exchange, routing_key)
+        if key not in self._routes:
+            if exchange == '':
+                queues = [routing_key] if routing_key in self._queues else []
+            else:
+                exchangeInfo = self._exchanges.get(exchange, {'bindings': []})
+                queues = [
+                    queue for bindingKey, queue in exchangeInfo['bindings']
+                    if self._matches(exchangeInfo['type'], bindingKey, routing_key)
+                ]
+            self._routes[key] = queues
+        return self._routes[key]
+
+    def _matches(self, exchangeType, bindingKey, routing_key):
+        if exchangeType == 'fanout':
+            return True
+        if exchangeType == 'direct':
+            return bindingKey == routing_key
+        return topicMatches(bindingKey.split('.'), routing_key.split('.'))
+
+    def _route(self, body, exchange, routing_key, options):
+        for queue in self._getQueues(exchange, routing_key):
+            self._deliveryTag += 1
+            message = FakeIncomingMessage(
+                self, queue, self._deliveryTag, body, routing_key,
+                headers=options.get('headers'),
+                content_type=options.get('contentType'),
+                timestamp=options.get('timestamp'),
+                priority=options.get('priority')
+            )
+            arguments = self._queues[queue].arguments
+            if 'x-message-ttl' in arguments and 'x-dead-letter-exchange' in arguments:
+                # delay queues are never consumed, their messages expire
+                # into the dead letter exchange like on a real broker
+                asyncio.get_event_loop().call_later(
+                    arguments['x-message-ttl'] / 1000.0, self._route, body,
+                    arguments['x-dead-letter-exchange'],
+                    arguments.get('x-dead-letter-routing-key', routing_key),
+                    options
+                )
+                continue
+            self._queues[queue].put(message)
+
+    async def _dispatch(self, consumer):
+        while True:
+            await consumer.deliverable.wait()
+            message = await consumer.queue.get()
+            message.consumer = consumer
+            consumer.queue.unacked[message.delivery_tag] = message
+            consumer.unacked += 1
+            self._unackedCount += 1
+            consumer.update()
+            asyncio.ensure_future(consumer.on_message(message))
+
+    def _settle(self, message, outcome, multiple=False, requeue=False):
+        self._settleFrames += 1
+        fakeQueue = self._queues[message._queue]
+        if message.delivery_tag not in fakeQueue.unacked:
+            raise ChannelPreconditionFailed(
+                "PRECONDITION_FAILED - unknown delivery tag {}".format(message.delivery_tag))
+        if multiple:
+            settled = [
+                tag for tag in fakeQueue.unacked if tag <= message.delivery_tag
+            ]
+        else:
+            settled = [message.delivery_tag]
+        for tag in settled:
+            settledMessage = fakeQueue.unacked.pop(tag)
+            settledMessage.consumer.unacked -= 1
+            settledMessage.consumer.update()
+            self._unackedCount -= 1
+            if outcome != 'ack' and requeue:
+                # a redelivery gets a new delivery tag
+                self._deliveryTag += 1
+                redelivery = FakeIncomingMessage(
+                    self, settledMessage._queue, self._deliveryTag,
+                    settledMessage.body, settledMessage.routing_key,
+                    settledMessage.headers, settledMessage.content_type,
+                    settledMessage.timestamp, settledMessage.priority
+                )
+                redelivery.publishedAt = settledMessage.publishedAt
+                redelivery.redelivered = True
+                fakeQueue.put(redelivery)
+            elif self._onSettle:
+                self._onSettle(settledMessage, outcome)
+
+
+def topicMatches(bindingWords, routingWords):
+    # amqp topic matching, '*' is exactly one word and '#' zero or more
+    if not bindingWords:
+        return not routingWords
+    head = bindingWords[0]
+    if head == '#':
+        return any(
+            topicMatches(bindingWords[1:], routingWords[index:])
+            for index in range(len(routingWords) + 1)
+        )
+    if not routingWords:
+        return False
+    if head == '*' or head == routingWords[0]:
+        return topicMatches(bindingWords[1:], routingWords[1:])
+    return False
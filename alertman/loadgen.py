@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from time import perf_counter
+
+from alertman.log import getCustomLogger
+from alertman.message_codecs import decodeMessageBody
+
+
+log = getCustomLogger(__name__)
+
+
+LOADGEN_QUEUE = 'alertman_loadgen_queue'
+
+
+# How many alerts are due after elapsed seconds, the integral of the rate so
+# the generator catches up after falling behind instead of drifting:
+#
+#   fixed  rate alerts/sec for duration seconds
+#   ramp   rate going linearly from rampFrom to rate over duration seconds
+#   burst  burstSize alerts at once every burstInterval seconds, starting at
+#          0 and before duration, a single burst when there's no duration
+class LoadProfile(object):
+    def __init__(self, profile='fixed', rate=100.0, duration=10.0, rampFrom=0.0,
+            burstSize=1000, burstInterval=1.0):
+        if profile not in ('fixed', 'ramp', 'burst'):
+            raise Exception("Load profile: {} not available".format(profile))
+        self.profile = profile
+        self.rate = rate
+        self.duration = duration
+        self.rampFrom = rampFrom
+        self.burstSize = burstSize
+        self.burstInterval = burstInterval
+
+    def due(self, elapsed):
+        elapsed = min(elapsed, self.duration)
+        if self.profile == 'fixed':
+            return int(self.rate * elapsed)
+        if self.profile == 'ramp':
+            slope = (self.rate - self.rampFrom) / self.duration if self.duration else 0.0
+            return int(self.rampFrom * elapsed + slope * elapsed * elapsed / 2.0)
+        if self.duration <= 0:
+            return self.burstSize
+        bursts = min(
+            int(elapsed / self.burstInterval) + 1,
+            math.ceil(self.duration / self.burstInterval)
+        )
+        return self.burstSize * bursts
+
+    @property
+    def total(self):
+        return self.due(self.duration)
+
+
+# Builds the synthetic alerts, every one carries the run id, its sequence
+# number and its send time (unix seconds) inside the alert message, so they
+# reach whatever the worker sends them to.
+class AlertFactory(object):
+    def __init__(self, alertTypes, routingKeys, bodySizes, runID, source='loadgen',
+            severities=('info', 'warning', 'critical')):
+        self.alertTypes = list(alertTypes)
+        self.routingKeys = list(routingKeys)
+        self.bodySizes = list(bodySizes)
+        self.runID = runID
+        self.source = source
+        self.severities = list(severities)
+        self._payloads = {}
+
+    def create(self, sequence):
+        bodySize = random.choice(self.bodySizes)
+        payload = self._payloads.get(bodySize)
+        if payload is None:
+            payload = self._payloads[bodySize] = 'x' * bodySize
+        alert = {
+            'alertTypes': [random.choice(self.alertTypes)],
+            'source': self.source,
+            'severity': random.choice(self.severities),
+            'message': {
+                'runID': self.runID,
+                'sequence': sequence,
+                'sentAt': time.time(),
+                'payload': payload
+            }
+        }
+        return alert, random.choice(self.routingKeys)
+
+
+class LoadGenerator(object):
+    def __init__(self, client, exchange, profile, alertFactory, concurrency=64,
+            options=None):
+        self._client = client
+        self._exchange = exchange
+        self._profile = profile
+        self._alertFactory = alertFactory
+        self._slots = asyncio.Semaphore(concurrency)
+        self._options = options or {}
+        self._pending = set()
+        self.published = 0
+        self.failed = 0
+        self.publishLatencies = LatencyReservoir()
+        self.elapsed = 0.0
+
+    async def run(self):
+        sequence = 0
+        startedAt = perf_counter()
+        total = self._profile.total
+        while sequence < total:
+            due = min(total, self._profile.due(perf_counter() - startedAt))
+            while sequence < due:
+                sequence += 1
+                # waits once the publishes in flight hit the concurrency
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._publish(sequence))
+                self._pending.add(task)
+                task.add_done_callback(self._pending.discard)
+            await asyncio.sleep(0.001)
+        if self._pending:
+            await asyncio.wait(self._pending)
+        self.elapsed = perf_counter() - startedAt
+        return self
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _publish(self, sequence):
+        alert, routingKey = self._alertFactory.create(sequence)
+        options = dict(self._options, timestamp=int(alert['message']['sentAt']))
+        options['headers'] = {'x-loadgen-sequence': sequence}
+        startedAt = perf_counter()
+        try:
+            await self._client.publish(alert, self._exchange, routingKey, options)
+            self.published += 1
+            self.publishLatencies.add(perf_counter() - startedAt)
+        except Exception as exc:
+            self.failed += 1
+            log.error("Loadgen could not publish alert: %d: %s", sequence, exc)
+        finally:
+            self._slots.release()
+
+
+# Consumes the generated alerts and checks them off by sequence number, every
+# alert of another run is ignored. Latency is from the send time stamped by
+# the generator, so generator and sink clocks have to be in sync when they
+# run on different hosts.
+class LoadgenSink(object):
+    def __init__(self, runID):
+        self.runID = runID
+        self.sequences = set()
+        self.duplicates = 0
+        self.foreign = 0
+        self.latencies = LatencyReservoir()
+
+    async def on_message(self, message):
+        try:
+            content = decodeMessageBody(message.body, message.content_type)['message']
+            stamp = content['message']
+            if stamp.get('runID') != self.runID:
+                self.foreign += 1
+            elif stamp['sequence'] in self.sequences:
+                self.duplicates += 1
+            else:
+                self.sequences.add(stamp['sequence'])
+                self.latencies.add(time.time() - stamp['sentAt'])
+        except Exception as exc:
+            log.error("Loadgen sink could not read message: %s", exc)
+        finally:
+            await message.ack()
+
+    @property
+    def received(self):
+        return len(self.sequences)
+
+
+# A uniform sample of at most size latencies out of all the ones added, so
+# long runs keep a fixed memory. Percentiles are estimated from the sample,
+# the maximum is exact.
+class LatencyReservoir(object):
+    def __init__(self, size=10000):
+        self.size = size
+        self.count = 0
+        self.max = 0.0
+        self._sample = []
+
+    def add(self, value):
+        self.count += 1
+        self.max = max(self.max, value)
+        if len(self._sample) < self.size:
+            self._sample.append(value)
+            return
+        index = random.randrange(self.count)
+        if index < self.size:
+            self._sample[index] = value
+
+    def percentile(self, fraction):
+        return percentile(self._sample, fraction)
+
+    def __len__(self):
+        return self.count
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def getSummary(args, profile, generator, sink=None):
+    summary = {
+        'runID': args.run_id,
+        'profile': profile.profile,
+        'planned': profile.total,
+        'published': generator.published,
+        'failed': generator.failed,
+        'elapsedSeconds': round(generator.elapsed, 3),
+        'publishRate': round(generator.published / generator.elapsed, 2) if generator.elapsed else 0.0,
+        'publishP50Ms': round(generator.publishLatencies.percentile(0.50) * 1000, 3),
+        'publishP99Ms': round(generator.publishLatencies.percentile(0.99) * 1000, 3),
+    }
+    if sink is not None:
+        missing = [
+            sequence for sequence in range(1, profile.total + 1)
+            if sequence not in sink.sequences
+        ]
+        summary.update({
+            'received': sink.received,
+            'lost': len(missing),
+            'firstLost': missing[:10],
+            'duplicates': sink.duplicates,
+            'endToEndP50Ms': round(sink.latencies.percentile(0.50) * 1000, 3),
+            'endToEndP99Ms': round(sink.latencies.percentile(0.99) * 1000, 3),
+            'endToEndMaxMs': round(sink.latencies.max * 1000, 3),
+        })
+    return summary
+
+
+def printSummary(summary):
+    width = max(len(key) for key in summary)
+    for key, value in summary.items():
+        print('{}  {}'.format(key.ljust(width), value))
+
+
+async def getClient(args, loop):
+    if args.fake:
+        from alertman.fake_broker import FakeRabbitMQClient
+        return FakeRabbitMQClient(codec=args.codec)
+    from alertman.rabbitmq_client import AioPikaClient
+    client = AioPikaClient(
+        username=args.username, password=args.password, host=args.host,
+        port=args.port, virtualhoat=args.vhost, loop=loop,
+        publisherConfirms=args.confirms, codec=args.codec,
+        publishChannels=args.publish_channels
+    )
+    await client.setup()
+    return client
+
+
+async def runLoadgen(args, loop):
+    profile = LoadProfile(
+        args.profile, args.rate, args.duration, args.ramp_from,
+        args.burst_size, args.burst_interval
+    )
+    alertFactory = AlertFactory(
+        args.alert_type or ['email'], args.routing_key or ['dummy-alerts'],
+        getBodySizes(args.body_size or ['256']), args.run_id
+    )
+    client = await getClient(args, loop)
+    options = {'exchangeType': 'topic'}
+    if args.persistent:
+        options['deliverMode'] = 'persistent'
+
+    sink = None
+    # without a broker the generated alerts have to end somewhere, so the
+    # fake always consumes them itself
+    sinkQueue = args.sink_queue or (LOADGEN_QUEUE if args.fake else None)
+    if sinkQueue:
+        sink = LoadgenSink(args.run_id)
+        await client.consume(sinkQueue, args.exchange, sink.on_message, dict(options,
+            bindingKey=args.routing_key or ['dummy-alerts'], set_qos=args.sink_prefetch))
+
+    generator = LoadGenerator(
+        client, args.exchange, profile, alertFactory, args.concurrency, options
+    )
+    await generator.run()
+    if sink is not None:
+        drainDeadline = perf_counter() + args.drain_timeout
+        while (sink.received + sink.duplicates < generator.published and
+                perf_counter() < drainDeadline):
+            await asyncio.sleep(0.05)
+    await client.close()
+    return getSummary(args, profile, generator, sink)
+
+
+def getBodySizes(specs):
+    # sizes are bytes, "256" or a "100-2000" range sampled in 8 steps
+    bodySizes = []
+    for spec in specs:
+        if '-' in spec:
+            low, high = (int(value) for value in spec.split('-', 1))
+            step = max(1, (high - low) // 8)
+            bodySizes.extend(range(low, high + 1, step))
+        else:
+            bodySizes.append(int(spec))
+    return bodySizes
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description='publish synthetic alerts at a worker for capacity planning'
+    )
+    parser.add_argument('--profile', default='fixed', choices=('fixed', 'ramp', 'burst'))
+    parser.add_argument('--rate', type=float, default=100.0,
+        help='alerts per second, the final rate of a ramp')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to publish for')
+    parser.add_argument('--ramp-from', type=float, default=0.0,
+        help='alerts per second a ramp starts at')
+    parser.add_argument('--burst-size', type=int, default=1000)
+    parser.add_argument('--burst-interval', type=float, default=1.0)
+    parser.add_argument('--alert-type', action='append',
+        help='alert type to generate, can be repeated, defaults to email')
+    parser.add_argument('--routing-key', action='append',
+        help='routing key to publish with, can be repeated, defaults to dummy-alerts')
+    parser.add_argument('--body-size', action='append',
+        help='payload bytes, eg: 256 or 100-2000, can be repeated, defaults to 256')
+    parser.add_argument('--exchange', default='dummy-exchange')
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--persistent', action='store_true', help='persistent delivery mode')
+    parser.add_argument('--concurrency', type=int, default=64,
+        help='publishes in flight at most')
+    parser.add_argument('--fake', action='store_true',
+        help='publish into an in process fake broker instead of rabbitmq')
+    parser.add_argument('--sink-queue',
+        help='consume this queue and report loss, duplicates and end to end latency')
+    parser.add_argument('--sink-prefetch', type=int, default=500)
+    parser.add_argument('--drain-timeout', type=float, default=30.0)
+    parser.add_argument('--run-id', default=uuid.uuid4().hex[:12])
+    parser.add_argument('--output', help='write the summary as json to this file')
+    parser.add_argument('--host', default=os.getenv('MESSAGE_BROKER_SERVICE_HOST', 'localhost'))
+    parser.add_argument('--port', type=int,
+        default=int(os.getenv('MESSAGE_BROKER_SERVICE_PORT', 5672)))
+    parser.add_argument('--username', default=os.getenv('MESSAGE_BROKER_SERVICE_USERNAME', 'guest'))
+    parser.add_argument('--password', default=os.getenv('MESSAGE_BROKER_SERVICE_PASSWORD', 'guest'))
+    parser.add_argument('--vhost', default=os.getenv('MESSAGE_BROKER_SERVICE_VIRTUALHOST', '/'))
+    parser.add_argument('--publish-channels', type=int, default=4)
+    parser.add_argument('--confirms', action='store_true', help='use publisher confirms')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    loop = asyncio.get_event_loop()
+    try:
+        summary = loop.run_until_complete(runLoadgen(args, loop))
+    except KeyboardInterrupt:
+        return 1
+    printSummary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 0 if not summary['failed'] and not summary.get('lost') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,12 @@
 # Initate logging loggers, and handlers
+import atexit
+import json
 import logging
+import os
+import queue
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
 from os import getenv
 
 
@@ -12,23 +19,139 @@ LOG_LEVEL = {
     'error': logging.ERROR
 }
 
+# 'sync' writes from the calling thread, 'queue' hands records to a
+# background thread so that writes never block the event loop
+LOG_MODE = getenv('LOG_MODE', 'sync')
+# 'text' or 'json' lines
+LOG_FORMAT = getenv('LOG_FORMAT', 'text')
+# at most LOG_RATE_LIMIT_BURST records of the same message per
+# LOG_RATE_LIMIT_INTERVAL seconds, 0 disables rate limiting
+LOG_RATE_LIMIT_INTERVAL = float(getenv('LOG_RATE_LIMIT_INTERVAL', 0))
+LOG_RATE_LIMIT_BURST = int(getenv('LOG_RATE_LIMIT_BURST', 10))
+
+DEFAULT_FORMAT = '[%(levelname)s]: [%(asctime)s]  [%(name)s] [%(funcName)s:%(lineno)d] - %(message)s'
+DEFAULT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+
+_logQueue = None
+_logListener = None
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'func': record.funcName,
+            'line': record.lineno,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class DeferredQueueHandler(QueueHandler):
+    # the stock QueueHandler formats the message in the calling thread, here
+    # the record is enqueued as is and only the listener thread formats it
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    # records are grouped by their unformatted message, so the same error
+    # logged with different arguments counts as one repeated message. The
+    # windows are kept in the order they started, expired ones are dropped
+    # from the front and at most maxKeys messages are tracked at a time
+    def __init__(self, interval, burst, maxKeys=1000):
+        super().__init__()
+        self._interval = interval
+        self._burst = burst
+        self._maxKeys = maxKeys
+        self._windows = OrderedDict()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self._interval:
+            suppressed = window[2] if window else 0
+            window = self._windows[key] = [now, 0, 0]
+            self._windows.move_to_end(key)
+            self._prune(now)
+            if suppressed:
+                record.msg = '{} (suppressed {} similar messages)'.format(
+                    record.msg, suppressed)
+        window[1] += 1
+        if window[1] > self._burst:
+            window[2] += 1
+            return False
+        return True
+
+    def _prune(self, now):
+        while self._windows:
+            startedAt = next(iter(self._windows.values()))[0]
+            if now - startedAt < self._interval and len(self._windows) <= self._maxKeys:
+                break
+            self._windows.popitem(last=False)
+
+
+def getFormatter():
+    if LOG_FORMAT == 'json':
+        return JSONFormatter(datefmt=DEFAULT_DATE_FORMAT)
+    return logging.Formatter(DEFAULT_FORMAT, DEFAULT_DATE_FORMAT)
+
+
+def getQueueHandler():
+    # one queue and one listener thread are shared by all the loggers
+    global _logQueue, _logListener
+    if _logListener is None:
+        _logQueue = queue.SimpleQueue()
+        handler = logging.StreamHandler()
+        handler.setFormatter(getFormatter())
+        _logListener = QueueListener(_logQueue, handler)
+        _logListener.start()
+        atexit.register(stopLogging)
+        # forked worker processes inherit the queue but not the thread
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=_restartListener)
+    return DeferredQueueHandler(_logQueue)
+
+
+def _restartListener():
+    global _logListener
+    if _logListener is not None:
+        _logListener = QueueListener(_logQueue, *_logListener.handlers)
+        _logListener.start()
+
+
+def stopLogging():
+    # flushes every record still waiting in the queue
+    global _logListener
+    if _logListener is not None:
+        _logListener.stop()
+        _logListener = None
+
 
 def getCustomLogger(loggerName, logLevel=LOG_LEVEL[loglevel]):
     # initiate a logger
     logger = logging.getLogger(loggerName)
     if len(logger.handlers) != 0:
         return logger
-    # create formatter
-    DEFAULT_FORMAT = '[%(levelname)s]: [%(asctime)s]  [%(name)s] [%(funcName)s:%(lineno)d] - %(message)s'
-    DEFAULT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S %z'
-    formatter = logging.Formatter(DEFAULT_FORMAT, DEFAULT_DATE_FORMAT)
-    # create console handler and set level to info
-    handler = logging.StreamHandler()
+    if LOG_MODE == 'queue':
+        handler = getQueueHandler()
+        # the root logger writes synchronously, keep records away from it
+        logger.propagate = False
+    else:
+        # create console handler with the formatter
+        handler = logging.StreamHandler()
+        handler.setFormatter(getFormatter())
+    # set level for handler and Logger
     handler.setLevel(logLevel)
-    # add formatter to handler
-    handler.setFormatter(formatter)
-    # set level for Logger
     logger.setLevel(logLevel)
+    # drop repeated messages before they cost any formatting or io
+    if LOG_RATE_LIMIT_INTERVAL > 0:
+        logger.addFilter(RateLimitFilter(LOG_RATE_LIMIT_INTERVAL, LOG_RATE_LIMIT_BURST))
     # add handler to logger
     logger.addHandler(handler)
 
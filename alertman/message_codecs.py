@@ -0,0 +1,97 @@
+import abc
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+# Interface
+class Codec(metaclass=abc.ABCMeta):
+    contentType = None
+
+    @abc.abstractmethod
+    def encode(self, obj):
+        pass
+
+    # decodes straight from the message body bytes
+    @abc.abstractmethod
+    def decode(self, data):
+        pass
+
+
+class JSONCodec(Codec):
+    contentType = 'application/json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(Codec):
+    # same wire format as JSONCodec, just a faster implementation
+    contentType = 'application/json'
+
+    def encode(self, obj):
+        return orjson.dumps(obj)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(Codec):
+    contentType = 'application/msgpack'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+_codecs = {}
+_contentTypes = {}
+_legacyCodec = JSONCodec()
+
+
+def registerCodec(name, codec):
+    # the last registered codec for a content type is used to decode it
+    _codecs[name] = codec
+    _contentTypes[codec.contentType] = codec
+
+
+def getCodec(name):
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise Exception("Codec: {} not available, registered codecs: {}".format(
+            name, sorted(_codecs)))
+
+
+def getCodecForContentType(contentType):
+    # messages without a known content type are legacy stdlib json ones
+    return _contentTypes.get(contentType, _legacyCodec)
+
+
+def decodeMessageBody(body, contentType=None):
+    return getCodecForContentType(contentType).decode(body)
+
+
+registerCodec('json', _legacyCodec)
+if orjson is not None:
+    registerCodec('orjson', OrjsonCodec())
+if msgpack is not None:
+    registerCodec('msgpack', MsgpackCodec())
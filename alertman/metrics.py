@@ -0,0 +1,296 @@
+import abc
+import asyncio
+import time
+from bisect import bisect_left
+
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+
+# Metrics keep one child per label values tuple. The hot path is a dict lookup
+# in labels() plus an integer add or a bisect, so callers recording the same
+# labels repeatedly can also hold on to the child and skip the lookup.
+class Metric(metaclass=abc.ABCMeta):
+    metricType = None
+
+    def __init__(self, name, documentation, labelNames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._children = {}
+
+    def labels(self, *labelValues):
+        child = self._children.get(labelValues)
+        if child is None:
+            if len(labelValues) != len(self.labelNames):
+                raise Exception("Metric: {} expects labels: {}".format(
+                    self.name, self.labelNames))
+            child = self._children[labelValues] = self._newChild()
+        return child
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.metricType)
+        ]
+        for labelValues, child in list(self._children.items()):
+            lines.extend(self._renderChild(labelValues, child))
+        return lines
+
+    def _formatLabels(self, labelValues, extra=()):
+        pairs = list(zip(self.labelNames, labelValues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+            for name, value in pairs
+        ) + '}'
+
+    @abc.abstractmethod
+    def _newChild(self):
+        pass
+
+    @abc.abstractmethod
+    def _renderChild(self, labelValues, child):
+        pass
+
+
+class _CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(Metric):
+    metricType = 'counter'
+
+    def _newChild(self):
+        return _CounterChild()
+
+    def _renderChild(self, labelValues, child):
+        return ['{}{} {}'.format(self.name, self._formatLabels(labelValues), child.value)]
+
+
+class _GaugeChild(object):
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    # the value is read from function only when the metrics are scraped
+    def setFunction(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Gauge(Metric):
+    metricType = 'gauge'
+
+    def _newChild(self):
+        return _GaugeChild()
+
+    def _renderChild(self, labelValues, child):
+        return ['{}{} {}'.format(self.name, self._formatLabels(labelValues), child.get())]
+
+
+class _HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # counts are per bucket, they are only made cumulative when rendered
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    metricType = 'histogram'
+
+    def __init__(self, name, documentation, labelNames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _newChild(self):
+        return _HistogramChild(self.buckets)
+
+    # count and sum over every child with matching labels, eg: stage='send'
+    def totals(self, **matchLabels):
+        positions = [
+            (self.labelNames.index(name), value) for name, value in matchLabels.items()
+        ]
+        count, total = 0, 0.0
+        for labelValues, child in list(self._children.items()):
+            if all(labelValues[index] == value for index, value in positions):
+                count += child.count
+                total += child.sum
+        return count, total
+
+    def _renderChild(self, labelValues, child):
+        lines = []
+        cumulative = 0
+        for upperBound, count in zip(self.buckets + ('+Inf',), child.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name, self._formatLabels(labelValues, [('le', upperBound)]),
+                cumulative))
+        labels = self._formatLabels(labelValues)
+        lines.append('{}_sum{} {}'.format(self.name, labels, child.sum))
+        lines.append('{}_count{} {}'.format(self.name, labels, child.count))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise Exception("Metric: {} already registered".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelNames=()):
+        return self.register(Counter(name, documentation, labelNames))
+
+    def gauge(self, name, documentation, labelNames=()):
+        return self.register(Gauge(name, documentation, labelNames))
+
+    def histogram(self, name, documentation, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelNames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_LATENCY = REGISTRY.histogram(
+    'alertman_stage_duration_seconds',
+    'Time spent per processing stage',
+    ('stage', 'alert_type', 'outcome')
+)
+ALERTS_PROCESSED = REGISTRY.counter(
+    'alertman_alerts_total',
+    'Alerts processed per alert type and outcome',
+    ('alert_type', 'outcome')
+)
+IN_FLIGHT = REGISTRY.gauge(
+    'alertman_in_flight_messages',
+    'Deliveries currently being processed'
+)
+PIPELINE_QUEUE_DEPTH = REGISTRY.gauge(
+    'alertman_pipeline_queue_depth',
+    'Items waiting in front of each pipeline stage',
+    ('stage',)
+)
+PREFETCH_COUNT = REGISTRY.gauge(
+    'alertman_prefetch_count',
+    'Prefetch count currently applied to the consume channels'
+)
+OUTBOX_PENDING = REGISTRY.gauge(
+    'alertman_outbox_pending',
+    'Alerts spooled in the outbox and not sent yet',
+    ('channel',)
+)
+CIRCUIT_STATE = REGISTRY.gauge(
+    'alertman_circuit_state',
+    'Circuit breaker state per channel, 0 closed, 1 half open, 2 open',
+    ('channel',)
+)
+SMS_RECEIPTS = REGISTRY.counter(
+    'alertman_sms_receipts_total',
+    'Delivery receipts received from the sms gateway per status',
+    ('status',)
+)
+QUEUE_LAG = REGISTRY.gauge(
+    'alertman_queue_lag_seconds',
+    'Time between publishing and consuming of the last delivery'
+)
+
+
+def observeStage(stage, alertType, outcome, startedAt):
+    STAGE_LATENCY.labels(stage, alertType, outcome).observe(
+        time.perf_counter() - startedAt
+    )
+
+
+async def startMetricsServer(host='0.0.0.0', port=9100, registry=REGISTRY, readTimeout=10.0,
+        maxHeaderLines=100):
+    # a minimal http endpoint serving the registry in prometheus text format
+    async def handle(reader, writer):
+        try:
+            try:
+                requestLine = await asyncio.wait_for(
+                    readMetricsRequest(reader, maxHeaderLines), readTimeout
+                )
+            except asyncio.TimeoutError:
+                log.debug("Metrics endpoint timed out reading a request")
+                return
+            parts = requestLine.decode('latin-1').split() if requestLine else []
+            if requestLine is None:
+                status = '431 Request Header Fields Too Large'
+                body = b'too many headers\n'
+            elif len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status = '200 OK'
+                body = registry.render().encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'not found\n'
+            writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                    status, len(body)).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except Exception as exc:
+            log.error("Metrics endpoint raised exception: %s", exc)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info("Metrics endpoint listening on %s:%s/metrics", host, port)
+    return server
+
+
+# returns the request line once the headers are drained, or None when there
+# are more than maxHeaderLines of them
+async def readMetricsRequest(reader, maxHeaderLines):
+    requestLine = await reader.readline()
+    for _ in range(maxHeaderLines + 1):
+        if (await reader.readline()) in (b'\r\n', b'\n', b''):
+            return requestLine
+    return None
@@ -0,0 +1,92 @@
+import asyncio
+
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+# One step of a Pipeline. handler is a coroutine function taking an item and
+# returning the items for the next stage, so a stage can fan an item out or
+# finish it by returning nothing. CPU heavy handlers can push their work to
+# the executor through offload, with a process pool the offloaded function
+# and its arguments have to be picklable.
+class Stage(object):
+    def __init__(self, name, handler, workers=1, queueSize=100, executor=None):
+        self.name = name
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queueSize)
+        self._handler = handler
+        self._executor = executor
+
+    async def handle(self, item):
+        return await self._handler(self, item)
+
+    async def offload(self, function, *args):
+        if self._executor is None:
+            return function(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+
+# Runs items through stages connected by bounded queues, every stage with its
+# own number of worker tasks. A full queue blocks the stage feeding it, so a
+# slow stage pushes back all the way to submit instead of piling up items.
+class Pipeline(object):
+    def __init__(self, stages, onError):
+        self._stages = stages
+        self._onError = onError
+        self._tasks = []
+
+    def start(self):
+        for index, stage in enumerate(self._stages):
+            nextStage = None
+            if index + 1 < len(self._stages):
+                nextStage = self._stages[index + 1]
+            for _ in range(stage.workers):
+                self._tasks.append(
+                    asyncio.ensure_future(self._runWorker(stage, nextStage))
+                )
+
+    async def submit(self, item):
+        await self._stages[0].queue.put(item)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        self._tasks = []
+
+    def depths(self):
+        return dict((stage.name, stage.depth) for stage in self._stages)
+
+    @property
+    def stages(self):
+        return list(self._stages)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _runWorker(self, stage, nextStage):
+        while True:
+            item = await stage.queue.get()
+            try:
+                nextItems = await stage.handle(item)
+                if nextStage is not None:
+                    for nextItem in nextItems or ():
+                        await nextStage.queue.put(nextItem)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                try:
+                    self._onError(stage, item, exc)
+                except Exception as onErrorExc:
+                    log.error("Pipeline onError raised exception: %s", onErrorExc)
+            finally:
+                stage.queue.task_done()
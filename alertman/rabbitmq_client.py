@@ -1,10 +1,11 @@
 import abc
-import json
+import asyncio
 from functools import wraps
 
 import aio_pika
 
 from alertman.log import getCustomLogger
+from alertman.message_codecs import getCodec
 
 
 log = getCustomLogger(__name__)
@@ -15,16 +16,160 @@ class RabbitMQClient(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     async def publish(self, msgToPublish, exchange, routing_key, options=None):
         pass
+
+    @abc.abstractmethod
+    async def publish_many(self, msgsToPublish, exchange, routing_key, options=None):
+        pass
     
     @abc.abstractmethod
     async def consume(self, queue, exchange, options=None):
         pass
 
 
+# One channel of the ChannelManager together with what has to be restored
+# when the channel gets replaced. Exchange handles are per channel, so they
+# are cached here by name once the exchange itself was declared.
+class ChannelSlot(object):
+    def __init__(self, publisherConfirms=False):
+        self.channel = None
+        self.publisherConfirms = publisherConfirms
+        self.exchanges = {}
+        self.prefetchCount = None
+        self.qos = None
+        self.consumer = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def isOpen(self):
+        return self.channel is not None and not self.channel.is_closed
+
+
+# Owns the channels of one connection: a pool of publish channels handed out
+# round robin, one consume channel per queue so that the prefetch and flow
+# control of a queue never stall publishing or another queue, and a channel
+# for declarations so that a failing declare only closes that one. Channels
+# of the robust connection restore themselves, with their qos and consumer,
+# after a channel error or a reconnect. A publish or declare channel that is
+# closed when it's used is replaced by a new one.
+class ChannelManager(object):
+    def __init__(self, getConnection, publishChannels=4, publisherConfirms=False):
+        self._getConnection = getConnection
+        self._publishSlots = [
+            ChannelSlot(publisherConfirms) for _ in range(max(1, publishChannels))
+        ]
+        self._nextPublishSlot = 0
+        self._declareSlot = ChannelSlot()
+        self._consumeSlots = {}
+
+    async def getPublishChannel(self):
+        slot = self._publishSlots[self._nextPublishSlot]
+        self._nextPublishSlot = (self._nextPublishSlot + 1) % len(self._publishSlots)
+        await self._open(slot)
+        return slot
+
+    async def getDeclareChannel(self):
+        await self._open(self._declareSlot)
+        return self._declareSlot.channel
+
+    async def getExchange(self, slot, exchange, exchangeType):
+        # the '' exchange, as well as an exchange declared without a type, is
+        # the broker's default exchange
+        if not exchange or exchangeType is None:
+            return slot.channel.default_exchange
+        currentExchange = slot.exchanges.get(exchange)
+        if currentExchange is None:
+            currentExchange = await slot.channel.get_exchange(exchange, ensure=False)
+            slot.exchanges[exchange] = currentExchange
+        return currentExchange
+
+    async def consume(self, queue, on_message, noAck=False, prefetchCount=None):
+        slot = self._consumeSlots.get(queue)
+        if slot is None:
+            slot = self._consumeSlots[queue] = ChannelSlot()
+        slot.prefetchCount = slot.qos = prefetchCount
+        slot.consumer = (queue, on_message, noAck)
+        wasOpen = slot.isOpen
+        await self._open(slot)
+        if wasOpen:
+            await self._applyQos(slot)
+        await self._startConsumer(slot)
+
+    async def setQos(self, prefetchCount):
+        # prefetchCount is the total of the worker, every consume channel
+        # gets the part matching the prefetch its queue was consumed with
+        slots = list(self._consumeSlots.values())
+        consumed = sum(slot.prefetchCount or 0 for slot in slots)
+        for slot in slots:
+            slot.qos = prefetchCount
+            if consumed and slot.prefetchCount:
+                slot.qos = max(1, int(round(prefetchCount * slot.prefetchCount / consumed)))
+            if slot.isOpen:
+                await self._applyQos(slot)
+
+    async def close(self):
+        slots = self._publishSlots + [self._declareSlot] + list(self._consumeSlots.values())
+        for slot in slots:
+            if slot.isOpen:
+                try:
+                    await slot.channel.close()
+                except Exception as exc:
+                    log.error("ChannelManager channel.close raised exception: %s", exc)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _open(self, slot):
+        if slot.isOpen:
+            return slot.channel
+        async with slot.lock:
+            if slot.isOpen:
+                return slot.channel
+            if slot.channel is not None:
+                # stop a channel still restoring itself from coming back
+                # next to the one replacing it
+                await self._closeChannel(slot.channel)
+            connection = await self._getConnection()
+            try:
+                slot.channel = await connection.channel(
+                    publisher_confirms=slot.publisherConfirms
+                )
+            except Exception as exc:
+                log.error("AioPikaClient's self._connection.channel()\
+                    raised exception: {}".format(exc))
+                raise exc
+            slot.exchanges = {}
+            await self._applyQos(slot)
+            log.info("AioPikaClient channel established")
+        return slot.channel
+
+    async def _applyQos(self, slot):
+        # a consume channel has a single consumer, so the prefetch is set for
+        # the whole channel, unlike a per consumer prefetch rabbitmq applies
+        # a change of it to the running consumer right away
+        if slot.qos is not None:
+            await slot.channel.set_qos(prefetch_count=slot.qos, global_=True)
+
+    async def _startConsumer(self, slot):
+        queue, on_message, noAck = slot.consumer
+        # declared passively so that the channel knows the queue, and
+        # restores the consumer when it restores itself
+        currentQueue = await slot.channel.declare_queue(queue, passive=True)
+        await currentQueue.consume(on_message, no_ack=noAck)
+
+    async def _closeChannel(self, channel):
+        try:
+            await channel.close()
+        except Exception as exc:
+            log.debug("ChannelManager channel.close raised exception: %s", exc)
+
+
 class AioPikaClient(RabbitMQClient):
     
     def __init__(self, username='guest', password='guest',
-            host='localhost', port=5672, virtualhoat='/', loop=None):
+            host='localhost', port=5672, virtualhoat='/', loop=None,
+            publisherConfirms=False, confirmWindow=1000, codec='json',
+            publishChannels=4):
         self._username = username
         self._password = password
         self._host = host
@@ -32,7 +177,11 @@ class AioPikaClient(RabbitMQClient):
         self._virtualhoat = virtualhoat
         self._loop = loop
         self._connection = None
-        self._channel = None
+        self._connecting = asyncio.Lock()
+        self._channels = ChannelManager(
+            self._getConnection, publishChannels, publisherConfirms
+        )
+        # exchanges and queues are declared once and then cached by name
         self._exchanges = {}
         self._exchange_types = {
             'direct': aio_pika.ExchangeType.DIRECT,
@@ -40,22 +189,29 @@ class AioPikaClient(RabbitMQClient):
             'fanout': aio_pika.ExchangeType.FANOUT
         }
         self._queues = {}
-        self._setupDone = False
+        # with publisher confirms every publish resolves only once the broker
+        # acked it, the window caps how many of them can be unconfirmed
+        self._publisherConfirms = publisherConfirms
+        self._confirmWindow = asyncio.Semaphore(confirmWindow)
+        # default wire codec, a publish can pick another one via options
+        self._codec = getCodec(codec)
         self._url = 'amqp://{}:{}@{}:{}{}'.format(
             self._username, self._password, self._host,
             self._port, self._virtualhoat)
 
     async def publish(self, msgToPublish, exchange='default_exchange',
             routing_key='', options=None):
-
-        if not self._setupDone:
-            await self._setUpClient(exchange, options)
+        options = options or {}
+        if exchange not in self._exchanges:
+            await self._getExchange(exchange, options)
         # Sending the message
         currentExchange = None
         try:
             message = self._formatMessage(msgToPublish, options)
-            exchangegroup = self._exchanges[exchange]
-            currentExchange = exchangegroup['exchange']
+            slot = await self._channels.getPublishChannel()
+            currentExchange = await self._channels.getExchange(
+                slot, exchange, self._exchanges[exchange]['type']
+            )
             
             await currentExchange.publish(
                 message, routing_key=routing_key
@@ -67,27 +223,83 @@ class AioPikaClient(RabbitMQClient):
                 )
             )
             raise exc
+
+    async def publish_many(self, msgsToPublish, exchange='default_exchange',
+            routing_key='', options=None):
+        options = options or {}
+        if exchange not in self._exchanges:
+            await self._getExchange(exchange, options)
+        # pipeline the publishes, only waiting when the window of unconfirmed
+        # messages is full, instead of awaiting each confirm one after another
+        pending = []
+        for msgToPublish in msgsToPublish:
+            await self._confirmWindow.acquire()
+            pending.append(asyncio.ensure_future(
+                self._publishConfirmed(msgToPublish, exchange, routing_key, options)
+            ))
+        # per message results, an exception instance marks a failed publish
+        return await asyncio.gather(*pending, return_exceptions=True)
     
     async def consume(self, queue, exchange, on_message, options=None):
-        if not self._setupDone:
-            await self._setUpClient(exchange, options)
-
-        if 'set_qos' in options:
-            await self._channel.set_qos(prefetch_count=options['set_qos'])
+        options = options or {}
+        if exchange not in self._exchanges:
+            await self._getExchange(exchange, options)
 
         if queue not in self._queues:
             await self._createAndBindQueue(queue, exchange, options)
 
+        # every queue is consumed on its own channel with its own prefetch
         noAck = options.get('noAck', False)
-        log.info("[X] Cosuming ... Waiting to get messages ...")
-        await self._queues[queue]['queue'].consume(on_message, no_ack=noAck)
+        log.info("[X] Cosuming %s ... Waiting to get messages ...", queue)
+        await self._channels.consume(
+            queue, on_message, noAck, options.get('set_qos', None)
+        )
+
+    async def publish_raw(self, body, exchange='', routing_key='', options=None):
+        # publish already encoded bytes as they are, the '' exchange is the
+        # broker's default exchange which routes by queue name
+        options = options or {}
+        exchangeType = None
+        if exchange != '':
+            if exchange not in self._exchanges:
+                await self._getExchange(exchange, options)
+            exchangeType = self._exchanges[exchange]['type']
+        currentExchange = None
+        try:
+            message = self._buildMessage(body, options)
+            slot = await self._channels.getPublishChannel()
+            currentExchange = await self._channels.getExchange(
+                slot, exchange, exchangeType
+            )
+            await currentExchange.publish(message, routing_key=routing_key)
+        except Exception as exc:
+            log.error("AioPikaClient's %s.publish_raw raised exception for: \
+                { routing_key: %s, exc: %s }", currentExchange, routing_key, exc)
+            raise exc
+
+    async def declare_queue(self, queue, options=None):
+        # declare a queue without binding it to any exchange
+        options = options or {}
+        if queue not in self._queues:
+            currentQueue = await self._createQueue(queue, options)
+            self._queues[queue] = {
+                'queue': currentQueue,
+                'bindingKeys': None
+            }
+        return self._queues[queue]['queue']
+
+    async def set_qos(self, prefetchCount):
+        # change the total prefetch of the consume channels, used for
+        # backpressure and the adaptive prefetch
+        await self._channels.setQos(prefetchCount)
 
     async def setup(self):
-        if not self._channel:
-            await self._getChannel()
+        await self._getConnection()
+        await self._channels.getDeclareChannel()
         return self._connection
    
     async def close(self):
+        await self._channels.close()
         await self._connection.close()
         log.info("AioPikaClient connection closed")
 
@@ -99,63 +311,48 @@ class AioPikaClient(RabbitMQClient):
     #           Private Methods             #
     #---------------------------------------#
 
-    async def _setUpClient(self, exchange, options):
-        if not self._channel:
-            await self._getChannel()
-        
-        if exchange not in self._exchanges:
-            await self._getExchange(exchange, options)
-        
-        self._setupDone = True
+    async def _publishConfirmed(self, msgToPublish, exchange, routing_key, options):
+        try:
+            await self.publish(msgToPublish, exchange, routing_key, options)
+        finally:
+            self._confirmWindow.release()
    
     async def _getConnection(self):
-        try:
-            self._connection = await aio_pika.connect_robust(self._url)
-        except Exception as exc:
-            log.error("AioPikaClient's aio_pika.connect_robust raised\
-                exception for: {{ self._url: {}, exc: {} }}".format(self._url, exc))
-            raise exc
-        
-        log.info("AioPikaClient connection established")
-        return self._connection
-
-    async def _getChannel(self):
-        if not self._connection:
-            await self._getConnection()
-        if not self._channel:
+        if self._connection:
+            return self._connection
+        async with self._connecting:
+            if self._connection:
+                return self._connection
             try:
-                self._channel = await self._connection.channel()
+                self._connection = await aio_pika.connect_robust(self._url)
             except Exception as exc:
-                log.error("AioPikaClient's self._connection.channel()\
-                    raised exception: {}".format(exc))
+                log.error("AioPikaClient's aio_pika.connect_robust raised\
+                    exception for: {{ self._url: {}, exc: {} }}".format(self._url, exc))
                 raise exc
-                
-            log.info("AioPikaClient channel established")
-        return self._channel
+        
+        log.info("AioPikaClient connection established")
+        return self._connection
 
     async def _getExchange(self, exchange, options):
-        # create a new exhange and bind to routing_key
+        # declare the exchange once, publish channels only fetch handles to it
         exchangeType = None
         if 'exchangeType' in options:
             exchangeType = self._exchange_types[options['exchangeType']]
         
-        currentExchange = self._channel.default_exchange
         if exchangeType:
+            channel = await self._channels.getDeclareChannel()
             try:
-                currentExchange = await self._channel.declare_exchange(
-                    exchange, exchangeType
-                )
+                await channel.declare_exchange(exchange, exchangeType)
             except Exception as exc:
-                log.error("AioPikaClient's self._channel.declare_exchange \
+                log.error("AioPikaClient's channel.declare_exchange \
                     raised exception for: {{ exchange: {}, exhangeType: {},\
                     exc: {} }}".format(exchange, exchangeType, exc))
                 raise exc
         
         self._exchanges[exchange] = {
-            'exchange': currentExchange,
             'type': exchangeType
         }
-        return currentExchange
+        return exchangeType
    
     async def _createAndBindQueue(self, queue, exchange, options):
         currentQueue = await self._createQueue(queue, options)
@@ -169,13 +366,18 @@ class AioPikaClient(RabbitMQClient):
         return currentQueue
 
     async def _createQueue(self, queue, options):
+        channel = await self._channels.getDeclareChannel()
         durable = options.get('queueDurable', False)
+        arguments = options.get('queueArguments', None)
+        if options.get('maxPriority'):
+            # priorities only work on queues declared with x-max-priority
+            arguments = dict(arguments or {}, **{'x-max-priority': options['maxPriority']})
         try:
-            currentQueue = await self._channel.declare_queue(
-                queue, durable=durable
+            currentQueue = await channel.declare_queue(
+                queue, durable=durable, arguments=arguments
             )
         except Exception as exc:
-            log.error("AioPikaClient's self._channel.declare_queue \
+            log.error("AioPikaClient's channel.declare_queue \
                 raised exception for: {{ queue: {}, durable: {}, \
                 exc: {} }}".format(queue, durable, exc))
             raise exc
@@ -194,15 +396,12 @@ class AioPikaClient(RabbitMQClient):
                 bindingKeys = [bindingKeys]
             for binding_key in bindingKeys:
                 try:
-                    await queue.bind(
-                        self._exchanges[exchange]['exchange'], routing_key=binding_key
-                    )
+                    await queue.bind(exchange, routing_key=binding_key)
                 except Exception as exc:
                     log.error("AioPikaClient's queue.bind raised exception for: \
                         {{ queue: {}, exchange: {}, routine_key: {}, \
                         exc: {} }}".format(
-                            queue, self._exchanges[exchange]['exchange'],
-                            binding_key, exc
+                            queue, exchange, binding_key, exc
                         )
                     )
                     raise exc
@@ -213,26 +412,120 @@ class AioPikaClient(RabbitMQClient):
         data = {
             'message': msgToPublish
         }
+        codec = self._codec
+        if 'codec' in options:
+            codec = getCodec(options['codec'])
         message = data
         try:
-            message = json.dumps(data).encode()
+            message = codec.encode(data)
         except Exception as exc:
-            log.error("AioPikaClient's json.dumps raised exception for: \
-                {{ data: {}, exc: {} }}".format(data, exc))
+            log.error("AioPikaClient's {}.encode raised exception for: \
+                {{ data: {}, exc: {} }}".format(codec, data, exc))
+
+        return self._buildMessage(message, dict(options, contentType=codec.contentType))
 
+    def _buildMessage(self, body, options):
         delivery = options.get('deliverMode', None)
         deliveryMode = aio_pika.DeliveryMode.NOT_PERSISTENT
         if delivery == 'persistent':
            deliveryMode = aio_pika.DeliveryMode.PERSISTENT
+        headers = options.get('headers', None)
+        contentType = options.get('contentType', None)
+        priority = options.get('priority', None)
+        # publish time, lets consumers measure how long messages were queued
+        timestamp = options.get('timestamp', None)
         try:
             formattedMessage = aio_pika.Message(
-                message, delivery_mode=deliveryMode
+                body, delivery_mode=deliveryMode, headers=headers,
+                content_type=contentType, priority=priority, timestamp=timestamp
             )
             return formattedMessage
         except Exception as exc:
             log.error("AioPikaClient's aio_pika.Message raised exception \
                 for: {{ message: {}, delivery_mode: {}, exc: {} }}".format(
-                    message, deliveryMode, exc
+                    body, deliveryMode, exc
                 )
             )
             raise exc
+
+
+# Buffers messages published to one exchange and flushes them through
+# AioPikaClient.publish_many once maxBatchSize messages are buffered or
+# flushInterval seconds passed since the first buffered message. Every
+# publish returns a future resolved with the confirm of its own message.
+class BatchPublisher(object):
+
+    def __init__(self, client, exchange, options=None, maxBatchSize=100,
+            flushInterval=0.05, loop=None):
+        self._client = client
+        self._exchange = exchange
+        self._options = options or {}
+        self._maxBatchSize = maxBatchSize
+        self._flushInterval = flushInterval
+        self._loop = loop or asyncio.get_event_loop()
+        self._buffer = []
+        self._flushHandle = None
+        self._flushing = set()
+
+    def publish(self, msgToPublish, routing_key=''):
+        future = self._loop.create_future()
+        self._buffer.append((msgToPublish, routing_key, future))
+        if len(self._buffer) >= self._maxBatchSize:
+            self._scheduleFlush()
+        elif self._flushHandle is None:
+            self._flushHandle = self._loop.call_later(
+                self._flushInterval, self._scheduleFlush
+            )
+        return future
+
+    async def flush(self):
+        await self._publishBatch(self._takeBatch())
+
+    async def close(self):
+        await self.flush()
+        if self._flushing:
+            await asyncio.wait(self._flushing)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _takeBatch(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        batch, self._buffer = self._buffer, []
+        return batch
+
+    def _scheduleFlush(self):
+        # take the batch right away so that publishes arriving before the
+        # flush task runs start a new batch instead of growing this one
+        task = asyncio.ensure_future(
+            self._publishBatch(self._takeBatch()), loop=self._loop
+        )
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _publishBatch(self, batch):
+        if not batch:
+            return
+        # one publish_many call per routing key, keeping publish order
+        groups = {}
+        for msgToPublish, routing_key, future in batch:
+            groups.setdefault(routing_key, []).append((msgToPublish, future))
+
+        for routing_key, items in groups.items():
+            try:
+                results = await self._client.publish_many(
+                    [msgToPublish for msgToPublish, _ in items],
+                    self._exchange, routing_key, self._options
+                )
+            except Exception as exc:
+                results = [exc] * len(items)
+            for (_, future), result in zip(items, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
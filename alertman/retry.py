@@ -0,0 +1,141 @@
+from alertman.usecases.circuit_breaker import CircuitOpenError
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+ATTEMPTS_HEADER = 'x-alertman-attempts'
+ALERT_TYPES_HEADER = 'x-alertman-alert-types'
+LAST_ERROR_HEADER = 'x-alertman-last-error'
+DEFERRALS_HEADER = 'x-alertman-deferrals'
+
+
+def getBackoffDelays(baseDelay, factor, tiers, maxDelay):
+    # exponential backoff tiers in milliseconds, eg: 1000, 5000, 25000 ...
+    delays = []
+    for tier in range(tiers):
+        delays.append(int(min(baseDelay * (factor ** tier), maxDelay)))
+    return delays
+
+
+def getAttempts(message):
+    headers = message.headers or {}
+    return int(headers.get(ATTEMPTS_HEADER, 0))
+
+
+def getDeferrals(message):
+    headers = message.headers or {}
+    return int(headers.get(DEFERRALS_HEADER, 0))
+
+
+def getRetryAlertTypes(message):
+    # a retried message only carries the alert types which failed before
+    headers = message.headers or {}
+    alertTypes = headers.get(ALERT_TYPES_HEADER, None)
+    if alertTypes is None:
+        return None
+    return [
+        alertType.decode('utf-8') if isinstance(alertType, bytes) else alertType
+        for alertType in alertTypes
+    ]
+
+
+# Retries failed deliveries later without blocking the consumer. Every backoff
+# tier is a queue with a message ttl whose dead letters go back to the
+# consumed queue through the default exchange, so a failed message just sits
+# in its tier queue until it expires. Messages out of attempts, or deferred
+# by open circuits more than maxDeferrals times, are parked.
+class RetryPolicy(object):
+    def __init__(self, client, queue, delays=(1000, 5000, 25000), maxAttempts=5,
+            maxDeferrals=50):
+        self._client = client
+        self._queue = queue
+        self._delays = list(delays)
+        self._maxAttempts = maxAttempts
+        self._maxDeferrals = maxDeferrals
+        self._parkingQueue = '{}.parking'.format(queue)
+        self._setupDone = False
+
+    async def setup(self):
+        for delay in self._delays:
+            await self._client.declare_queue(self._getDelayQueue(delay), {
+                'queueDurable': True,
+                'queueArguments': {
+                    'x-message-ttl': delay,
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': self._queue
+                }
+            })
+        await self._client.declare_queue(self._parkingQueue, {
+            'queueDurable': True
+        })
+        self._setupDone = True
+
+    async def retry(self, message, failedAlertTypes, reason=''):
+        if not self._setupDone:
+            await self.setup()
+        # an alert rejected by an open circuit never reached its backend, so
+        # it uses up a deferral instead of an attempt. Either way it waits at
+        # least as long as the circuit or the backend asked for.
+        retryAfter = getattr(reason, 'retryAfter', None)
+        deferred = isinstance(reason, CircuitOpenError)
+        attempts = getAttempts(message) + (0 if deferred else 1)
+        deferrals = getDeferrals(message) + (1 if deferred else 0)
+        options = self._getPublishOptions(message, attempts, failedAlertTypes, reason)
+        options['headers'][DEFERRALS_HEADER] = deferrals
+        if attempts >= self._maxAttempts or \
+                self._maxDeferrals and deferrals >= self._maxDeferrals:
+            log.error("Alert exhausted %d attempts and %d deferrals, parking it in: %s",
+                attempts, deferrals, self._parkingQueue)
+            await self._client.publish_raw(
+                message.body, '', self._parkingQueue, options
+            )
+            return False
+
+        delay = self._delays[max(min(attempts, len(self._delays)), 1) - 1]
+        if retryAfter is not None:
+            delay = self._getDelayAtLeast(retryAfter * 1000, delay)
+        log.info("Retrying alert: { attempt: %d, alertTypes: %s, delay: %dms }",
+            attempts, failedAlertTypes, delay)
+        await self._client.publish_raw(
+            message.body, '', self._getDelayQueue(delay), options
+        )
+        return True
+
+    async def park(self, message, reason=''):
+        # for messages which can never succeed, eg: undecodable ones
+        if not self._setupDone:
+            await self.setup()
+        log.error("Parking alert in: %s, reason: %s", self._parkingQueue, reason)
+        options = self._getPublishOptions(message, getAttempts(message), [], reason)
+        options['headers'][DEFERRALS_HEADER] = getDeferrals(message)
+        await self._client.publish_raw(
+            message.body, '', self._parkingQueue, options
+        )
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _getPublishOptions(self, message, attempts, alertTypes, reason):
+        # the body is republished as is, so it keeps its original codec
+        return {
+            'deliverMode': 'persistent',
+            'contentType': message.content_type,
+            'headers': {
+                ATTEMPTS_HEADER: attempts,
+                ALERT_TYPES_HEADER: list(alertTypes),
+                LAST_ERROR_HEADER: str(reason)[:256]
+            }
+        }
+
+    def _getDelayAtLeast(self, minDelay, delay):
+        # only the declared tiers exist, so the smallest long enough one
+        for tierDelay in self._delays:
+            if tierDelay >= max(minDelay, delay):
+                return tierDelay
+        return self._delays[-1]
+
+    def _getDelayQueue(self, delay):
+        return '{}.retry.{}ms'.format(self._queue, delay)
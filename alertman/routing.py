@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+
+from alertman.log import getCustomLogger
+from alertman.templates import compileTemplate
+
+
+log = getCustomLogger(__name__)
+
+
+MATCH_FIELDS = ('routingKey', 'alertType', 'source', 'severity')
+
+
+# Where and how one alert type of a message is delivered. channel picks the
+# alert processor, eg: email or sms, every receiver gets its own alert. The
+# body template is compiled with the route, so once per rules (re)load.
+class Route(object):
+    def __init__(self, channel, receivers, sender='', subject='', template=None):
+        self.channel = channel
+        self.receivers = list(receivers)
+        self.sender = sender
+        self.subject = subject
+        self.template = compileTemplate(template)
+
+    def getBody(self, alert):
+        if self.template is None:
+            return alert['message']
+        return self.template.render(alert)
+
+    def __repr__(self):
+        return '{{ Route: {{ channel: {0}, receivers: {1} }} }}'.format(
+            self.channel, self.receivers)
+
+
+# Rules compiled into a single dict keyed by the matched field values, a
+# field a rule doesn't match on is None in its key. A lookup only probes the
+# combinations of matched fields some rule actually uses, most specific
+# first, so routing costs at most 16 dict lookups however many rules there
+# are. Among rules with the same match the first one wins.
+class RoutingTable(object):
+    def __init__(self, rules=()):
+        self._routes = {}
+        masks = set()
+        for rule in rules:
+            match = rule.get('match', {})
+            unknown = set(match) - set(MATCH_FIELDS)
+            if unknown:
+                raise Exception("Routing rule matches on unknown fields: {}".format(
+                    sorted(unknown)))
+            key = tuple(match.get(field) for field in MATCH_FIELDS)
+            if key in self._routes:
+                log.warning("Routing rule for %s shadowed by an earlier rule", match)
+                continue
+            self._routes[key] = getRoute(rule)
+            masks.add(tuple(value is not None for value in key))
+        # more matched fields first, ties broken by the order of MATCH_FIELDS
+        self._masks = sorted(masks, key=lambda mask: (-sum(mask), [not used for used in mask]))
+
+    def route(self, routingKey=None, alertType=None, source=None, severity=None):
+        values = (routingKey, alertType, source, severity)
+        for mask in self._masks:
+            key = tuple(value if used else None for value, used in zip(values, mask))
+            route = self._routes.get(key)
+            if route is not None:
+                return route
+        return None
+
+    def __len__(self):
+        return len(self._routes)
+
+
+def getRoute(rule):
+    receivers = rule.get('receivers', rule.get('receiver', []))
+    if isinstance(receivers, str):
+        receivers = [receivers]
+    channel = rule.get('channel') or rule.get('match', {}).get('alertType')
+    if not channel:
+        raise Exception("Routing rule needs a channel: {}".format(rule))
+    return Route(
+        channel, receivers, rule.get('sender', ''), rule.get('subject', ''),
+        rule.get('template', None)
+    )
+
+
+def loadRoutingRules(path):
+    # a json file, either a list of rules or an object with a 'rules' list
+    with open(path, 'r') as rulesFile:
+        rules = json.load(rulesFile)
+    if isinstance(rules, dict):
+        rules = rules.get('rules', [])
+    return rules
+
+
+# Routes alert types of messages with the rules of a file compiled on top of
+# the default rules, the rules of the file win over defaults with the same
+# match. The file is watched and recompiled when it changes, a file that
+# fails to load keeps the previous table in place.
+class AlertRouter(object):
+    def __init__(self, defaultRules=(), path=None, reloadInterval=5.0):
+        self._defaultRules = list(defaultRules)
+        self._path = path
+        self._reloadInterval = reloadInterval
+        self._mtime = None
+        self._table = RoutingTable(self._defaultRules)
+        if path:
+            self.reload()
+
+    def route(self, routingKey=None, alertType=None, source=None, severity=None):
+        return self._table.route(routingKey, alertType, source, severity)
+
+    def reload(self):
+        try:
+            mtime = os.stat(self._path).st_mtime
+            rules = loadRoutingRules(self._path)
+            table = RoutingTable(rules + self._defaultRules)
+        except Exception as exc:
+            log.error("AlertRouter could not load rules from %s: %s", self._path, exc)
+            return False
+        # swapping the reference is atomic for the routing coroutines
+        self._table = table
+        self._mtime = mtime
+        log.info("AlertRouter loaded %d routes from %s", len(table), self._path)
+        return True
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(self._reloadInterval)
+            try:
+                mtime = os.stat(self._path).st_mtime
+            except OSError as exc:
+                log.error("AlertRouter could not stat %s: %s", self._path, exc)
+                continue
+            if mtime != self._mtime:
+                self.reload()
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+# Forks numProcesses worker processes, each running target(config, workerIndex,
+# statsQueue) with its own event loop and broker connection. Crashed children
+# are restarted, SIGTERM / SIGINT are forwarded to every child and the stats
+# the children push on statsQueue are reported as per child throughput.
+class WorkerSupervisor(object):
+    def __init__(self, target, numProcesses, config, restartDelay=1.0,
+            reportInterval=30.0, shutdownTimeout=10.0):
+        self._target = target
+        self._numProcesses = numProcesses
+        self._config = config
+        self._restartDelay = restartDelay
+        self._reportInterval = reportInterval
+        self._shutdownTimeout = shutdownTimeout
+        self._context = multiprocessing.get_context('fork')
+        self._statsQueue = self._context.Queue()
+        self._children = {}
+        self._restartAt = {}
+        self._stats = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._onSignal)
+        signal.signal(signal.SIGINT, self._onSignal)
+        for workerIndex in range(self._numProcesses):
+            self._startChild(workerIndex)
+
+        lastReport = time.monotonic()
+        while not self._stopping:
+            self._collectStats(timeout=0.5)
+            self._superviseChildren()
+            now = time.monotonic()
+            if now - lastReport >= self._reportInterval:
+                self._report(now - lastReport)
+                lastReport = now
+
+        self._shutdown()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _onSignal(self, signum, frame):
+        log.info("WorkerSupervisor received signal: %s, stopping children", signum)
+        self._stopping = True
+
+    def _startChild(self, workerIndex):
+        process = self._context.Process(
+            target=self._runChild, args=(workerIndex,),
+            name='alertman-worker-{}'.format(workerIndex)
+        )
+        process.start()
+        self._children[workerIndex] = process
+        log.info("WorkerSupervisor started worker: { index: %d, pid: %d }",
+            workerIndex, process.pid)
+
+    def _runChild(self, workerIndex):
+        # children get default signal handling back, the target installs
+        # its own SIGTERM handler on the event loop it creates
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._target(self._config, workerIndex, self._statsQueue)
+
+    def _superviseChildren(self):
+        now = time.monotonic()
+        for workerIndex, process in list(self._children.items()):
+            if process.is_alive():
+                continue
+            if workerIndex not in self._restartAt:
+                log.error("WorkerSupervisor worker died: { index: %d, pid: %d, exitcode: %s }",
+                    workerIndex, process.pid, process.exitcode)
+                process.join()
+                self._stats.pop(workerIndex, None)
+                self._restartAt[workerIndex] = now + self._restartDelay
+            elif now >= self._restartAt[workerIndex]:
+                del self._restartAt[workerIndex]
+                self._startChild(workerIndex)
+
+    def _collectStats(self, timeout):
+        try:
+            workerIndex, pid, stats = self._statsQueue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        previous = self._stats.get(workerIndex)
+        # counters restart with a restarted child, so only diff the same pid
+        if previous and previous['pid'] == pid:
+            lastReported = previous['lastReported']
+        else:
+            lastReported = 0
+        self._stats[workerIndex] = {
+            'pid': pid,
+            'stats': stats,
+            'lastReported': lastReported
+        }
+
+    def _report(self, elapsed):
+        total = 0.0
+        for workerIndex in sorted(self._stats):
+            entry = self._stats[workerIndex]
+            processed = entry['stats']['processed']
+            rate = (processed - entry['lastReported']) / elapsed
+            entry['lastReported'] = processed
+            total += rate
+            log.info("worker %d (pid %s): %.2f alerts/sec, stats: %s",
+                workerIndex, entry['pid'], rate, entry['stats'])
+        log.info("WorkerSupervisor total throughput: %.2f alerts/sec", total)
+
+    def _shutdown(self):
+        for process in self._children.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + self._shutdownTimeout
+        for process in self._children.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.error("WorkerSupervisor killing unresponsive worker: %d", process.pid)
+                process.kill()
+                process.join()
+        log.info("WorkerSupervisor stopped")
@@ -0,0 +1,55 @@
+import string
+
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+formatter = string.Formatter()
+
+
+# A body template compiled once when its routing rules are loaded, the format
+# string is split into its literal text and fields up front, so rendering an
+# alert only looks up and formats the fields. Fields use str.format syntax
+# against the alert, eg: "[{severity}] {source}: {message}".
+class AlertTemplate(object):
+    def __init__(self, source):
+        self.source = source
+        self._parts = []
+        for literal, fieldName, formatSpec, conversion in formatter.parse(source):
+            if literal:
+                self._parts.append((literal, None, None, None))
+            if fieldName is not None:
+                if fieldName == '' or fieldName.isdigit():
+                    raise Exception("Template: {!r} has a positional field, fields "
+                        "have to be named".format(source))
+                self._parts.append((None, fieldName, formatSpec, conversion))
+
+    def render(self, alert):
+        rendered = []
+        for literal, fieldName, formatSpec, conversion in self._parts:
+            if fieldName is None:
+                rendered.append(literal)
+                continue
+            try:
+                value = formatter.get_field(fieldName, (), alert)[0]
+            except (KeyError, AttributeError, IndexError, TypeError) as exc:
+                raise Exception("Template field: {} missing in alert: {}".format(
+                    fieldName, exc))
+            if conversion:
+                value = formatter.convert_field(value, conversion)
+            if formatSpec and '{' in formatSpec:
+                # nested fields in the format spec, eg: {message:{width}}
+                formatSpec = AlertTemplate(formatSpec).render(alert)
+            rendered.append(format(value, formatSpec or ''))
+        return ''.join(rendered)
+
+    def __repr__(self):
+        return '{{ AlertTemplate: {0!r} }}'.format(self.source)
+
+
+def compileTemplate(template):
+    if template is None or isinstance(template, AlertTemplate):
+        return template
+    return AlertTemplate(template)
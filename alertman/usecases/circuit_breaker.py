@@ -0,0 +1,157 @@
+import asyncio
+import time
+
+from aiosmtplib import SMTPAuthenticationError, SMTPHeloError, SMTPResponseException
+
+from alertman.usecases.process_alert import AlertSender
+from alertman.usecases.http_pool import HTTPConnectionClosed
+from alertman.usecases.send_sms import SMSGatewayError
+from alertman.log import getCustomLogger
+from alertman.metrics import CIRCUIT_STATE
+
+
+log = getCustomLogger(__name__)
+
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+# Raised instead of calling a backend whose circuit is open. retryAfter is
+# the number of seconds until the circuit lets a probe through again, retry
+# and outbox use it to wait that long and count a deferral, not an attempt.
+class CircuitOpenError(Exception):
+    def __init__(self, name, retryAfter):
+        super().__init__("Circuit: {} is open, retry after {:.1f}s".format(name, retryAfter))
+        self.retryAfter = retryAfter
+
+
+# Opens after failureThreshold consecutive failures and rejects calls right
+# away for resetTimeout seconds. Then it's half open and lets through at most
+# halfOpenMaxProbes calls at a time, successThreshold successful probes close
+# it again while a failed probe opens it for another resetTimeout.
+class CircuitBreaker(object):
+    def __init__(self, name, failureThreshold=5, resetTimeout=30.0,
+            halfOpenMaxProbes=1, successThreshold=1):
+        self.name = name
+        self._failureThreshold = failureThreshold
+        self._resetTimeout = resetTimeout
+        self._halfOpenMaxProbes = halfOpenMaxProbes
+        self._successThreshold = successThreshold
+        self._state = CLOSED
+        self._failures = 0
+        self._successes = 0
+        self._probes = 0
+        self._openedAt = 0.0
+        self._stateGauge = CIRCUIT_STATE.labels(name)
+        self._stateGauge.set(STATE_VALUES[CLOSED])
+
+    # returns whether the call is a half open probe, raises when rejected
+    def before(self):
+        if self._state == OPEN:
+            retryAfter = self._openedAt + self._resetTimeout - time.monotonic()
+            if retryAfter > 0:
+                raise CircuitOpenError(self.name, retryAfter)
+            self._setState(HALF_OPEN)
+        if self._state == HALF_OPEN:
+            if self._probes >= self._halfOpenMaxProbes:
+                raise CircuitOpenError(self.name, self._resetTimeout)
+            self._probes += 1
+            return True
+        return False
+
+    def onSuccess(self, probe):
+        if probe:
+            self._probes -= 1
+            if self._state == HALF_OPEN:
+                self._successes += 1
+                if self._successes >= self._successThreshold:
+                    self._setState(CLOSED)
+            return
+        self._failures = 0
+
+    def onFailure(self, probe):
+        if probe:
+            self._probes -= 1
+            if self._state == HALF_OPEN:
+                self._setState(OPEN)
+            return
+        self._failures += 1
+        if self._state == CLOSED and self._failures >= self._failureThreshold:
+            self._setState(OPEN)
+
+    # a call that ended without telling anything about the backend, eg:
+    # cancelled, or a recipient the backend refused
+    def onCancel(self, probe):
+        if probe:
+            self._probes -= 1
+
+    @property
+    def state(self):
+        return self._state
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _setState(self, state):
+        if state == OPEN:
+            self._openedAt = time.monotonic()
+        self._failures = 0
+        self._successes = 0
+        if state != self._state:
+            log.warning("Circuit: %s %s -> %s", self.name, self._state, state)
+        self._state = state
+        self._stateGauge.set(STATE_VALUES[state])
+
+
+class CircuitBreakerSender(AlertSender):
+    def __init__(self, alertSender, breaker):
+        self._alertSender = alertSender
+        self._breaker = breaker
+
+    async def send(self, alert):
+        probe = self._breaker.before()
+        settled = False
+        try:
+            await self._alertSender.send(alert)
+            settled = True
+            self._breaker.onSuccess(probe)
+        except Exception as exc:
+            settled = True
+            if isBackendFailure(exc):
+                self._breaker.onFailure(probe)
+            else:
+                self._breaker.onCancel(probe)
+            raise exc
+        finally:
+            if not settled:
+                self._breaker.onCancel(probe)
+
+    def getRenderer(self):
+        return self._alertSender.getRenderer()
+
+    async def close(self):
+        if hasattr(self._alertSender, 'close'):
+            await self._alertSender.close()
+
+
+# Only transport errors, timeouts and a backend that is failing or throttling
+# count towards opening a circuit. A refused recipient, a message the sms
+# gateway rejected, or an alert that failed before reaching the backend says
+# nothing about the health of the backend.
+def isBackendFailure(exc):
+    if isinstance(exc, (OSError, asyncio.TimeoutError, HTTPConnectionClosed)):
+        return True
+    if isinstance(exc, SMSGatewayError):
+        return exc.status == 429 or (isinstance(exc.status, int) and exc.status >= 500)
+    if isinstance(exc, (SMTPAuthenticationError, SMTPHeloError)):
+        return True
+    if isinstance(exc, SMTPResponseException):
+        # 421 is the server shutting the session down, the other replies
+        # refuse the sender, a recipient or the message
+        return exc.code == 421
+    return False
@@ -0,0 +1,105 @@
+import asyncio
+
+from alertman.domain.email import EmailMessage
+from alertman.usecases.process_alert import AlertSender
+from alertman.usecases.send_email import getEmailBodyText
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+class EmailDigest(object):
+    def __init__(self, sender, receiver, subject):
+        self.sender = sender
+        self.receiver = receiver
+        self.subject = subject
+        self.emails = []
+        self.futures = []
+        self.flushHandle = None
+
+    def add(self, email, future):
+        self.emails.append(email)
+        self.futures.append(future)
+
+    def __len__(self):
+        return len(self.emails)
+
+    def toEmailMessage(self):
+        if len(self.emails) == 1:
+            return self.emails[0]
+        subject = '{} ({} alerts)'.format(self.subject, len(self.emails))
+        parts = []
+        for index, email in enumerate(self.emails, 1):
+            parts.append('Alert {} of {}:\n{}'.format(
+                index, len(self.emails), getEmailBodyText(email.body)))
+        return EmailMessage(
+            self.sender, self.receiver, subject, '\n\n'.join(parts)
+        )
+
+
+# Sits in front of an EmailSender and coalesces emails going to the same
+# (receiver, subject) for up to window seconds or maxAlerts emails into one
+# digest email. Every send only returns once the digest containing its email
+# was sent, so the caller acks the source delivery after the real send.
+class DigestEmailSender(AlertSender):
+    def __init__(self, emailSender, loop, window=5.0, maxAlerts=50):
+        self._emailSender = emailSender
+        self._loop = loop
+        self._window = window
+        self._maxAlerts = maxAlerts
+        self._digests = {}
+        self._sending = set()
+
+    async def send(self, email):
+        key = (email.receiver, email.subject)
+        digest = self._digests.get(key)
+        if digest is None:
+            digest = EmailDigest(email.sender, email.receiver, email.subject)
+            digest.flushHandle = self._loop.call_later(
+                self._window, self._flush, key
+            )
+            self._digests[key] = digest
+
+        future = self._loop.create_future()
+        digest.add(email, future)
+        if len(digest) >= self._maxAlerts:
+            self._flush(key)
+        await future
+
+    async def close(self):
+        for key in list(self._digests):
+            self._flush(key)
+        if self._sending:
+            await asyncio.wait(self._sending)
+        await self._emailSender.close()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _flush(self, key):
+        digest = self._digests.pop(key, None)
+        if digest is None:
+            return
+        digest.flushHandle.cancel()
+        task = asyncio.ensure_future(self._sendDigest(digest), loop=self._loop)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _sendDigest(self, digest):
+        try:
+            await self._emailSender.send(digest.toEmailMessage())
+        except Exception as exc:
+            log.error("DigestEmailSender could not send digest of %d emails to %s: %s",
+                len(digest), digest.receiver, exc)
+            for future in digest.futures:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        log.info("DigestEmailSender sent digest of %d emails to %s",
+            len(digest), digest.receiver)
+        for future in digest.futures:
+            if not future.done():
+                future.set_result(None)
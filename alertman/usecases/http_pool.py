@@ -0,0 +1,213 @@
+import asyncio
+import json
+import ssl
+import time
+from collections import deque
+from time import perf_counter
+
+from alertman.log import getCustomLogger
+from alertman.metrics import observeStage
+
+
+log = getCustomLogger(__name__)
+
+
+class HTTPConnectionClosed(Exception):
+    pass
+
+
+# The connection failed before the whole request was written, the server
+# can't have acted on it.
+class HTTPRequestNotSent(HTTPConnectionClosed):
+    pass
+
+
+class HTTPResponse(object):
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def __repr__(self):
+        return '{{ HTTPResponse: {{ status: {0}, length: {1} }} }}'.format(
+            self.status, len(self.body))
+
+
+class HTTPConnection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.requestsSent = 0
+        self.lastUsed = time.monotonic()
+
+    @property
+    def isOpen(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+# Bounded pool of keep-alive HTTP/1.1 connections to a single host. HTTP/1.1
+# carries one request at a time per connection, so maxSize is also the limit
+# on concurrent requests to the host, further requests wait for a connection.
+# A request on a reused connection that failed while it was being written, eg:
+# the server closed the connection while it was idle, is retried once on a
+# new connection. Once written a request is never retried here, the server
+# may have acted on it even when the connection closes before the response.
+class HTTPConnectionPool(object):
+    def __init__(self, host, port, useTLS=False, maxSize=16, idleTimeout=30.0,
+            maxRequestsPerConnection=1000, connectTimeout=5.0, stage='http'):
+        self._host = host
+        self._port = port
+        self._ssl = ssl.create_default_context() if useTLS else None
+        self._hostHeader = host if port in (80, 443) else '{}:{}'.format(host, port)
+        self._maxSize = maxSize
+        self._idleTimeout = idleTimeout
+        self._maxRequestsPerConnection = maxRequestsPerConnection
+        self._connectTimeout = connectTimeout
+        self._stage = stage
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxSize)
+        self._closed = False
+
+    async def request(self, method, path, headers=None, body=b'', timeout=10.0):
+        if self._closed:
+            raise Exception("HTTPConnectionPool is closed")
+        async with self._slots:
+            connection = self._getIdleConnection()
+            if connection is not None:
+                try:
+                    return await self._request(connection, method, path, headers, body, timeout)
+                except HTTPRequestNotSent:
+                    log.debug("Idle HTTP connection to %s was closed, reconnecting",
+                        self._hostHeader)
+            connection = await self._connect()
+            return await self._request(connection, method, path, headers, body, timeout)
+
+    def close(self):
+        self._closed = True
+        while self._idle:
+            self._idle.popleft().close()
+        log.info("HTTPConnectionPool to %s closed", self._hostHeader)
+
+    @property
+    def idleSize(self):
+        return len(self._idle)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _getIdleConnection(self):
+        # most recently used connections are at the right end, so stale ones
+        # accumulate on the left and get evicted there
+        now = time.monotonic()
+        while self._idle and now - self._idle[0].lastUsed > self._idleTimeout:
+            self._idle.popleft().close()
+        while self._idle:
+            connection = self._idle.pop()
+            if connection.isOpen:
+                return connection
+            connection.close()
+        return None
+
+    async def _connect(self):
+        startedAt = perf_counter()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self._host, self._port, ssl=self._ssl),
+                self._connectTimeout
+            )
+        except Exception as exc:
+            observeStage('{}_connect'.format(self._stage), self._stage, 'error', startedAt)
+            log.error("HTTPConnectionPool could not connect to %s: %s", self._hostHeader, exc)
+            raise exc
+        observeStage('{}_connect'.format(self._stage), self._stage, 'ok', startedAt)
+        return HTTPConnection(reader, writer)
+
+    async def _request(self, connection, method, path, headers, body, timeout):
+        try:
+            response, keepAlive = await asyncio.wait_for(
+                self._roundTrip(connection, method, path, headers or {}, body), timeout
+            )
+        except BaseException:
+            # a connection failing mid request is in an unknown state, and
+            # one that timed out may still get the late response
+            connection.close()
+            raise
+        connection.requestsSent += 1
+        connection.lastUsed = time.monotonic()
+        if (keepAlive and not self._closed and
+                connection.requestsSent < self._maxRequestsPerConnection):
+            self._idle.append(connection)
+        else:
+            connection.close()
+        return response
+
+    async def _roundTrip(self, connection, method, path, headers, body):
+        lines = [
+            '{} {} HTTP/1.1'.format(method, path),
+            'Host: {}'.format(self._hostHeader),
+            'Content-Length: {}'.format(len(body))
+        ]
+        lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+        writer = connection.writer
+        if writer.is_closing():
+            raise HTTPRequestNotSent("Connection closed before the request")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        # the transport closes right away when the socket refuses the
+        # request, later on the request may have reached the server already
+        if writer.is_closing():
+            raise HTTPRequestNotSent("Connection closed while writing the request")
+        await writer.drain()
+
+        reader = connection.reader
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise HTTPConnectionClosed("Connection closed before the response")
+        parts = statusLine.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(parts) < 2 or not parts[0].startswith('HTTP/') or not parts[1].isdigit():
+            raise HTTPConnectionClosed("Malformed status line: {!r}".format(statusLine[:100]))
+        version, status = parts[0], int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ''
+        responseHeaders = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise HTTPConnectionClosed("Connection closed inside the response headers")
+            name, _, value = line.decode('latin-1').partition(':')
+            responseHeaders[name.strip().lower()] = value.strip()
+
+        keepAlive = (version == 'HTTP/1.1' and
+            responseHeaders.get('connection', '').lower() != 'close')
+        if 'chunked' in responseHeaders.get('transfer-encoding', '').lower():
+            responseBody = await self._readChunked(reader)
+        elif 'content-length' in responseHeaders:
+            responseBody = await reader.readexactly(int(responseHeaders['content-length']))
+        elif status in (204, 304) or method == 'HEAD':
+            responseBody = b''
+        else:
+            # delimited by the server closing the connection
+            responseBody = await reader.read()
+            keepAlive = False
+        return HTTPResponse(status, reason, responseHeaders, responseBody), keepAlive
+
+    async def _readChunked(self, reader):
+        chunks = []
+        while True:
+            sizeLine = await reader.readline()
+            size = int(sizeLine.split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip trailers up to the final blank line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
@@ -0,0 +1,440 @@
+import asyncio
+import fcntl
+import mmap
+import os
+import struct
+import time
+import zlib
+from collections import deque
+
+from alertman.domain.email import EmailMessage
+from alertman.domain.sms import SMSMessage
+from alertman.message_codecs import getCodec
+from alertman.usecases.process_alert import AlertSender
+from alertman.usecases.circuit_breaker import CircuitOpenError
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+# a log record is its payload length and crc32 followed by the payload, an
+# index entry is the record offset, payload length and state
+RECORD_HEADER = struct.Struct('<II')
+INDEX_ENTRY = struct.Struct('<QIB3x')
+# entries the index file grows by
+INDEX_CHUNK = 4096
+
+PENDING = 0
+SENT = 1
+DEAD = 2
+
+
+# One append only log file of the spool with its memory mapped index. The
+# log is only ever appended to, sending a record just flips its state in
+# the index, so a segment is deleted as a whole once nothing is pending.
+class SpoolSegment(object):
+    def __init__(self, directory, base):
+        self.base = base
+        self.logPath = os.path.join(directory, 'segment-{:020d}.log'.format(base))
+        self.indexPath = os.path.join(directory, 'segment-{:020d}.idx'.format(base))
+        self.count = 0
+        self.size = 0
+        self.pending = 0
+        self._fd = os.open(self.logPath, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._indexFd = os.open(self.indexPath, os.O_RDWR | os.O_CREAT, 0o644)
+        self._index = None
+        self._capacity = 0
+        self._mapIndex(max(
+            os.fstat(self._indexFd).st_size // INDEX_ENTRY.size, INDEX_CHUNK
+        ))
+
+    def recover(self):
+        # take the entries of the index, then index the records at the end
+        # of the log the index missed, eg: when the process died meanwhile
+        while self.count < self._capacity:
+            offset, length, state = self.getEntry(self.count)
+            if length == 0:
+                break
+            self.count += 1
+            if state == PENDING:
+                self.pending += 1
+        logSize = os.fstat(self._fd).st_size
+        offset = 0
+        if self.count:
+            lastOffset, lastLength, _ = self.getEntry(self.count - 1)
+            offset = lastOffset + RECORD_HEADER.size + lastLength
+        while offset + RECORD_HEADER.size <= logSize:
+            length, crc = RECORD_HEADER.unpack(
+                os.pread(self._fd, RECORD_HEADER.size, offset)
+            )
+            payload = os.pread(self._fd, length, offset + RECORD_HEADER.size)
+            if length == 0 or len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self.addEntry(offset, length)
+            offset += RECORD_HEADER.size + length
+        if offset < logSize:
+            log.warning("Outbox segment %s has a torn write at %d, truncating it",
+                self.logPath, offset)
+            os.ftruncate(self._fd, offset)
+        self.size = offset
+
+    def write(self, data, startSize):
+        # runs in an executor, the batch is durable once this returns
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.write(self._fd, view)
+                view = view[written:]
+            os.fsync(self._fd)
+        except Exception as exc:
+            # never leave half a batch in front of the next one
+            try:
+                os.ftruncate(self._fd, startSize)
+            except OSError:
+                pass
+            raise exc
+
+    def read(self, index):
+        offset, length, _ = self.getEntry(index)
+        return os.pread(self._fd, length, offset + RECORD_HEADER.size)
+
+    def getEntry(self, index):
+        return INDEX_ENTRY.unpack_from(self._index, index * INDEX_ENTRY.size)
+
+    def addEntry(self, offset, length):
+        if self.count == self._capacity:
+            self._mapIndex(self._capacity + INDEX_CHUNK)
+        INDEX_ENTRY.pack_into(
+            self._index, self.count * INDEX_ENTRY.size, offset, length, PENDING
+        )
+        self.count += 1
+        self.pending += 1
+        return self.count - 1
+
+    def setState(self, index, state):
+        offset, length, previous = self.getEntry(index)
+        INDEX_ENTRY.pack_into(
+            self._index, index * INDEX_ENTRY.size, offset, length, state
+        )
+        if previous == PENDING and state != PENDING:
+            self.pending -= 1
+
+    def close(self):
+        self._index.flush()
+        self._index.close()
+        os.close(self._indexFd)
+        os.close(self._fd)
+
+    def delete(self):
+        self.close()
+        os.unlink(self.logPath)
+        os.unlink(self.indexPath)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _mapIndex(self, capacity):
+        if self._index is not None:
+            self._index.close()
+        os.ftruncate(self._indexFd, capacity * INDEX_ENTRY.size)
+        self._index = mmap.mmap(self._indexFd, capacity * INDEX_ENTRY.size)
+        self._capacity = capacity
+
+
+# A durable local queue of alert payloads made of segments. Appends are
+# group committed, every fsyncInterval the appends waiting so far are
+# written and fsynced in one go and only then resolved, so a caller holding
+# a resolved append can ack its delivery. Pending records are handed out in
+# append order, a directory can only be used by one process at a time.
+class OutboxSpool(object):
+    def __init__(self, directory, segmentBytes=64 * 1024 * 1024, fsyncInterval=0.005):
+        self._directory = directory
+        self._segmentBytes = segmentBytes
+        self._fsyncInterval = fsyncInterval
+        self._segments = []
+        self._active = None
+        self._pendingRecords = deque()
+        self._available = asyncio.Event()
+        self._batch = []
+        self._flushing = None
+        self._lockFile = None
+
+    def open(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._lockFile = open(os.path.join(self._directory, 'lock'), 'w')
+        try:
+            fcntl.flock(self._lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lockFile.close()
+            raise Exception("Outbox directory: {} is used by another process".format(
+                self._directory))
+
+        bases = sorted(
+            int(name[len('segment-'):-len('.log')])
+            for name in os.listdir(self._directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+        for base in bases:
+            segment = SpoolSegment(self._directory, base)
+            segment.recover()
+            self._segments.append(segment)
+            for index in range(segment.count):
+                if segment.getEntry(index)[2] == PENDING:
+                    self._pendingRecords.append((segment, index))
+        if not self._segments or self._segments[-1].size >= self._segmentBytes:
+            self._roll()
+        self._active = self._segments[-1]
+        for segment in list(self._segments):
+            self._compact(segment)
+        if self._pendingRecords:
+            log.info("Outbox %s recovered %d pending alerts",
+                self._directory, len(self._pendingRecords))
+            self._available.set()
+
+    def append(self, payload):
+        future = asyncio.get_event_loop().create_future()
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        self._batch.append((record, len(payload), future))
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        return future
+
+    async def next(self):
+        while not self._pendingRecords:
+            self._available.clear()
+            await self._available.wait()
+        return self._pendingRecords.popleft()
+
+    def read(self, record):
+        segment, index = record
+        return segment.read(index)
+
+    def complete(self, record, state=SENT):
+        segment, index = record
+        segment.setState(index, state)
+        self._compact(segment)
+
+    # puts a record handed out by next back in front of the pending records
+    def requeue(self, record):
+        self._pendingRecords.appendleft(record)
+        self._available.set()
+
+    @property
+    def pendingCount(self):
+        return sum(segment.pending for segment in self._segments)
+
+    async def close(self):
+        if self._flushing is not None:
+            await self._flushing
+        for segment in self._segments:
+            segment.close()
+        self._segments = []
+        if self._lockFile is not None:
+            self._lockFile.close()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _flush(self):
+        loop = asyncio.get_event_loop()
+        while self._batch:
+            # let the appends of the interval join the batch
+            await asyncio.sleep(self._fsyncInterval)
+            batch, self._batch = self._batch, []
+            segment = self._active
+            try:
+                await loop.run_in_executor(
+                    None, segment.write,
+                    b''.join(record for record, _, _ in batch), segment.size
+                )
+            except Exception as exc:
+                log.error("Outbox could not write %d alerts: %s", len(batch), exc)
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            offset = segment.size
+            for record, length, future in batch:
+                index = segment.addEntry(offset, length)
+                offset += len(record)
+                self._pendingRecords.append((segment, index))
+                if not future.done():
+                    future.set_result(None)
+            segment.size = offset
+            self._available.set()
+            if segment.size >= self._segmentBytes:
+                self._roll()
+
+    def _roll(self):
+        base = 0
+        previous = self._active
+        if self._segments:
+            last = self._segments[-1]
+            base = last.base + last.count
+        self._active = SpoolSegment(self._directory, base)
+        self._segments.append(self._active)
+        if previous is not None:
+            self._compact(previous)
+
+    def _compact(self, segment):
+        # a segment nothing is pending in anymore is dropped as a whole
+        if segment.pending or segment is self._active or segment not in self._segments:
+            return
+        self._segments.remove(segment)
+        try:
+            segment.delete()
+        except OSError as exc:
+            log.error("Outbox could not delete segment %s: %s", segment.logPath, exc)
+
+
+def encodeAlert(alert, codec):
+    data = {
+        'id': alert.alertID,
+        'sender': alert.sender,
+        'receiver': alert.receiver,
+        'body': alert.body
+    }
+    if isinstance(alert, EmailMessage):
+        data['type'] = 'email'
+        data['subject'] = alert.subject
+    elif isinstance(alert, SMSMessage):
+        data['type'] = 'sms'
+    else:
+        raise Exception("Outbox can't spool alert: {}".format(alert))
+    if isinstance(alert.body, bytes):
+        data['body'] = alert.body.decode('latin-1')
+        data['bodyBytes'] = True
+    return codec.encode(data)
+
+
+def decodeAlert(payload, codec):
+    data = codec.decode(payload)
+    body = data['body']
+    if data.get('bodyBytes'):
+        body = body.encode('latin-1')
+    # spooled before alerts had ids when there's no id
+    alertID = data.get('id')
+    if data['type'] == 'email':
+        return EmailMessage(data['sender'], data['receiver'], data['subject'], body, alertID)
+    return SMSMessage(data['sender'], data['receiver'], body, alertID)
+
+
+# Sits in front of an AlertSender and only spools alerts, send returns once
+# the alert is durable so the delivery can be acked while the channel is
+# down. A drainer sends the spooled alerts through the wrapped sender, after
+# a failure it backs off exponentially, as the next alert would most likely
+# fail the same way, and a record is given up on after maxAttempts, or after
+# being deferred by an open circuit maxDeferrals times, if set.
+class OutboxSender(AlertSender):
+    def __init__(self, alertSender, spool, concurrency=64, baseDelay=1.0,
+            maxDelay=60.0, maxAttempts=0, maxDeferrals=0, codec='json'):
+        self._alertSender = alertSender
+        self._spool = spool
+        self._slots = asyncio.Semaphore(concurrency)
+        self._baseDelay = baseDelay
+        self._maxDelay = maxDelay
+        self._maxAttempts = maxAttempts
+        self._maxDeferrals = maxDeferrals
+        self._codec = getCodec(codec)
+        self._attempts = {}
+        self._deferrals = {}
+        self._failures = 0
+        self._resumeAt = 0.0
+        self._sending = set()
+        self._drainer = None
+
+    async def send(self, alert):
+        await self._spool.append(encodeAlert(alert, self._codec))
+
+    def getRenderer(self):
+        # alerts get rendered when they are drained, not before spooling
+        return None
+
+    def start(self):
+        if self._drainer is None:
+            self._drainer = asyncio.ensure_future(self._drain())
+
+    @property
+    def pendingCount(self):
+        return self._spool.pendingCount
+
+    async def close(self, timeout=5.0):
+        if self._drainer is not None:
+            self._drainer.cancel()
+        # alerts still being sent are sent again after a restart
+        if self._sending:
+            await asyncio.wait(self._sending, timeout=timeout)
+        for task in list(self._sending):
+            task.cancel()
+        await self._spool.close()
+        if hasattr(self._alertSender, 'close'):
+            await self._alertSender.close()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _drain(self):
+        while True:
+            await self._slots.acquire()
+            record = await self._spool.next()
+            while self._resumeAt > time.monotonic():
+                await asyncio.sleep(self._resumeAt - time.monotonic())
+            task = asyncio.ensure_future(self._drainRecord(record))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _drainRecord(self, record):
+        try:
+            try:
+                alert = decodeAlert(self._spool.read(record), self._codec)
+            except Exception as exc:
+                log.error("Outbox dropping unreadable alert: %s", exc)
+                self._spool.complete(record, DEAD)
+                return
+            try:
+                await self._alertSender.send(alert)
+            except Exception as exc:
+                self._onFailure(record, alert, exc)
+                return
+            self._failures = 0
+            self._attempts.pop(record, None)
+            self._deferrals.pop(record, None)
+            self._spool.complete(record, SENT)
+        finally:
+            self._slots.release()
+
+    def _onFailure(self, record, alert, exc):
+        # an open circuit says for how long sending is pointless, and the
+        # alert didn't use up an attempt as it never reached the backend
+        retryAfter = getattr(exc, 'retryAfter', None)
+        if isinstance(exc, CircuitOpenError):
+            deferrals = self._deferrals[record] = self._deferrals.get(record, 0) + 1
+            if self._maxDeferrals and deferrals >= self._maxDeferrals:
+                self._giveUp(record, alert, exc)
+                return
+            self._spool.requeue(record)
+            self._resumeAt = max(self._resumeAt, time.monotonic() + retryAfter)
+            return
+        # sends failing together during one backoff count as one failure
+        if time.monotonic() >= self._resumeAt:
+            self._failures += 1
+        attempts = self._attempts[record] = self._attempts.get(record, 0) + 1
+        if self._maxAttempts and attempts >= self._maxAttempts:
+            self._giveUp(record, alert, exc)
+            return
+        self._spool.requeue(record)
+        delay = min(self._maxDelay, self._baseDelay * (2 ** min(self._failures - 1, 32)))
+        # a throttled or unavailable backend may ask for a longer wait
+        if retryAfter is not None:
+            delay = max(delay, retryAfter)
+        self._resumeAt = max(self._resumeAt, time.monotonic() + delay)
+        log.warning("Outbox send of %s failed, backing off %.1fs: %s", alert, delay, exc)
+
+    def _giveUp(self, record, alert, exc):
+        log.error("Outbox giving up on %s after %d attempts and %d deferrals: %s", alert,
+            self._attempts.pop(record, 0), self._deferrals.pop(record, 0), exc)
+        self._spool.complete(record, DEAD)
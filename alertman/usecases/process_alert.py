@@ -1,52 +1,144 @@
 import abc
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from time import perf_counter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from alertman.log import getCustomLogger
+from alertman.metrics import observeStage
 from alertman.domain.email import createAlertObject
+from alertman.domain.ids import newAlertID
 
 
 log = getCustomLogger(__name__)
 
 
+ADDED = 'added'
+PENDING = 'pending'
+SENT = 'sent'
+
+
+# Another delivery of the same alert holds the claim and hasn't been sent
+# yet, the alert is retried instead of dropped in case that one never is.
+class DedupClaimPending(Exception):
+    pass
+
+
+# alertID is handed on to the alert created from the request, so logs of
+# every step can be correlated by it
 class AlertRequest(object):
-    def __init__(self, alertMessage, alertType):
+    __slots__ = ('alertID', 'alertMessage', 'alertType')
+
+    def __init__(self, alertMessage, alertType, alertID=None):
+	    self.alertID = newAlertID() if alertID is None else alertID
 	    self.alertMessage = alertMessage
 	    self.alertType = alertType
 
+    def __repr__(self):
+        return '{{ AlertRequest: {{ id: {0}, type: {1} }} }}'.format(
+            self.alertID, self.alertType)
+
 
 class AlertProcessor(object): 
-    def __init__(self, alertSender, validator):
+    def __init__(self, alertSender, validator, deduplicator=None):
 	    self._alertSender = alertSender
 	    self._validator = validator
+	    self._deduplicator = deduplicator
 
 
     async def process(self, alertRequest):
+        prepared = await self.prepare(alertRequest)
+        if prepared is None:
+            return
+        alert, dedupKey = prepared
+        await self.deliver(alert, alertRequest.alertType, dedupKey)
+
+    # validates, deduplicates and creates the alert object, returns None for
+    # duplicates or the (alert, dedupKey) pair which deliver expects
+    async def prepare(self, alertRequest):
+        alertType = alertRequest.alertType
         # step 1:  validate the Transaction Request -> Order, PaymentMethod, PaymentInfo
+        startedAt = perf_counter()
         isValid = self._validator.validate(alertRequest)
+        observeStage('validate', alertType, 'ok' if isValid else 'invalid', startedAt)
         if not isValid:
             raise Exception("AlertProcessor returned invalid for {{ AlertRequest: \
                 object: {} }}".format(alertRequest))
-        # step 2: Create new domain Transaction ojbect with fraud status false and transaction status pending
-        alert = self._createAlert(alertRequest)
+        # step 2: drop alerts already sent, before doing any network io
+        dedupKey = None
+        if self._deduplicator:
+            startedAt = perf_counter()
+            try:
+                dedupKey = await self._deduplicator.claim(alertRequest)
+            except DedupClaimPending as exc:
+                observeStage('dedup', alertType, 'pending', startedAt)
+                raise exc
+            observeStage('dedup', alertType,
+                'duplicate' if dedupKey is None else 'ok', startedAt)
+            if dedupKey is None:
+                log.info("Dropping duplicate %s alert: %s", alertType, alertRequest.alertID)
+                return None
+        # step 3: Create new domain Transaction ojbect with fraud status false and transaction status pending
+        try:
+            startedAt = perf_counter()
+            alert = self._createAlert(alertRequest)
+            observeStage('create', alertType, 'ok', startedAt)
+        except Exception as exc:
+            await self._releaseDedupKey(dedupKey)
+            raise exc
+        return alert, dedupKey
+
+    async def deliver(self, alert, alertType, dedupKey=None):
         try:
-            await self._sendAlert(alert)
+            await self._sendAlert(alert, alertType)
         except Exception as exc:
+            # let the retried alert through the deduplicator again
+            await self._releaseDedupKey(dedupKey)
             raise exc
+        await self._confirmDedupKey(dedupKey)
+
+    # gives up on a prepared alert which will never be delivered
+    async def abort(self, dedupKey=None):
+        await self._releaseDedupKey(dedupKey)
+
+    def getRenderer(self):
+        return self._alertSender.getRenderer()
 
     #---------------------------------------#
     #           Private Methods             #
     #---------------------------------------#
 
-    async def _sendAlert(self, alert):
+    async def _sendAlert(self, alert, alertType):
+        startedAt = perf_counter()
         try:
             await self._alertSender.send(alert)
         except Exception as exc:
-            log.error("self._alertSender.send raised exception: {{ \
-                exc: {} }}".format(exc))
+            observeStage('send', alertType, 'error', startedAt)
+            log.error("self._alertSender.send raised exception: { alert: %s, exc: %s }",
+                alert.alertID, exc)
             raise exc
+        observeStage('send', alertType, 'ok', startedAt)
+
+    async def _releaseDedupKey(self, dedupKey):
+        if dedupKey is not None:
+            await self._deduplicator.release(dedupKey)
+
+    async def _confirmDedupKey(self, dedupKey):
+        if dedupKey is None:
+            return
+        # the alert is out, failing here must not get it sent again
+        try:
+            await self._deduplicator.confirm(dedupKey)
+        except Exception as exc:
+            log.error("Could not mark alert as sent in the deduplicator: %s", exc)
 
     def _createAlert(self, alertRequest):
         return createAlertObject(
-            alertRequest.alertMessage, alertRequest.alertType
+            alertRequest.alertMessage, alertRequest.alertType, alertRequest.alertID
         )
             
 
@@ -57,6 +149,201 @@ class AlertSender(metaclass=abc.ABCMeta):
     async def send(self):
         pass
 
+    # optional picklable function rendering an alert ahead of send, so that
+    # cpu heavy rendering can run in an executor. send uses alert.rendered
+    # when it is set and renders inline otherwise
+    def getRenderer(self):
+        return None
+
+
+# Interface
+# A key is added as pending for pendingTtl seconds and kept for ttl seconds
+# once it's confirmed as sent. A claim left pending by a crashed worker so
+# only holds the alert back until it expires.
+class DedupBackend(metaclass=abc.ABCMeta):
+
+    # add key as pending unless present and not expired, returns ADDED, or
+    # PENDING or SENT for the state of the key already there
+    @abc.abstractmethod
+    async def add(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def confirm(self, key):
+        pass
+
+    @abc.abstractmethod
+    async def discard(self, key):
+        pass
+
+
+class InMemoryDedupBackend(DedupBackend):
+    # keys are kept in the order they were last added or confirmed in, with
+    # their expiry time and state. Expired keys are mostly at the front, so
+    # evictions are O(1), a pending key behind a sent one is only evicted
+    # later but already counts as expired. keys are 16 byte digests, so
+    # maxEntries caps the memory used
+    def __init__(self, ttl=3600.0, maxEntries=100000, pendingTtl=120.0):
+        self._ttl = ttl
+        self._pendingTtl = pendingTtl
+        self._maxEntries = maxEntries
+        self._entries = OrderedDict()
+
+    async def add(self, key):
+        now = time.monotonic()
+        self._evict(now)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return SENT if entry[1] else PENDING
+        self._entries.pop(key, None)
+        self._entries[key] = (now + self._pendingTtl, False)
+        if len(self._entries) > self._maxEntries:
+            self._entries.popitem(last=False)
+        return ADDED
+
+    async def confirm(self, key):
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self._ttl, True)
+        if len(self._entries) > self._maxEntries:
+            self._entries.popitem(last=False)
+
+    async def discard(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self, now):
+        while self._entries:
+            key, (expiresAt, _) = next(iter(self._entries.items()))
+            if expiresAt > now:
+                break
+            del self._entries[key]
+
+
+class SQLiteDedupBackend(DedupBackend):
+    # survives restarts and can be shared by the worker processes of one host.
+    # sqlite blocks, so every statement runs on the backend's own thread,
+    # which also owns the connection. An expired key is taken over by the
+    # insert itself, the expired rows are only deleted every sweepInterval
+    def __init__(self, path, ttl=3600.0, sweepInterval=60.0, pendingTtl=120.0):
+        self._path = path
+        self._ttl = ttl
+        self._pendingTtl = pendingTtl
+        self._sweepInterval = sweepInterval
+        self._sweptAt = 0.0
+        self._connection = None
+        self._executor = ThreadPoolExecutor(1)
+
+    async def add(self, key):
+        return await self._run(self._add, key)
+
+    async def confirm(self, key):
+        await self._run(self._confirm, key)
+
+    async def discard(self, key):
+        await self._run(self._discard, key)
+
+    async def close(self):
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _run(self, function, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path, isolation_level=None)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS dedup_claims '
+                '(key BLOB PRIMARY KEY, sent INTEGER NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS dedup_claims_expires_at ON dedup_claims (expires_at)'
+            )
+        return self._connection
+
+    def _add(self, key):
+        connection = self._connect()
+        now = time.time()
+        if now - self._sweptAt >= self._sweepInterval:
+            self._sweptAt = now
+            connection.execute('DELETE FROM dedup_claims WHERE expires_at <= ?', (now,))
+        cursor = connection.execute(
+            'INSERT INTO dedup_claims (key, sent, expires_at) VALUES (?, 0, ?) '
+            'ON CONFLICT (key) DO UPDATE SET sent = 0, expires_at = excluded.expires_at '
+            'WHERE dedup_claims.expires_at <= ?',
+            (key, now + self._pendingTtl, now)
+        )
+        if cursor.rowcount == 1:
+            return ADDED
+        row = connection.execute(
+            'SELECT sent FROM dedup_claims WHERE key = ?', (key,)
+        ).fetchone()
+        return SENT if row and row[0] else PENDING
+
+    def _confirm(self, key):
+        self._connect().execute(
+            'INSERT INTO dedup_claims (key, sent, expires_at) VALUES (?, 1, ?) '
+            'ON CONFLICT (key) DO UPDATE SET sent = 1, expires_at = excluded.expires_at',
+            (key, time.time() + self._ttl)
+        )
+
+    def _discard(self, key):
+        self._connect().execute('DELETE FROM dedup_claims WHERE key = ?', (key,))
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class AlertDeduplicator(object):
+    def __init__(self, backend):
+        self._backend = backend
+
+    # returns the claimed key, or None when the alert was sent already
+    async def claim(self, alertRequest):
+        key = self.getKey(alertRequest)
+        state = await self._backend.add(key)
+        if state == ADDED:
+            return key
+        if state == PENDING:
+            raise DedupClaimPending(
+                "Alert: {} is being sent by another delivery".format(alertRequest.alertID))
+        return None
+
+    # the alert of a claimed key was sent, keep the key for the whole ttl
+    async def confirm(self, key):
+        await self._backend.confirm(key)
+
+    async def release(self, key):
+        await self._backend.discard(key)
+
+    async def close(self):
+        if hasattr(self._backend, 'close'):
+            await self._backend.close()
+
+    def getKey(self, alertRequest):
+        alertMessage = alertRequest.alertMessage
+        body = alertMessage['body']
+        if not isinstance(body, (str, bytes)):
+            body = json.dumps(body, sort_keys=True)
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(alertRequest.alertType.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(str(alertMessage['receiver']).encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(body)
+        return digest.digest()
+
 
 # Interface
 class Validator(metaclass=abc.ABCMeta):
@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from alertman.usecases.process_alert import AlertSender
+from alertman.log import getCustomLogger
+
+
+log = getCustomLogger(__name__)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        self._rate = float(rate)
+        self._capacity = float(capacity or max(rate, 1))
+        self._tokens = self._capacity
+        self._updatedAt = time.monotonic()
+
+    # takes one token, possibly going into debt, and returns how many seconds
+    # the caller has to wait before its token is actually available. callers
+    # reserving one after the other get served in order
+    def reserve(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updatedAt) * self._rate
+        )
+        self._updatedAt = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self._rate
+
+
+class RateLimiter(object):
+    # one bucket for the whole channel plus one per receiver domain, the
+    # domain buckets are kept in a bounded lru so that they can't grow forever
+    def __init__(self, rate=0, burst=None, domainRate=0, domainBurst=None,
+            maxDomains=10000):
+        self._bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self._domainRate = domainRate
+        self._domainBurst = domainBurst
+        self._maxDomains = maxDomains
+        self._domainBuckets = OrderedDict()
+
+    def reserve(self, receiver):
+        delay = 0.0
+        if self._bucket:
+            delay = self._bucket.reserve()
+        domain = getReceiverDomain(receiver)
+        if self._domainRate > 0 and domain:
+            delay = max(delay, self._getDomainBucket(domain).reserve())
+        return delay
+
+    def _getDomainBucket(self, domain):
+        bucket = self._domainBuckets.get(domain)
+        if bucket is None:
+            bucket = TokenBucket(self._domainRate, self._domainBurst)
+            self._domainBuckets[domain] = bucket
+            if len(self._domainBuckets) > self._maxDomains:
+                self._domainBuckets.popitem(last=False)
+        else:
+            self._domainBuckets.move_to_end(domain)
+        return bucket
+
+
+def getReceiverDomain(receiver):
+    if not isinstance(receiver, str) or '@' not in receiver:
+        return None
+    return receiver.rsplit('@', 1)[1].lower()
+
+
+# Wraps an AlertSender so that sends never go above the configured rates. A
+# send that has to wait throttles the consumer through backpressure, so
+# the broker stops delivering new alerts while the bucket is dry.
+class RateLimitedSender(AlertSender):
+    def __init__(self, alertSender, limiter, backpressure=None):
+        self._alertSender = alertSender
+        self._limiter = limiter
+        self._backpressure = backpressure
+
+    async def send(self, alert):
+        delay = self._limiter.reserve(getattr(alert, 'receiver', None))
+        if delay > 0:
+            log.debug("Rate limited, delaying send by %.3fs", delay)
+            if self._backpressure:
+                self._backpressure.throttle()
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                if self._backpressure:
+                    self._backpressure.release()
+        await self._alertSender.send(alert)
+
+    def getRenderer(self):
+        return self._alertSender.getRenderer()
+
+    async def close(self):
+        if hasattr(self._alertSender, 'close'):
+            await self._alertSender.close()
@@ -1,11 +1,21 @@
+import asyncio
+import hashlib
 import random
 import json
+import threading
+from collections import OrderedDict
+from email import charset as emailCharset
+from email.message import Message
 from email.mime.text import MIMEText
+from email.policy import SMTP
+from time import perf_counter
 
-import aiosmtplib
+from aiosmtplib import SMTPRecipientRefused
 
 from alertman.usecases.process_alert import AlertSender
+from alertman.usecases.smtp_pool import SMTPConnectionPool
 from alertman.log import getCustomLogger
+from alertman.metrics import observeStage
 
 
 log = getCustomLogger(__name__)
@@ -15,57 +25,297 @@ class EmailSender(AlertSender):
     def __init__(self, config, loop):
         self._config = config
         self._loop = loop
+        # a single smtp connection can only carry one transaction at a time,
+        # so parallel emails each borrow their own pooled session instead of
+        # sharing one, and the connect + login cost is paid once per session
+        self._pool = SMTPConnectionPool(
+            config, loop,
+            maxSize=config.get('SMTP_POOL_SIZE', 4),
+            idleTimeout=config.get('SMTP_POOL_IDLE_TIMEOUT', 60.0),
+            maxMessagesPerSession=config.get('SMTP_POOL_MAX_MESSAGES_PER_SESSION', 100),
+            healthcheckInterval=config.get('SMTP_POOL_HEALTHCHECK_INTERVAL', 5.0)
+        )
+        self._batcher = None
+        if config.get('SMTP_BATCH_WINDOW', 0) > 0:
+            self._batcher = RecipientBatcher(
+                self._pool, config['SMTP_BATCH_WINDOW'],
+                config.get('SMTP_MAX_RECIPIENTS', 100)
+            )
     
     async def send(self, email):
-        # create a new email connection
-        smtp = await self._connect()
-        # send email now
-        await self._createAndSendEmail(email, smtp)
-
-    async def _connect(self):
-        # create a new smtp connection 
-        # reason for not using the same connection if becasue
-        # sinble connectin email is blocking and cannot send paraller email
-        # so better to perform multiple email
-        smtp = aiosmtplib.SMTP(
-            hostname=self._config['SMTP_HOSTNAME'], port=self._config['SMTP_PORT'],
-            loop=self._loop, use_tls=self._config['SMTP_USE_TLS']
-        )
-        await smtp.connect()
-        await smtp.login(self._config['SMTP_USERNAME'], self._config['SMTP_PASSWORD'])
-        return smtp
+        if self._batcher is not None:
+            await self._batcher.send(email)
+            return
+        message = getattr(email, 'rendered', None)
+        if message is None:
+            startedAt = perf_counter()
+            message = self._createEmailMessage(email)
+            observeStage('render', 'email', 'ok', startedAt)
+        # borrow a connected session from the pool and send email now
+        async with self._pool.session() as session:
+            startedAt = perf_counter()
+            try:
+                await self._sendEmail(email, message, session.smtp)
+            except Exception as exc:
+                observeStage('smtp_send', 'email', 'error', startedAt)
+                raise exc
+            observeStage('smtp_send', 'email', 'ok', startedAt)
+            session.messagesSent += 1
+
+    async def close(self):
+        if self._batcher is not None:
+            await self._batcher.close()
+        await self._pool.close()
 
-    async def _createAndSendEmail(self, email, smtp):
-        message = self._createEmailMessage(email)
-        await self._sendEmail(message, smtp)
+    def getRenderer(self):
+        # batched emails are rendered once per group when the group is sent
+        if self._batcher is not None:
+            return None
+        return createEmailMessage
     
-    async def _sendEmail(self, message, smtp):
+    async def _sendEmail(self, email, message, smtp):
         try:
-            await smtp.send_message(message)
+            await smtp.sendmail(email.sender, [email.receiver], message)
         except Exception as exc:
             raise exc
     
     def _createEmailMessage(self, email):
-        message = None
+        return createEmailMessage(email)
+
+
+class EmailGroup(object):
+    def __init__(self, email):
+        self.email = email
+        self.receivers = []
+        self.futures = []
+
+    def add(self, receiver, future):
+        self.receivers.append(receiver)
+        self.futures.append(future)
+
+    def __len__(self):
+        return len(self.receivers)
+
+
+# Groups emails with the same sender, subject and body arriving within window
+# seconds, and sends every group as a single transaction, one MAIL FROM and
+# DATA with an RCPT TO per receiver, in chunks of maxRecipients. The groups
+# of a flush go back to back over one pooled session. Every send resolves
+# with the outcome of its own receiver, so a refused receiver only fails
+# its own alert.
+class RecipientBatcher(object):
+    def __init__(self, pool, window=0.005, maxRecipients=100):
+        self._pool = pool
+        self._window = window
+        self._maxRecipients = maxRecipients
+        self._groups = OrderedDict()
+        self._flushHandle = None
+        self._sending = set()
+
+    async def send(self, email):
+        key = (email.sender, email.subject, getEmailBodyDigest(email.body))
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = EmailGroup(email)
+        future = asyncio.get_event_loop().create_future()
+        group.add(email.receiver, future)
+        if len(group) >= self._maxRecipients:
+            self._flush()
+        elif self._flushHandle is None:
+            self._flushHandle = asyncio.get_event_loop().call_later(
+                self._window, self._flush
+            )
+        await future
+
+    async def close(self):
+        self._flush()
+        if self._sending:
+            await asyncio.wait(self._sending)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _flush(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        groups, self._groups = list(self._groups.values()), OrderedDict()
+        if not groups:
+            return
+        chunks = []
+        for group in groups:
+            for start in range(0, len(group), self._maxRecipients):
+                end = start + self._maxRecipients
+                chunks.append((
+                    group.email, group.receivers[start:end], group.futures[start:end]
+                ))
+        task = asyncio.ensure_future(self._sendChunks(chunks))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _sendChunks(self, chunks):
+        while chunks:
+            opened = False
+            chunk = None
+            try:
+                async with self._pool.session() as session:
+                    opened = True
+                    while chunks:
+                        chunk = chunks.pop(0)
+                        await self._sendChunk(session, *chunk)
+                        chunk = None
+            except Exception as exc:
+                # the session is dropped, the next chunks get a fresh one. A
+                # session that couldn't be opened fails the chunk it was for,
+                # one failing to close after a send fails no chunk at all
+                if not opened:
+                    chunk = chunks.pop(0)
+                if chunk is None:
+                    log.warning("Could not close smtp session: %s", exc)
+                    continue
+                email, receivers, futures = chunk
+                log.error("Could not send email to %d receivers: %s", len(receivers), exc)
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    async def _sendChunk(self, session, email, receivers, futures):
+        startedAt = perf_counter()
+        # receivers of a group never get to see each other
+        to = receivers[0] if len(receivers) == 1 else 'undisclosed-recipients:;'
+        message = createEmailMessage(email, to)
+        observeStage('render', 'email', 'ok', startedAt)
+        startedAt = perf_counter()
         try:
-            bodyAsBytes = self._getEmailBodyBytes(email.body)
-            message = MIMEText(bodyAsBytes)
-            message['From'] = email.sender
-            message['To'] = email.receiver
-            message['Subject'] = email.subject
+            refused, _ = await session.smtp.sendmail(email.sender, receivers, message)
         except Exception as exc:
-            log.error("Error while creating MIMIEText: exc: {}".format(exc))
+            observeStage('smtp_send', 'email', 'error', startedAt)
             raise exc
-        return message
-    
-    def _getEmailBodyBytes(self, body):
-        try:
-            if isinstance(body, str):
-                return body
-            if isinstance(body, bytes):
-                return body.decode('utf-8')
+        observeStage('smtp_send', 'email', 'ok', startedAt)
+        session.messagesSent += 1
+        for receiver, future in zip(receivers, futures):
+            if future.done():
+                continue
+            if receiver in refused:
+                response = refused[receiver]
+                future.set_exception(SMTPRecipientRefused(
+                    response.code, response.message, receiver
+                ))
             else:
-                return json.dumps(body)
-        except Exception as exc:
-            log.error("Exception raise while parsing emailmessage body: exc: {}".format(exc))
-            raise exc
\ No newline at end of file
+                future.set_result(None)
+
+
+# Bounded by the total size of the cached values, the least recently used
+# entries are evicted first. Values larger than an eighth of the cache are
+# rendered every time instead of flushing everything else out. Render stage
+# threads share it, so it's guarded by a lock.
+class RenderCache(object):
+    def __init__(self, maxBytes=8 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, render, *args):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = render(*args)
+        if len(value) > self.maxBytes // 8:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._size += len(value)
+            while self._size > self.maxBytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# the cache of the process rendering, every process of a process pool
+# executor ends up with one of its own
+renderCache = RenderCache()
+
+# non ascii bodies go out as quoted printable utf-8, readable in the raw
+# message unlike base64
+UTF8 = emailCharset.Charset('utf-8')
+UTF8.body_encoding = emailCharset.QP
+
+
+def configureRenderCache(maxBytes):
+    global renderCache
+    renderCache = RenderCache(maxBytes)
+
+
+# module level so that the pipeline can render emails in a process pool. An
+# email is rendered to the bytes sent as DATA, put together from the cached
+# From and Subject headers, the cached To header and the cached body part, so
+# the same alert sent to many receivers is only encoded once.
+def createEmailMessage(email, to=None):
+    try:
+        bodyText = getEmailBodyText(email.body)
+        return b''.join((
+            renderCache.get(('headers', email.sender, email.subject),
+                renderHeaders, (('From', email.sender), ('Subject', email.subject))),
+            renderCache.get(('to', to or email.receiver),
+                renderHeaders, (('To', to or email.receiver),)),
+            # keyed by digest, a body as key would be kept twice per entry
+            # and only its rendering counts toward maxBytes
+            renderCache.get(('body', getEmailBodyDigest(bodyText)), renderBodyPart, bodyText)
+        ))
+    except Exception as exc:
+        log.error("Error while creating email message: exc: %s", exc)
+        raise exc
+
+
+def renderHeaders(headers):
+    message = Message(policy=SMTP)
+    for name, value in headers:
+        message[name] = value
+    # drop the blank line ending the headers of an empty message
+    return message.as_bytes()[:-2]
+
+
+def renderBodyPart(bodyText):
+    if bodyText.isascii():
+        part = MIMEText(bodyText, 'plain', 'us-ascii', policy=SMTP)
+    else:
+        part = MIMEText(bodyText, 'plain', UTF8, policy=SMTP)
+    return part.as_bytes()
+
+
+# alert bodies that aren't text, eg: the message of an alert without a body
+# template, are rendered as one "key: value" line per field
+def getEmailBodyText(body):
+    try:
+        if isinstance(body, str):
+            return body
+        if isinstance(body, bytes):
+            return body.decode('utf-8')
+        if isinstance(body, dict):
+            return '\n'.join(
+                '{}: {}'.format(key, value if isinstance(value, str)
+                    else json.dumps(value, ensure_ascii=False))
+                for key, value in body.items()
+            )
+        return json.dumps(body, indent=2, ensure_ascii=False)
+    except Exception as exc:
+        log.error("Exception raise while parsing emailmessage body: exc: %s", exc)
+        raise exc
+
+
+def getEmailBodyDigest(body):
+    return hashlib.blake2b(
+        getEmailBodyText(body).encode('utf-8'), digest_size=16
+    ).digest()
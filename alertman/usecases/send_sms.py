@@ -1,22 +1,338 @@
+import asyncio
+import hmac
+import json
 import random
 from asyncio import sleep
+from collections import OrderedDict
+from time import perf_counter
+from urllib.parse import parse_qs, urlsplit
 
 from alertman.usecases.process_alert import AlertSender
+from alertman.usecases.http_pool import HTTPConnectionPool
 from alertman.log import getCustomLogger
+from alertman.metrics import SMS_RECEIPTS, observeStage
 
 
 log = getCustomLogger(__name__)
 
-    
+
+# retryAfter is set from the Retry-After of a throttled or unavailable
+# gateway, retry and outbox then wait that long without using up an attempt
+class SMSGatewayError(Exception):
+    def __init__(self, status, message, retryAfter=None):
+        super().__init__("SMS gateway returned {}: {}".format(status, message))
+        self.status = status
+        self.retryAfter = retryAfter
+
+
+# Sends sms through a generic http sms gateway over a pool of keep-alive
+# connections, the pool size caps the requests in flight to the gateway.
+# Messages arriving within bulkWindow seconds of each other go out together
+# through the bulk submit endpoint, up to bulkMaxMessages per request:
+#
+#   POST {url}/messages       {"reference", "from", "to", "text", "callbackUrl"}
+#   POST {url}/messages/bulk  {"messages": [...]} -> {"results": [
+#                                 {"reference", "id", "status", "error"}]}
+#
+# A send returns once the gateway accepted its message, the delivery receipt
+# arrives later on the receipt endpoint and is matched up by DeliveryReceipts.
 class SMSSender(AlertSender):
+    def __init__(self, config, loop, callbackUrl=None):
+        self._config = config
+        self._loop = loop
+        url = urlsplit(config['SMS_GATEWAY_URL'])
+        useTLS = url.scheme == 'https'
+        self._pool = HTTPConnectionPool(
+            url.hostname, url.port or (443 if useTLS else 80), useTLS,
+            maxSize=config.get('SMS_GATEWAY_POOL_SIZE', 16),
+            idleTimeout=config.get('SMS_GATEWAY_IDLE_TIMEOUT', 30.0),
+            connectTimeout=config.get('SMS_GATEWAY_CONNECT_TIMEOUT', 5.0),
+            stage='sms_gateway'
+        )
+        self._path = url.path.rstrip('/')
+        self._headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        if config.get('SMS_GATEWAY_API_KEY'):
+            self._headers['Authorization'] = 'Bearer {}'.format(config['SMS_GATEWAY_API_KEY'])
+        self._timeout = config.get('SMS_GATEWAY_TIMEOUT', 10.0)
+        self._bulkWindow = config.get('SMS_BULK_WINDOW', 0.01)
+        self._bulkMaxMessages = config.get('SMS_BULK_MAX_MESSAGES', 100)
+        self._callbackUrl = callbackUrl
+        self._pending = []
+        self._flushHandle = None
+        self._sending = set()
+        self.receipts = DeliveryReceipts(
+            maxPending=config.get('SMS_RECEIPT_MAX_PENDING', 100000)
+        )
+
+    async def send(self, sms):
+        if self._bulkWindow <= 0:
+            await self._submit(sms)
+            return
+        future = self._loop.create_future()
+        self._pending.append((sms, future))
+        if len(self._pending) >= self._bulkMaxMessages:
+            self._flush()
+        elif self._flushHandle is None:
+            self._flushHandle = self._loop.call_later(self._bulkWindow, self._flush)
+        await future
+
+    async def close(self):
+        self._flush()
+        if self._sending:
+            await asyncio.wait(self._sending)
+        self._pool.close()
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    def _flush(self):
+        if self._flushHandle is not None:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._submitBatch(batch), loop=self._loop)
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _submitBatch(self, batch):
+        if len(batch) == 1:
+            sms, future = batch[0]
+            try:
+                await self._submit(sms)
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+                return
+            if not future.done():
+                future.set_result(None)
+            return
+
+        futures = {str(sms.alertID): (sms, future) for sms, future in batch}
+        try:
+            response = await self._post('/messages/bulk', {
+                'messages': [self._getMessage(sms) for sms, _ in batch]
+            }, len(batch))
+        except Exception as exc:
+            log.error("SMS bulk submit of %d messages failed: %s", len(batch), exc)
+            for _, future in futures.values():
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        results = response.get('results')
+        if results is None:
+            # the gateway took the whole batch without telling us the ids
+            for _, future in futures.values():
+                if not future.done():
+                    future.set_result(None)
+            return
+        for result in results:
+            sms, future = futures.pop(str(result.get('reference')), (None, None))
+            if future is None or future.done():
+                continue
+            if result.get('status') == 'accepted':
+                if result.get('id') is not None:
+                    self.receipts.track(result['id'], sms.alertID)
+                future.set_result(None)
+            else:
+                future.set_exception(SMSGatewayError(
+                    result.get('status', 'rejected'), result.get('error', '')
+                ))
+        for sms, future in futures.values():
+            if not future.done():
+                future.set_exception(Exception(
+                    "SMS gateway returned no result for sms: {}".format(sms.alertID)))
+
+    async def _submit(self, sms):
+        result = await self._post('/messages', self._getMessage(sms), 1)
+        if result.get('id') is not None:
+            self.receipts.track(result['id'], sms.alertID)
+
+    async def _post(self, path, payload, count):
+        startedAt = perf_counter()
+        try:
+            response = await self._pool.request(
+                'POST', self._path + path, self._headers,
+                json.dumps(payload).encode('utf-8'), self._timeout
+            )
+        except Exception as exc:
+            observeStage('sms_submit', 'sms', 'error', startedAt)
+            raise exc
+        if not 200 <= response.status < 300:
+            observeStage('sms_submit', 'sms', 'error', startedAt)
+            raise SMSGatewayError(
+                response.status, response.body[:200].decode('utf-8', 'replace'),
+                getRetryAfter(response)
+            )
+        observeStage('sms_submit', 'sms', 'ok', startedAt)
+        log.debug("SMS gateway accepted %d messages", count)
+        # the messages are accepted whatever the body says, a body that
+        # can't be read must not get them sent again
+        try:
+            result = response.json()
+        except ValueError:
+            log.debug("SMS gateway response body is not json: %r", response.body[:200])
+            return {}
+        return result if isinstance(result, dict) else {}
+
+    def _getMessage(self, sms):
+        message = {
+            'reference': str(sms.alertID),
+            'from': sms.sender,
+            'to': sms.receiver,
+            'text': getSMSText(sms.body)
+        }
+        if self._callbackUrl:
+            message['callbackUrl'] = self._callbackUrl
+        return message
+
+
+def getRetryAfter(response):
+    if response.status not in (429, 503):
+        return None
+    try:
+        return max(0.0, float(response.headers.get('retry-after', 1)))
+    except ValueError:
+        # the http date form, not worth parsing for a retry hint
+        return 1.0
+
+
+def getSMSText(body):
+    if isinstance(body, str):
+        return body
+    if isinstance(body, bytes):
+        return body.decode('utf-8')
+    return json.dumps(body, ensure_ascii=False)
+
+
+# Messages the gateway accepted, by gateway message id, until their delivery
+# receipt arrives. Bounded, receipts that never come only ever hold the
+# oldest entries which are evicted first.
+class DeliveryReceipts(object):
+    def __init__(self, maxPending=100000):
+        self._maxPending = maxPending
+        self._pending = OrderedDict()
+
+    def track(self, messageID, alertID):
+        if messageID is None:
+            return
+        self._pending[str(messageID)] = (alertID, perf_counter())
+        while len(self._pending) > self._maxPending:
+            self._pending.popitem(last=False)
+
+    def onReceipt(self, receipt):
+        status = str(receipt.get('status', 'unknown')).lower()
+        SMS_RECEIPTS.labels(status).inc()
+        tracked = self._pending.pop(str(receipt.get('id')), None)
+        if tracked is None:
+            # sent by another worker, or before this one started
+            return
+        alertID, acceptedAt = tracked
+        observeStage('sms_delivery', 'sms', status, acceptedAt)
+        if status != 'delivered':
+            log.error("SMS: %s not delivered: { status: %s, error: %s }",
+                alertID, status, receipt.get('error', ''))
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class ReceiptRequestError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+# Takes the delivery receipts the gateway posts, a receipt or a list of them,
+# to the callback url. With a token set, a request has to carry it either as
+# a bearer token or as the token query parameter of the callback url, since
+# most gateways can't add headers to their callbacks. Requests have to arrive
+# within readTimeout seconds and bodies are capped at maxBodyBytes.
+async def startReceiptServer(receipts, host='127.0.0.1', port=9200, token=None,
+        readTimeout=10.0, maxBodyBytes=1048576):
+    async def handle(reader, writer):
+        try:
+            method, target, headers, body = await asyncio.wait_for(
+                readReceiptRequest(reader, maxBodyBytes), readTimeout
+            )
+            if method != 'POST':
+                raise ReceiptRequestError('405 Method Not Allowed')
+            if token and not hasReceiptToken(target, headers, token):
+                raise ReceiptRequestError('401 Unauthorized')
+            payload = json.loads(body.decode('utf-8'))
+            for receipt in payload if isinstance(payload, list) else [payload]:
+                receipts.onReceipt(receipt)
+            status = '204 No Content'
+        except ReceiptRequestError as exc:
+            log.debug("SMS receipt endpoint refused request: %s", exc.status)
+            status = exc.status
+        except asyncio.TimeoutError:
+            log.debug("SMS receipt endpoint timed out reading a request")
+            status = '408 Request Timeout'
+        except Exception as exc:
+            log.error("SMS receipt endpoint raised exception: %s", exc)
+            status = '400 Bad Request'
+        try:
+            writer.write('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.format(
+                status).encode('latin-1'))
+            await writer.drain()
+        except Exception as exc:
+            log.debug("SMS receipt endpoint could not respond: %s", exc)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log.info("SMS receipt endpoint listening on %s:%s", host, port)
+    return server
+
+
+async def readReceiptRequest(reader, maxBodyBytes):
+    requestLine = await reader.readline()
+    parts = requestLine.decode('latin-1').split()
+    if len(parts) < 2:
+        raise ReceiptRequestError('400 Bad Request')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n'):
+            break
+        if not line:
+            raise ReceiptRequestError('400 Bad Request')
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        raise ReceiptRequestError('411 Length Required')
+    contentLength = int(headers.get('content-length', 0))
+    if contentLength < 0:
+        raise ReceiptRequestError('400 Bad Request')
+    if contentLength > maxBodyBytes:
+        raise ReceiptRequestError('413 Payload Too Large')
+    body = await reader.readexactly(contentLength)
+    return parts[0], parts[1], headers, body
+
+
+def hasReceiptToken(target, headers, token):
+    token = token.encode('utf-8')
+    scheme, _, credentials = headers.get('authorization', '').partition(' ')
+    if scheme.lower() == 'bearer':
+        return hmac.compare_digest(credentials.strip().encode('utf-8'), token)
+    sent = parse_qs(urlsplit(target).query).get('token', [''])[0]
+    return hmac.compare_digest(sent.encode('utf-8'), token)
+
+
+# Stands in for a gateway when SMS_GATEWAY_URL isn't configured, eg: local
+# development, only logs the sms after a sleep.
+class SimulatedSMSSender(AlertSender):
     def __init__(self, config):
         self._config = config
-    
+
     async def send(self, sms):
         # mimic sending email
-        log.info("Sending Sms {{ from: {}, to: {} }}".format(
-            sms.sender, sms.receiver))
+        log.info("Sending Sms { from: %s, to: %s }", sms.sender, sms.receiver)
         # sleep randomly for 1-2 sec to mimic actual sms sending
         await sleep(random.uniform(1, 2))
-        
+
         log.info("Sms sent successfully")
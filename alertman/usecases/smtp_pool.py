@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import deque
+from time import perf_counter
+
+import aiosmtplib
+
+from alertman.log import getCustomLogger
+from alertman.metrics import observeStage
+
+
+log = getCustomLogger(__name__)
+
+
+class SMTPSession(object):
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messagesSent = 0
+        self.lastUsed = time.monotonic()
+
+    def __repr__(self):
+        return '{{ SMTPSession: {{ messagesSent: {0}, lastUsed: {1} }} }}'.format(
+            self.messagesSent, self.lastUsed)
+
+
+# Bounded pool of connected and logged in smtp sessions. Every borrower gets
+# a session of its own, so parallel sends never share a connection, but the
+# tcp + tls + auth handshake is paid once per session instead of per email.
+class SMTPConnectionPool(object):
+    def __init__(self, config, loop, maxSize=4, idleTimeout=60.0,
+            maxMessagesPerSession=100, healthcheckInterval=5.0):
+        self._config = config
+        self._loop = loop
+        self._maxSize = maxSize
+        self._idleTimeout = idleTimeout
+        self._maxMessagesPerSession = maxMessagesPerSession
+        self._healthcheckInterval = healthcheckInterval
+        self._idle = deque()
+        self._slots = asyncio.Semaphore(maxSize)
+        self._closed = False
+
+    def session(self):
+        return _PooledSession(self)
+
+    async def acquire(self):
+        if self._closed:
+            raise Exception("SMTPConnectionPool is closed")
+        await self._slots.acquire()
+        try:
+            session = await self._getIdleSession()
+            if not session:
+                session = await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+        return session
+
+    async def release(self, session, discard=False):
+        try:
+            session.lastUsed = time.monotonic()
+            if (discard or self._closed or
+                    session.messagesSent >= self._maxMessagesPerSession):
+                await self._disconnect(session)
+            else:
+                self._idle.append(session)
+        finally:
+            self._slots.release()
+
+    async def close(self):
+        self._closed = True
+        while self._idle:
+            await self._disconnect(self._idle.popleft())
+        log.info("SMTPConnectionPool closed")
+
+    @property
+    def idleSize(self):
+        return len(self._idle)
+
+    #---------------------------------------#
+    #           Private Methods             #
+    #---------------------------------------#
+
+    async def _getIdleSession(self):
+        # most recently used sessions are at the right end, so stale ones
+        # accumulate on the left and get evicted there
+        now = time.monotonic()
+        while self._idle and now - self._idle[0].lastUsed > self._idleTimeout:
+            await self._disconnect(self._idle.popleft())
+
+        while self._idle:
+            session = self._idle.pop()
+            if await self._isHealthy(session, now):
+                return session
+            await self._disconnect(session)
+        return None
+
+    async def _isHealthy(self, session, now):
+        if not session.smtp.is_connected:
+            return False
+        if now - session.lastUsed < self._healthcheckInterval:
+            return True
+        try:
+            await session.smtp.noop()
+        except Exception as exc:
+            log.info("SMTP session failed NOOP health check: %s", exc)
+            return False
+        return True
+
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(
+            hostname=self._config['SMTP_HOSTNAME'], port=self._config['SMTP_PORT'],
+            use_tls=self._config['SMTP_USE_TLS']
+        )
+        startedAt = perf_counter()
+        try:
+            await smtp.connect()
+            await smtp.login(self._config['SMTP_USERNAME'], self._config['SMTP_PASSWORD'])
+        except Exception as exc:
+            observeStage('smtp_connect', 'email', 'error', startedAt)
+            log.error("SMTPConnectionPool could not open session: exc: %s", exc)
+            smtp.close()
+            raise exc
+        observeStage('smtp_connect', 'email', 'ok', startedAt)
+        return SMTPSession(smtp)
+
+    async def _disconnect(self, session):
+        try:
+            if session.smtp.is_connected:
+                await session.smtp.quit()
+        except Exception as exc:
+            log.debug("SMTP quit raised exception: %s", exc)
+            session.smtp.close()
+
+
+class _PooledSession(object):
+    def __init__(self, pool):
+        self._pool = pool
+        self._session = None
+
+    async def __aenter__(self):
+        self._session = await self._pool.acquire()
+        return self._session
+
+    async def __aexit__(self, excType, exc, tb):
+        # a session that failed mid transaction is in an unknown protocol
+        # state, never hand it to the next borrower
+        await self._pool.release(self._session, discard=excType is not None)
+        return False
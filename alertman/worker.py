@@ -1,34 +1,94 @@
+import argparse
 import asyncio
+import inspect
 import os
-import json
+import signal
+import time
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from time import perf_counter
 
 from alertman.log import getCustomLogger
-from rabbitmq_client import AioPikaClient
+from alertman.alert_pipeline import AlertJob, buildAlertPipeline
+from alertman.consumer import (
+    AckBatcher, AdaptivePrefetch, BoundedConsumer, ConsumerBackpressure,
+    ConsumerGroup, logConsumerStats
+)
+from alertman.supervisor import WorkerSupervisor
+from alertman.message_codecs import decodeMessageBody
+from alertman.metrics import (
+    ALERTS_PROCESSED, IN_FLIGHT, OUTBOX_PENDING, PIPELINE_QUEUE_DEPTH,
+    QUEUE_LAG, observeStage, startMetricsServer
+)
+from alertman.routing import AlertRouter
+from alertman.domain.ids import configureIDGenerator
+from alertman.retry import RetryPolicy, getBackoffDelays, getRetryAlertTypes
+from alertman.rabbitmq_client import AioPikaClient
 from alertman.usecases.process_alert import (
     AlertRequest, AlertProcessor,
-    EmailAlertValidator, SMSAlertValidator
+    EmailAlertValidator, SMSAlertValidator,
+    AlertDeduplicator, InMemoryDedupBackend, SQLiteDedupBackend
 )
-from alertman.usecases.send_email import EmailSender
-from alertman.usecases.send_sms import SMSSender
+from alertman.usecases.send_email import EmailSender, configureRenderCache
+from alertman.usecases.digest_email import DigestEmailSender
+from alertman.usecases.outbox import OutboxSender, OutboxSpool
+from alertman.usecases.circuit_breaker import CircuitBreaker, CircuitBreakerSender
+from alertman.usecases.rate_limit import RateLimiter, RateLimitedSender
+from alertman.usecases.send_sms import SMSSender, SimulatedSMSSender, startReceiptServer
 
 
 log = getCustomLogger(__name__)
 usecases = {}
 
+ALERTS_QUEUE = 'dummy_alerts_queue'
+ALERTS_BINDING_KEY = 'dummy-alerts'
 
-async def startConsuming(app, on_message_function):
+
+async def startConsuming(app, on_message_function, prefetchCount=1,
+        queue=ALERTS_QUEUE, bindingKey=ALERTS_BINDING_KEY, maxPriority=0):
     options = {
-        'set_qos': 1,
+        'set_qos': prefetchCount,
         'exchangeType': 'topic',
         'queueDurable': True,
-        'bindingKey': 'dummy-alerts',
-        'deliverMode': 'persistent'
+        'bindingKey': bindingKey,
+        'deliverMode': 'persistent',
+        'maxPriority': maxPriority
     }
 
     await app.consume(
-        'dummy_alerts_queue', 'dummy-exchange', 
+        queue, 'dummy-exchange', 
         on_message_function, options
     )
+
+
+def getAlertLanes(config):
+    # WORKER_LANES is a comma separated list of name:queue:bindingKey:share,
+    # eg: critical:critical_alerts_queue:dummy-alerts.critical:0.3, without
+    # it the worker consumes the single default lane
+    lanes = []
+    for laneSpec in config['WORKER_LANES'].split(','):
+        if not laneSpec.strip():
+            continue
+        name, queue, bindingKey, share = laneSpec.strip().split(':')
+        lanes.append({
+            'name': name, 'queue': queue,
+            'bindingKey': bindingKey, 'share': float(share)
+        })
+    if not lanes:
+        lanes.append({
+            'name': 'default', 'queue': ALERTS_QUEUE,
+            'bindingKey': ALERTS_BINDING_KEY, 'share': 1.0
+        })
+    return lanes
+
+
+def getLaneLimits(lane, lanes, config):
+    # every lane reserves its share of the in flight slots and the prefetch
+    fraction = lane['share'] / sum(otherLane['share'] for otherLane in lanes)
+    maxInFlight = max(1, int(round(config['WORKER_MAX_IN_FLIGHT'] * fraction)))
+    prefetchCount = max(1, int(round(config['WORKER_PREFETCH_COUNT'] * fraction)))
+    return maxInFlight, prefetchCount
         
 
 async def setupMessageBroker(loop, config):
@@ -38,115 +98,509 @@ async def setupMessageBroker(loop, config):
         host=config['MESSAGE_BROKER_SERVICE_HOST'],
         port=config['MESSAGE_BROKER_SERVICE_PORT'],
         virtualhoat=config['MESSAGE_BROKER_SERVICE_VIRTUALHOST'],
-        loop=loop
+        loop=loop,
+        publishChannels=config['MESSAGE_BROKER_PUBLISH_CHANNELS']
     )
-    # setup the connection and channel that will be used across the app
+    # setup the connection, consume and publish channels are opened on use
     log.info("Setting up Message Broker...")
     await client.setup()
     return client
 
 
-def setupUseCaseDependencies(loop, config):
+def setupUseCaseDependencies(loop, config, backpressure=None, workerIndex=0):
     global usecases
-    emailAlertSender = EmailSender(config, loop)
+    configureRenderCache(config['EMAIL_RENDER_CACHE_BYTES'])
+    emailAlertSender = getRateLimitedSender(
+        EmailSender(config, loop), config, 'EMAIL', backpressure
+    )
+    emailAlertSender = getDigestEmailSender(emailAlertSender, config, loop)
+    emailAlertSender = getCircuitBreakerSender(emailAlertSender, config, 'email')
+    emailAlertSender = getOutboxSender(emailAlertSender, config, 'email', workerIndex)
     emailAlertValidator = EmailAlertValidator()
     
-    smsAlertSender = SMSSender(config)
+    smsAlertSender = getRateLimitedSender(
+        getSMSSender(config, loop, workerIndex), config, 'SMS', backpressure
+    )
+    smsAlertSender = getCircuitBreakerSender(smsAlertSender, config, 'sms')
+    smsAlertSender = getOutboxSender(smsAlertSender, config, 'sms', workerIndex)
     smsAlertValidator = SMSAlertValidator()
 
-    emailAlertProcessor = AlertProcessor(emailAlertSender, emailAlertValidator)
-    smsAlertProcessor = AlertProcessor(smsAlertSender, smsAlertValidator)
+    deduplicator = getAlertDeduplicator(config)
+    usecases['deduplicator'] = deduplicator
+    emailAlertProcessor = AlertProcessor(
+        emailAlertSender, emailAlertValidator, deduplicator
+    )
+    smsAlertProcessor = AlertProcessor(
+        smsAlertSender, smsAlertValidator, deduplicator
+    )
     
-    usecases['emailAlertProcessor'] = emailAlertProcessor
-    usecases['smsAlertProcessor'] = smsAlertProcessor
+    usecases['alertProcessors'] = {
+        'email': emailAlertProcessor,
+        'sms': smsAlertProcessor
+    }
+    # the outermost senders, closing them closes the ones they wrap
+    usecases['alertSenders'] = [emailAlertSender, smsAlertSender]
+    usecases['alertRouter'] = getAlertRouter(config)
+
+
+def getSMSSender(config, loop, workerIndex=0):
+    global usecases
+    if not config['SMS_GATEWAY_URL']:
+        log.warning("SMS_GATEWAY_URL not set, sms are only simulated")
+        return SimulatedSMSSender(config)
+    callbackUrl = None
+    if config['SMS_RECEIPT_CALLBACK_URL']:
+        # every forked worker receives its receipts on SMS_RECEIPT_PORT + index
+        callbackUrl = config['SMS_RECEIPT_CALLBACK_URL'].format(
+            port=config['SMS_RECEIPT_PORT'] + workerIndex,
+            token=config['SMS_RECEIPT_TOKEN']
+        )
+    smsSender = SMSSender(config, loop, callbackUrl)
+    usecases['smsSender'] = smsSender
+    return smsSender
+
+
+def getDigestEmailSender(alertSender, config, loop):
+    if not config['EMAIL_DIGEST_ENABLED'] or config['EMAIL_DIGEST_WINDOW'] <= 0:
+        return alertSender
+    # deliveries wait for their digest before being acked, so the in flight
+    # limit caps how many alerts a single digest can hold. With one alert in
+    # flight nothing ever coalesces and every alert just waits the window
+    lanes = getAlertLanes(config)
+    maxInFlight = min(getLaneLimits(lane, lanes, config)[0] for lane in lanes)
+    if maxInFlight <= 1:
+        log.warning("EMAIL_DIGEST_ENABLED needs more than one alert in flight per lane, "
+            "raise WORKER_MAX_IN_FLIGHT, email digests are disabled")
+        return alertSender
+    return DigestEmailSender(
+        alertSender, loop,
+        window=config['EMAIL_DIGEST_WINDOW'],
+        maxAlerts=config['EMAIL_DIGEST_MAX_ALERTS']
+    )
+
+
+def getCircuitBreakerSender(alertSender, config, channel):
+    if not config['CIRCUIT_BREAKER_ENABLED']:
+        return alertSender
+    # outside of digests and rate limits, so that rejecting is immediate
+    breaker = CircuitBreaker(
+        channel,
+        failureThreshold=config['CIRCUIT_BREAKER_FAILURE_THRESHOLD'],
+        resetTimeout=config['CIRCUIT_BREAKER_RESET_TIMEOUT'],
+        halfOpenMaxProbes=config['CIRCUIT_BREAKER_HALF_OPEN_PROBES'],
+        successThreshold=config['CIRCUIT_BREAKER_SUCCESS_THRESHOLD']
+    )
+    return CircuitBreakerSender(alertSender, breaker)
+
+
+def getOutboxSender(alertSender, config, channel, workerIndex):
+    global usecases
+    if not config['OUTBOX_ENABLED']:
+        return alertSender
+    # every worker process spools every channel to a directory of its own,
+    # a restarted worker with the same index picks its spool up again
+    spool = OutboxSpool(
+        os.path.join(config['OUTBOX_DIR'], str(workerIndex), channel),
+        segmentBytes=config['OUTBOX_SEGMENT_BYTES'],
+        fsyncInterval=config['OUTBOX_FSYNC_INTERVAL']
+    )
+    spool.open()
+    outboxSender = OutboxSender(
+        alertSender, spool,
+        concurrency=config['OUTBOX_DRAIN_CONCURRENCY'],
+        baseDelay=config['OUTBOX_RETRY_BASE_DELAY'],
+        maxDelay=config['OUTBOX_RETRY_MAX_DELAY'],
+        maxAttempts=config['OUTBOX_MAX_ATTEMPTS'],
+        maxDeferrals=config['OUTBOX_MAX_DEFERRALS']
+    )
+    outboxSender.start()
+    OUTBOX_PENDING.labels(channel).setFunction(lambda: outboxSender.pendingCount)
+    usecases.setdefault('outboxSenders', []).append(outboxSender)
+    return outboxSender
 
-    # add the email alerting for transction configs
-    usecases['emailSender'] = config['TRANSACTION_FRAUD_EMAIL_ALERT_FROM']
-    usecases['emailReceiver'] = config['TRANSACTION_FRAUD_EMAIL_ALERT_TO']
-    usecases['emailSubject'] = config['TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT']
 
-    # add alerting configs fro sms transaction fraud
-    usecases['smsSender'] = '10101010'
-    usecases['smsReceiver'] = '010010101'
+def getAlertRouter(config):
+    # the transaction fraud receivers stay the defaults, rules from the
+    # rules file route anything more specific
+    defaultRules = [
+        {
+            'match': {'alertType': 'email'},
+            'channel': 'email',
+            'sender': config['TRANSACTION_FRAUD_EMAIL_ALERT_FROM'],
+            'receivers': [config['TRANSACTION_FRAUD_EMAIL_ALERT_TO']],
+            'subject': config['TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT']
+        },
+        {
+            'match': {'alertType': 'sms'},
+            'channel': 'sms',
+            'sender': '10101010',
+            'receivers': ['010010101']
+        }
+    ]
+    return AlertRouter(
+        defaultRules, config['ROUTING_RULES_PATH'] or None,
+        config['ROUTING_RELOAD_INTERVAL']
+    )
+
+
+def getRateLimitedSender(alertSender, config, channel, backpressure):
+    rate = config['RATE_LIMIT_{}_RATE'.format(channel)]
+    domainRate = config['RATE_LIMIT_{}_DOMAIN_RATE'.format(channel)]
+    if rate <= 0 and domainRate <= 0:
+        return alertSender
+    limiter = RateLimiter(
+        rate=rate, burst=config['RATE_LIMIT_{}_BURST'.format(channel)],
+        domainRate=domainRate,
+        domainBurst=config['RATE_LIMIT_{}_DOMAIN_BURST'.format(channel)]
+    )
+    return RateLimitedSender(alertSender, limiter, backpressure)
+
+
+def getAlertDeduplicator(config):
+    if not config['DEDUP_ENABLED']:
+        return None
+    if config['DEDUP_BACKEND'] == 'sqlite':
+        backend = SQLiteDedupBackend(
+            config['DEDUP_SQLITE_PATH'], ttl=config['DEDUP_TTL'],
+            sweepInterval=config['DEDUP_SWEEP_INTERVAL'],
+            pendingTtl=config['DEDUP_PENDING_TTL']
+        )
+    else:
+        backend = InMemoryDedupBackend(
+            ttl=config['DEDUP_TTL'], maxEntries=config['DEDUP_MAX_ENTRIES'],
+            pendingTtl=config['DEDUP_PENDING_TTL']
+        )
+    return AlertDeduplicator(backend)
 
 
-async def setupApp(loop, config):
+async def setupRetryPolicy(app, config):
+    global usecases
+    usecases['retryPolicy'] = None
+    usecases['retryPolicies'] = {}
+    if not config['RETRY_ENABLED']:
+        return
+    delays = getBackoffDelays(
+        config['RETRY_BASE_DELAY_MS'], config['RETRY_BACKOFF_FACTOR'],
+        config['RETRY_TIERS'], config['RETRY_MAX_DELAY_MS']
+    )
+    # retried alerts have to come back to the lane they were consumed from
+    for lane in getAlertLanes(config):
+        retryPolicy = RetryPolicy(
+            app, lane['queue'], delays, config['RETRY_MAX_ATTEMPTS'],
+            config['RETRY_MAX_DEFERRALS']
+        )
+        await retryPolicy.setup()
+        usecases['retryPolicies'][lane['queue']] = retryPolicy
+        if usecases['retryPolicy'] is None:
+            usecases['retryPolicy'] = retryPolicy
+
+
+async def setupApp(loop, config, workerIndex=0):
+    # alert ids are unique per node id, one per worker process
+    configureIDGenerator(config['ALERT_ID_NODE_OFFSET'] + workerIndex)
     app = await setupMessageBroker(loop, config)
-    setupUseCaseDependencies(loop, config)
+    # throttled senders lower the prefetch instead of piling up coroutines
+    backpressure = ConsumerBackpressure(
+        app, config['WORKER_PREFETCH_COUNT'],
+        config['RATE_LIMIT_THROTTLED_PREFETCH_COUNT']
+    )
+    usecases['consumerBackpressure'] = backpressure
+    setupUseCaseDependencies(loop, config, backpressure, workerIndex)
+    await setupRetryPolicy(app, config)
     return app
 
 
-async def startWorker(loop, config):
+def setupAlertPipeline(config):
+    global usecases
+    executor = None
+    if config['PIPELINE_EXECUTOR'] == 'thread':
+        executor = ThreadPoolExecutor(config['PIPELINE_EXECUTOR_WORKERS'])
+    elif config['PIPELINE_EXECUTOR'] == 'process':
+        executor = ProcessPoolExecutor(config['PIPELINE_EXECUTOR_WORKERS'])
+    workers = dict(
+        (stage, config['PIPELINE_{}_WORKERS'.format(stage.upper())])
+        for stage in ('decode', 'prepare', 'render', 'send')
+    )
+    pipeline = buildAlertPipeline(
+        routeAlert, workers,
+        queueSize=config['PIPELINE_QUEUE_SIZE'], executor=executor,
+        offloadMinBytes=config['PIPELINE_OFFLOAD_MIN_BYTES']
+    )
+    for stage in pipeline.stages:
+        PIPELINE_QUEUE_DEPTH.labels(stage.name).setFunction(
+            lambda stage=stage: stage.depth
+        )
+    pipeline.start()
+    usecases['alertPipeline'] = pipeline
+    return pipeline
+
+
+async def startWorker(loop, config, statsQueue=None, workerIndex=0):
     # setup the app
-    app = await setupApp(loop, config)
-    # start consuming via the alerts_consumer
-    await startConsuming(app, alerts_consumer)
+    app = await setupApp(loop, config, workerIndex)
+    on_message = alerts_consumer
+    pipeline = None
+    if config['PIPELINE_ENABLED']:
+        pipeline = setupAlertPipeline(config)
+        on_message = pipeline_alerts_consumer
+    # bound the number of alerts processed concurrently per lane, the acks
+    # of every lane are batched on its own channel
+    lanes = getAlertLanes(config)
+    laneConsumers = {}
+    usecases['ackBatchers'] = []
+    for lane in lanes:
+        maxInFlight, prefetchCount = getLaneLimits(lane, lanes, config)
+        laneConsumers[lane['name']] = BoundedConsumer(
+            partial(on_message, retryPolicy=usecases['retryPolicies'].get(lane['queue'])),
+            maxInFlight=maxInFlight,
+            ackBatcher=getAckBatcher(config, prefetchCount)
+        )
+    consumer = ConsumerGroup(laneConsumers)
+    IN_FLIGHT.labels().setFunction(lambda: consumer.inFlight)
+    if config['METRICS_PORT']:
+        # every forked worker serves its own metrics on METRICS_PORT + index
+        await startMetricsServer(
+            config['METRICS_HOST'], config['METRICS_PORT'] + workerIndex,
+            readTimeout=config['METRICS_READ_TIMEOUT']
+        )
+    asyncio.ensure_future(
+        logConsumerStats(
+            consumer, config['WORKER_STATS_INTERVAL'], statsQueue, workerIndex,
+            pipeline
+        )
+    )
+    if config['SMS_RECEIPT_PORT'] and usecases.get('smsSender'):
+        usecases['receiptServer'] = await startReceiptServer(
+            usecases['smsSender'].receipts, config['SMS_RECEIPT_HOST'],
+            config['SMS_RECEIPT_PORT'] + workerIndex,
+            token=config['SMS_RECEIPT_TOKEN'],
+            readTimeout=config['SMS_RECEIPT_READ_TIMEOUT'],
+            maxBodyBytes=config['SMS_RECEIPT_MAX_BODY_BYTES']
+        )
+    if config['ROUTING_RULES_PATH']:
+        asyncio.ensure_future(usecases['alertRouter'].watch())
+    if config['WORKER_ADAPTIVE_PREFETCH']:
+        asyncio.ensure_future(getAdaptivePrefetch(config, consumer).run())
+    # start consuming every lane via the alerts_consumer
+    for lane in lanes:
+        _, prefetchCount = getLaneLimits(lane, lanes, config)
+        await startConsuming(
+            app, laneConsumers[lane['name']], prefetchCount,
+            lane['queue'], lane['bindingKey'], config['WORKER_QUEUE_MAX_PRIORITY']
+        )
+    return app
+
+
+def getAckBatcher(config, prefetchCount):
+    global usecases
+    if config['WORKER_ACK_BATCH_SIZE'] <= 1:
+        return None
+    # a batch never holds more than half the prefetch window, otherwise the
+    # broker would stop delivering while the batch fills up
+    ackBatcher = AckBatcher(
+        min(config['WORKER_ACK_BATCH_SIZE'], max(1, prefetchCount // 2)),
+        config['WORKER_ACK_FLUSH_INTERVAL']
+    )
+    usecases['ackBatchers'].append(ackBatcher)
+    return ackBatcher
+
+
+def getAdaptivePrefetch(config, consumer):
+    return AdaptivePrefetch(
+        usecases['consumerBackpressure'], consumer,
+        minPrefetch=config['WORKER_PREFETCH_MIN'],
+        maxPrefetch=config['WORKER_PREFETCH_MAX'],
+        interval=config['WORKER_PREFETCH_ADJUST_INTERVAL'],
+        headroom=config['WORKER_PREFETCH_HEADROOM']
+    )
+
+
+async def stopWorker(app):
+    # no more receipts, the ones of sms still in flight are lost either way
+    if usecases.get('receiptServer') is not None:
+        usecases['receiptServer'].close()
+        await usecases['receiptServer'].wait_closed()
+    # send the acks still waiting in a batch before the connection goes away
+    for ackBatcher in usecases.get('ackBatchers', []):
+        await ackBatcher.close()
+    # flush digests and batches and close the smtp and http pools, whatever
+    # the outbox didn't send yet stays spooled for the next start
+    for alertSender in usecases.get('alertSenders', []):
+        if hasattr(alertSender, 'close'):
+            await alertSender.close()
+    if usecases.get('deduplicator') is not None:
+        await usecases['deduplicator'].close()
+    await app.close()
+
+
+def runWorkerProcess(config, workerIndex=0, statsQueue=None):
+    # every worker process owns its event loop and its broker connection
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    worker = asyncio.ensure_future(
+        startWorker(loop, config, statsQueue, workerIndex), loop=loop
+    )
+    try:
+        loop.run_forever()
+    except Exception as exc:
+        log.error("Exception occured: {}".format(exc))
+    finally:
+        if worker.done() and not worker.cancelled() and not worker.exception():
+            loop.run_until_complete(stopWorker(worker.result()))
+        loop.close()
     
 
-async def alerts_consumer(message):
+async def alerts_consumer(message, retryPolicy=None):
+    retryPolicy = retryPolicy or usecases.get('retryPolicy')
+    recordQueueLag(message)
+    startedAt = perf_counter()
     try:
-        # read raw bytes data from message.body and decode it to unicode
-        messageContent = message.body.decode('utf-8')
-        # convert str to python dictionary
-        messageObj = json.loads(messageContent)
+        # decode the raw bytes of message.body straight into a python
+        # dictionary with the codec matching the message content type
+        messageObj = decodeMessageBody(message.body, message.content_type)
         # the real message is in the field 'message'
         messageContent = messageObj['message']
-        # read the alertTypes, eg: ['sms', 'email']
-        alertTypes = messageContent['alertTypes']
-        # create coroutine tasks(futures) to exectute in asyncrhronously concurrently
-        # since there can be multipel alerts required
-        tasks = [processAlert(alertType, messageContent) for alertType in alertTypes]
-        # wait for the tasks to complete
-        await asyncio.wait(tasks)
-    
+        # read the alertTypes, eg: ['sms', 'email'], a retried message only
+        # carries the alert types which failed in the previous attempt
+        alertTypes = getRetryAlertTypes(message) or messageContent['alertTypes']
     except Exception as exc:
-        log.error("Exception while waiting for tasks: {}".format(exc))
+        observeStage('decode', 'unknown', 'error', startedAt)
+        log.error("Exception while decoding alert message: %s", exc)
+        # retrying can never fix a malformed message, park it right away
+        await parkOrAck(message, exc, retryPolicy)
+        return
+    observeStage('decode', 'unknown', 'ok', startedAt)
+
+    # create coroutine tasks(futures) to exectute in asyncrhronously concurrently
+    # since there can be multipel alerts required
+    tasks = [
+        processAlert(alertType, messageContent, message.routing_key)
+        for alertType in alertTypes
+    ]
+    # wait for the tasks to complete, one failing alert type must not
+    # cancel or hide the result of the others
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await settleAlertMessage(message, list(zip(alertTypes, results)), retryPolicy)
+
+
+async def pipeline_alerts_consumer(message, retryPolicy=None):
+    # same outcome as alerts_consumer, but every step runs in the stages of
+    # the alert pipeline, this only waits for the job to come out of it
+    retryPolicy = retryPolicy or usecases.get('retryPolicy')
+    recordQueueLag(message)
+    job = AlertJob(message)
+    await usecases['alertPipeline'].submit(job)
+    await job.done
+    if job.decodeError is not None:
+        log.error("Exception while decoding alert message: %s", job.decodeError)
+        await parkOrAck(message, job.decodeError, retryPolicy)
+        return
+    await settleAlertMessage(message, [
+        (alertType, job.results.get(alertType)) for alertType in job.alertTypes
+    ], retryPolicy)
+
+
+async def settleAlertMessage(message, results, retryPolicy=None):
+    failedAlertTypes = []
+    reason = None
+    for alertType, result in results:
+        if isinstance(result, Exception):
+            log.error("Exception while processing %s alert: %s", alertType, result)
+            failedAlertTypes.append(alertType)
+            reason = result
+            ALERTS_PROCESSED.labels(alertType, 'error').inc()
+        else:
+            ALERTS_PROCESSED.labels(alertType, 'ok').inc()
+
+    if failedAlertTypes and retryPolicy:
+        try:
+            await retryPolicy.retry(message, failedAlertTypes, reason)
+        except Exception as exc:
+            # could not schedule the retry, let the broker redeliver it
+            log.error("Exception while scheduling alert retry: %s", exc)
+            await settleMessage(message.reject(requeue=True))
+            return
     # snnd consumer message acknowledgement so that the message can be removed
     # from the rabbitmq queueu
-    message.ack()
+    await settleMessage(message.ack())
+
+
+def recordQueueLag(message):
+    # only set when the publisher stamped the message with its send time
+    timestamp = message.timestamp
+    if timestamp is None:
+        return
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.timestamp()
+    QUEUE_LAG.labels().set(max(0.0, time.time() - timestamp))
+
 
+async def parkOrAck(message, reason, retryPolicy=None):
+    if retryPolicy:
+        try:
+            await retryPolicy.park(message, reason)
+        except Exception as exc:
+            log.error("Exception while parking alert: %s", exc)
+            await settleMessage(message.reject(requeue=True))
+            return
+    await settleMessage(message.ack())
 
-async def processAlert(alertType, alert):
-    alertRequest = getAlertRequest(alertType, alert)
-    alertProcessor = getAlertProcessor(alertType)
-    if alertProcessor:
-        await alertProcessor.process(alertRequest)
+
+async def settleMessage(result):
+    # ack, reject and nack are coroutines in aio_pika 10, older releases and
+    # the batched acks settle right away and return nothing to wait for
+    if inspect.isawaitable(result):
+        await result
+
+
+async def processAlert(alertType, alert, routingKey=''):
+    routedAlerts = routeAlert(alertType, alert, routingKey)
+    results = await asyncio.gather(*[
+        alertProcessor.process(alertRequest)
+        for alertProcessor, alertRequest in routedAlerts
+    ], return_exceptions=True)
+    # the alert type failed if the alert of any of its receivers failed
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def routeAlert(alertType, alert, routingKey=''):
+    # returns an (alertProcessor, alertRequest) pair for every receiver
+    route = usecases['alertRouter'].route(
+        routingKey, alertType, alert.get('source'), alert.get('severity')
+    )
+    if route is None:
+        log.error("No route for alert type: %s, routing key: %s", alertType, routingKey)
+        return []
+    alertProcessor = getAlertProcessor(route.channel)
+    if alertProcessor is None:
+        return []
+    body = route.getBody(alert)
+    return [
+        (alertProcessor, getAlertRequest(route, receiver, body))
+        for receiver in route.receivers
+    ]
 
 
-def getAlertRequest(alertType, alert):
+def getAlertRequest(route, receiver, body):
     alertReq = AlertRequest(
-        alertMessage=getAlertMessage(alertType, alert),
-        alertType=alertType
+        alertMessage={
+            'sender': route.sender,
+            'receiver': receiver,
+            'subject': route.subject,
+            'body': body
+        },
+        alertType=route.channel
     )
     return alertReq
 
-def getAlertMessage(alertType, alert):
-    sender, receiver, subject = '', '', ''
-    if alertType == 'email':
-        sender = usecases['emailSender']
-        receiver = usecases['emailReceiver']
-        subject = usecases['emailSubject']
-    elif alertType == 'sms':
-        sender = usecases['smsSender']
-        receiver = usecases['smsReceiver']
-    
-    message = {
-        'sender': sender,
-        'receiver': receiver,
-        'subject': subject,
-        'body': alert['message']
-    }
-    return message
 
-def getAlertProcessor(alertType):
-    global usecases
-    alertProcessor = None
-    if alertType == 'email':
-        alertProcessor = usecases['emailAlertProcessor']
-    elif alertType == 'sms':
-        alertProcessor = usecases['smsAlertProcessor']
-    else:
-        log.error("Alert type: {} does not exist".format(alertType))
+def getAlertProcessor(channel):
+    alertProcessor = usecases['alertProcessors'].get(channel)
+    if alertProcessor is None:
+        log.error("Alert channel: %s does not exist", channel)
     return alertProcessor
 
 
@@ -158,32 +612,180 @@ def getConfigFromEnvironment():
         'MESSAGE_BROKER_SERVICE_HOST': os.getenv('MESSAGE_BROKER_SERVICE_HOST'),
         'MESSAGE_BROKER_SERVICE_PORT': int(int(os.getenv('MESSAGE_BROKER_SERVICE_PORT'))),
         'MESSAGE_BROKER_SERVICE_VIRTUALHOST': os.getenv('MESSAGE_BROKER_SERVICE_VIRTUALHOST'),
+        # size of the pool of channels used for publishing, every consumed
+        # queue gets a channel of its own on top of these
+        'MESSAGE_BROKER_PUBLISH_CHANNELS': int(os.getenv('MESSAGE_BROKER_PUBLISH_CHANNELS', 4)),
         
+        # worker concurrency configs, prefetch should be >= max in flight
+        'WORKER_PREFETCH_COUNT': int(os.getenv('WORKER_PREFETCH_COUNT', 1)),
+        'WORKER_MAX_IN_FLIGHT': int(os.getenv('WORKER_MAX_IN_FLIGHT', 1)),
+        'WORKER_STATS_INTERVAL': float(os.getenv('WORKER_STATS_INTERVAL', 30)),
+        # alert ids embed offset + worker index as node id, hosts sharing a
+        # dedup store or logs need offsets at least WORKER_PROCESSES apart
+        'ALERT_ID_NODE_OFFSET': int(os.getenv('ALERT_ID_NODE_OFFSET', 0)),
+        # acks are sent with multiple=True for up to this many deliveries, or
+        # after the flush interval in seconds, a size of 0 or 1 acks each one
+        'WORKER_ACK_BATCH_SIZE': int(os.getenv('WORKER_ACK_BATCH_SIZE', 100)),
+        'WORKER_ACK_FLUSH_INTERVAL': float(os.getenv('WORKER_ACK_FLUSH_INTERVAL', 0.05)),
+        # tune the prefetch from the observed send latency and rate, starting
+        # at WORKER_PREFETCH_COUNT and staying within min and max
+        'WORKER_ADAPTIVE_PREFETCH': os.getenv('WORKER_ADAPTIVE_PREFETCH', 'false').lower() in ('1', 'true', 'yes'),
+        'WORKER_PREFETCH_MIN': int(os.getenv('WORKER_PREFETCH_MIN', 1)),
+        'WORKER_PREFETCH_MAX': int(os.getenv('WORKER_PREFETCH_MAX', os.getenv('WORKER_PREFETCH_COUNT', 1))),
+        'WORKER_PREFETCH_ADJUST_INTERVAL': float(os.getenv('WORKER_PREFETCH_ADJUST_INTERVAL', 5)),
+        'WORKER_PREFETCH_HEADROOM': float(os.getenv('WORKER_PREFETCH_HEADROOM', 1.5)),
+        # priority lanes, see getAlertLanes, and the x-max-priority of their
+        # queues, 0 declares queues without priorities
+        'WORKER_LANES': os.getenv('WORKER_LANES', ''),
+        'WORKER_QUEUE_MAX_PRIORITY': int(os.getenv('WORKER_QUEUE_MAX_PRIORITY', 0)),
+
+        # staged pipeline configs, workers per stage and the executor used
+        # for decoding large bodies and rendering, none|thread|process
+        'PIPELINE_ENABLED': os.getenv('PIPELINE_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+        'PIPELINE_QUEUE_SIZE': int(os.getenv('PIPELINE_QUEUE_SIZE', 100)),
+        'PIPELINE_DECODE_WORKERS': int(os.getenv('PIPELINE_DECODE_WORKERS', 1)),
+        'PIPELINE_PREPARE_WORKERS': int(os.getenv('PIPELINE_PREPARE_WORKERS', 4)),
+        'PIPELINE_RENDER_WORKERS': int(os.getenv('PIPELINE_RENDER_WORKERS', 2)),
+        'PIPELINE_SEND_WORKERS': int(os.getenv('PIPELINE_SEND_WORKERS', 256)),
+        'PIPELINE_EXECUTOR': os.getenv('PIPELINE_EXECUTOR', 'none'),
+        'PIPELINE_EXECUTOR_WORKERS': int(os.getenv('PIPELINE_EXECUTOR_WORKERS', 2)),
+        'PIPELINE_OFFLOAD_MIN_BYTES': int(os.getenv('PIPELINE_OFFLOAD_MIN_BYTES', 65536)),
+
+        # prometheus metrics endpoint, port 0 disables it
+        'METRICS_HOST': os.getenv('METRICS_HOST', '0.0.0.0'),
+        'METRICS_PORT': int(os.getenv('METRICS_PORT', 0)),
+        'METRICS_READ_TIMEOUT': float(os.getenv('METRICS_READ_TIMEOUT', 10)),
+
+        # retry configs, failed alerts wait in per tier delay queues
+        'RETRY_ENABLED': os.getenv('RETRY_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+        'RETRY_MAX_ATTEMPTS': int(os.getenv('RETRY_MAX_ATTEMPTS', 5)),
+        # times an open circuit may push an alert back before it's parked
+        'RETRY_MAX_DEFERRALS': int(os.getenv('RETRY_MAX_DEFERRALS', 50)),
+        'RETRY_BASE_DELAY_MS': int(os.getenv('RETRY_BASE_DELAY_MS', 1000)),
+        'RETRY_BACKOFF_FACTOR': float(os.getenv('RETRY_BACKOFF_FACTOR', 5)),
+        'RETRY_TIERS': int(os.getenv('RETRY_TIERS', 4)),
+        'RETRY_MAX_DELAY_MS': int(os.getenv('RETRY_MAX_DELAY_MS', 300000)),
+
+        # dedup configs, drop alerts already sent within the ttl. Off unless
+        # asked for, the same alert may legitimately be published twice
+        'DEDUP_ENABLED': os.getenv('DEDUP_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+        'DEDUP_BACKEND': os.getenv('DEDUP_BACKEND', 'memory'),
+        'DEDUP_TTL': float(os.getenv('DEDUP_TTL', 3600)),
+        # how long a claimed alert may take to be sent before another
+        # delivery of it, eg: after a crash, takes the claim over
+        'DEDUP_PENDING_TTL': float(os.getenv('DEDUP_PENDING_TTL', 120)),
+        'DEDUP_MAX_ENTRIES': int(os.getenv('DEDUP_MAX_ENTRIES', 100000)),
+        'DEDUP_SQLITE_PATH': os.getenv('DEDUP_SQLITE_PATH', 'alertman-dedup.sqlite3'),
+        'DEDUP_SWEEP_INTERVAL': float(os.getenv('DEDUP_SWEEP_INTERVAL', 60)),
+
+        # rate limit configs, alerts per second per channel and per receiver
+        # domain, 0 disables the limit
+        'RATE_LIMIT_EMAIL_RATE': float(os.getenv('RATE_LIMIT_EMAIL_RATE', 0)),
+        'RATE_LIMIT_EMAIL_BURST': float(os.getenv('RATE_LIMIT_EMAIL_BURST', 0)),
+        'RATE_LIMIT_EMAIL_DOMAIN_RATE': float(os.getenv('RATE_LIMIT_EMAIL_DOMAIN_RATE', 0)),
+        'RATE_LIMIT_EMAIL_DOMAIN_BURST': float(os.getenv('RATE_LIMIT_EMAIL_DOMAIN_BURST', 0)),
+        'RATE_LIMIT_SMS_RATE': float(os.getenv('RATE_LIMIT_SMS_RATE', 0)),
+        'RATE_LIMIT_SMS_BURST': float(os.getenv('RATE_LIMIT_SMS_BURST', 0)),
+        'RATE_LIMIT_SMS_DOMAIN_RATE': float(os.getenv('RATE_LIMIT_SMS_DOMAIN_RATE', 0)),
+        'RATE_LIMIT_SMS_DOMAIN_BURST': float(os.getenv('RATE_LIMIT_SMS_DOMAIN_BURST', 0)),
+        'RATE_LIMIT_THROTTLED_PREFETCH_COUNT': int(os.getenv('RATE_LIMIT_THROTTLED_PREFETCH_COUNT', 1)),
+
+        # http sms gateway, sms are only simulated without a url. Requests in
+        # flight are capped by the pool size, sms arriving within the bulk
+        # window go out in one bulk submit, a window of 0 submits one by one
+        'SMS_GATEWAY_URL': os.getenv('SMS_GATEWAY_URL', ''),
+        'SMS_GATEWAY_API_KEY': os.getenv('SMS_GATEWAY_API_KEY', ''),
+        'SMS_GATEWAY_POOL_SIZE': int(os.getenv('SMS_GATEWAY_POOL_SIZE', 16)),
+        'SMS_GATEWAY_IDLE_TIMEOUT': float(os.getenv('SMS_GATEWAY_IDLE_TIMEOUT', 30)),
+        'SMS_GATEWAY_CONNECT_TIMEOUT': float(os.getenv('SMS_GATEWAY_CONNECT_TIMEOUT', 5)),
+        'SMS_GATEWAY_TIMEOUT': float(os.getenv('SMS_GATEWAY_TIMEOUT', 10)),
+        'SMS_BULK_WINDOW': float(os.getenv('SMS_BULK_WINDOW', 0.01)),
+        'SMS_BULK_MAX_MESSAGES': int(os.getenv('SMS_BULK_MAX_MESSAGES', 100)),
+        # delivery receipts endpoint, the callback url given to the gateway
+        # can use {port} for the port of the worker sending the sms and
+        # {token} for the token receipts have to carry when one is set
+        'SMS_RECEIPT_HOST': os.getenv('SMS_RECEIPT_HOST', '127.0.0.1'),
+        'SMS_RECEIPT_PORT': int(os.getenv('SMS_RECEIPT_PORT', 0)),
+        'SMS_RECEIPT_CALLBACK_URL': os.getenv('SMS_RECEIPT_CALLBACK_URL', ''),
+        'SMS_RECEIPT_TOKEN': os.getenv('SMS_RECEIPT_TOKEN', ''),
+        'SMS_RECEIPT_READ_TIMEOUT': float(os.getenv('SMS_RECEIPT_READ_TIMEOUT', 10)),
+        'SMS_RECEIPT_MAX_BODY_BYTES': int(os.getenv('SMS_RECEIPT_MAX_BODY_BYTES', 1048576)),
+        'SMS_RECEIPT_MAX_PENDING': int(os.getenv('SMS_RECEIPT_MAX_PENDING', 100000)),
+
         # smtp related config for sending email
         'SMTP_HOSTNAME': os.getenv('SMTP_HOSTNAME'),
         'SMTP_PORT': int(os.getenv('SMTP_PORT')),
         'SMTP_USERNAME': os.getenv('SMTP_USERNAME'),
         'SMTP_PASSWORD': os.getenv('SMTP_PASSWORD'),
         'SMTP_USE_TLS': bool(os.getenv('SMTP_USE_TLS')),
+        'SMTP_POOL_SIZE': int(os.getenv('SMTP_POOL_SIZE', 4)),
+        'SMTP_POOL_IDLE_TIMEOUT': float(os.getenv('SMTP_POOL_IDLE_TIMEOUT', 60)),
+        'SMTP_POOL_MAX_MESSAGES_PER_SESSION': int(os.getenv('SMTP_POOL_MAX_MESSAGES_PER_SESSION', 100)),
+        'SMTP_POOL_HEALTHCHECK_INTERVAL': float(os.getenv('SMTP_POOL_HEALTHCHECK_INTERVAL', 5)),
+        'SMTP_BATCH_WINDOW': float(os.getenv('SMTP_BATCH_WINDOW', 0)),
+        'SMTP_MAX_RECIPIENTS': int(os.getenv('SMTP_MAX_RECIPIENTS', 100)),
+        # rendered email headers and bodies are cached up to this many bytes
+        'EMAIL_RENDER_CACHE_BYTES': int(os.getenv('EMAIL_RENDER_CACHE_BYTES', 8 * 1024 * 1024)),
 
         # email transaction fruad alerting configs
         'TRANSACTION_FRAUD_EMAIL_ALERT_FROM': os.getenv('TRANSACTION_FRAUD_EMAIL_ALERT_FROM'),
         'TRANSACTION_FRAUD_EMAIL_ALERT_TO': os.getenv('TRANSACTION_FRAUD_EMAIL_ALERT_TO'),
-        'TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT': os.getenv('TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT')
+        'TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT': os.getenv('TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT'),
+
+        # circuit breaker per channel, opens after consecutive failures and
+        # lets probes through again after the reset timeout in seconds
+        'CIRCUIT_BREAKER_ENABLED': os.getenv('CIRCUIT_BREAKER_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+        'CIRCUIT_BREAKER_FAILURE_THRESHOLD': int(os.getenv('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5)),
+        'CIRCUIT_BREAKER_RESET_TIMEOUT': float(os.getenv('CIRCUIT_BREAKER_RESET_TIMEOUT', 30)),
+        'CIRCUIT_BREAKER_HALF_OPEN_PROBES': int(os.getenv('CIRCUIT_BREAKER_HALF_OPEN_PROBES', 1)),
+        'CIRCUIT_BREAKER_SUCCESS_THRESHOLD': int(os.getenv('CIRCUIT_BREAKER_SUCCESS_THRESHOLD', 1)),
+
+        # durable local outbox, alerts are acked once spooled and sent from
+        # the spool with retries, so channel outages don't stall the queue
+        'OUTBOX_ENABLED': os.getenv('OUTBOX_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+        'OUTBOX_DIR': os.getenv('OUTBOX_DIR', '/var/lib/alertman/outbox'),
+        'OUTBOX_SEGMENT_BYTES': int(os.getenv('OUTBOX_SEGMENT_BYTES', 64 * 1024 * 1024)),
+        'OUTBOX_FSYNC_INTERVAL': float(os.getenv('OUTBOX_FSYNC_INTERVAL', 0.005)),
+        'OUTBOX_DRAIN_CONCURRENCY': int(os.getenv('OUTBOX_DRAIN_CONCURRENCY', 64)),
+        'OUTBOX_RETRY_BASE_DELAY': float(os.getenv('OUTBOX_RETRY_BASE_DELAY', 1)),
+        'OUTBOX_RETRY_MAX_DELAY': float(os.getenv('OUTBOX_RETRY_MAX_DELAY', 60)),
+        # 0 keeps retrying until the alert is sent
+        'OUTBOX_MAX_ATTEMPTS': int(os.getenv('OUTBOX_MAX_ATTEMPTS', 0)),
+        'OUTBOX_MAX_DEFERRALS': int(os.getenv('OUTBOX_MAX_DEFERRALS', 0)),
+
+        # json file of routing rules, reloaded when it changes
+        'ROUTING_RULES_PATH': os.getenv('ROUTING_RULES_PATH', ''),
+        'ROUTING_RELOAD_INTERVAL': float(os.getenv('ROUTING_RELOAD_INTERVAL', 5)),
+
+        # email digest configs, coalesce alerts per receiver and subject
+        'EMAIL_DIGEST_ENABLED': os.getenv('EMAIL_DIGEST_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+        'EMAIL_DIGEST_WINDOW': float(os.getenv('EMAIL_DIGEST_WINDOW', 5)),
+        'EMAIL_DIGEST_MAX_ALERTS': int(os.getenv('EMAIL_DIGEST_MAX_ALERTS', 50))
     }
     return config
     
 
+def parseArgs():
+    parser = argparse.ArgumentParser(description='alertman worker')
+    parser.add_argument(
+        '--processes', type=int, default=int(os.getenv('WORKER_PROCESSES', 1)),
+        help='number of worker processes to fork, each with its own event loop'
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parseArgs()
     # read config from environment
     config = getConfigFromEnvironment()
-    # create a new asynio event loop
-    loop = asyncio.get_event_loop()
-    asyncio.ensure_future(startWorker(loop, config))
-    try:
-        loop.run_forever()
-    except Exception as exc:
-        log.error("Exception occured: {}".format(exc))
-        loop.close()
+    if args.processes > 1:
+        supervisor = WorkerSupervisor(
+            runWorkerProcess, args.processes, config,
+            reportInterval=config['WORKER_STATS_INTERVAL']
+        )
+        supervisor.run()
+    else:
+        runWorkerProcess(config)
+
 
 
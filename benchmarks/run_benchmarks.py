@@ -0,0 +1,283 @@
+# End to end throughput benchmarks for alertman. Alerts are published into an
+# in process FakeRabbitMQClient and consumed by the real alerts_consumer,
+# EmailSender and SMSSender, with emails going to a local smtp sink and sms
+# to a local sms gateway stub.
+#
+#   $ python benchmarks/run_benchmarks.py                  # all scenarios
+#   $ python benchmarks/run_benchmarks.py --scenario burst --output burst.json
+#
+# Every scenario runs in its own process so that the peak rss is its own.
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from time import perf_counter
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    'email-only': {'alertTypes': ['email'], 'rate': 500, 'duration': 10, 'burst': 0},
+    'sms-only': {'alertTypes': ['sms'], 'rate': 500, 'duration': 10, 'burst': 0},
+    'mixed': {'alertTypes': ['email', 'sms'], 'rate': 500, 'duration': 10, 'burst': 0},
+    'burst': {'alertTypes': ['email', 'sms'], 'rate': 0, 'duration': 0, 'burst': 5000},
+}
+
+
+def getBenchmarkEnvironment(args):
+    # the worker reads its config from the environment, so the benchmark
+    # configures it the same way a deployment does
+    return {
+        'MESSAGE_BROKER_SERVICE_USERNAME': 'guest',
+        'MESSAGE_BROKER_SERVICE_PASSWORD': 'guest',
+        'MESSAGE_BROKER_SERVICE_HOST': 'localhost',
+        'MESSAGE_BROKER_SERVICE_PORT': '5672',
+        'MESSAGE_BROKER_SERVICE_VIRTUALHOST': '/',
+        'SMTP_HOSTNAME': args.smtp_host,
+        'SMTP_PORT': str(args.smtp_port),
+        'SMTP_USERNAME': 'benchmark',
+        'SMTP_PASSWORD': 'benchmark',
+        'SMTP_USE_TLS': '',
+        'SMTP_POOL_SIZE': str(args.smtp_pool_size),
+        'SMS_GATEWAY_URL': 'http://{}:{}/v1'.format(args.sms_host, args.sms_port),
+        'SMS_GATEWAY_POOL_SIZE': str(args.sms_pool_size),
+        'TRANSACTION_FRAUD_EMAIL_ALERT_FROM': 'alertman@localhost',
+        'TRANSACTION_FRAUD_EMAIL_ALERT_TO': 'oncall@localhost',
+        'TRANSACTION_FRAUD_EMAIL_ALERT_SUBJECT': 'alertman benchmark',
+        'WORKER_PREFETCH_COUNT': str(args.prefetch),
+        'WORKER_MAX_IN_FLIGHT': str(args.max_in_flight),
+        'WORKER_ACK_BATCH_SIZE': str(args.ack_batch_size),
+        'WORKER_ADAPTIVE_PREFETCH': 'true' if args.adaptive_prefetch else 'false',
+        'WORKER_PREFETCH_ADJUST_INTERVAL': '0.5',
+        'RETRY_ENABLED': 'false',
+        'DEDUP_ENABLED': 'false',
+        'PIPELINE_ENABLED': 'true' if args.pipeline else 'false',
+        'PIPELINE_EXECUTOR': args.pipeline_executor,
+        'LOG_LEVEL': 'error',
+    }
+
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self.latencies = []
+        self.acked = 0
+        self.rejected = 0
+
+    def onSettle(self, message, outcome):
+        if outcome == 'ack':
+            self.acked += 1
+        else:
+            self.rejected += 1
+        self.latencies.append(perf_counter() - message.publishedAt)
+
+    @property
+    def settled(self):
+        return self.acked + self.rejected
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+async def publishAtRate(client, scenario, bodySize):
+    body = 'x' * bodySize
+    sequence = 0
+
+    def nextAlert():
+        nonlocal sequence
+        sequence += 1
+        return {'alertTypes': scenario['alertTypes'], 'message': {
+            'sequence': sequence, 'payload': body
+        }}
+
+    if scenario['burst']:
+        for _ in range(scenario['burst']):
+            await client.publish(nextAlert(), 'dummy-exchange', 'dummy-alerts')
+        return sequence
+
+    startedAt = perf_counter()
+    deadline = startedAt + scenario['duration']
+    while perf_counter() < deadline:
+        due = int((perf_counter() - startedAt) * scenario['rate'])
+        while sequence < due:
+            await client.publish(nextAlert(), 'dummy-exchange', 'dummy-alerts')
+        await asyncio.sleep(0.005)
+    return sequence
+
+
+async def runScenario(name, args):
+    from alertman import worker
+    from alertman.consumer import BoundedConsumer, ConsumerBackpressure
+    from alertman.fake_broker import FakeRabbitMQClient
+
+    scenario = dict(SCENARIOS[name])
+    if args.rate:
+        scenario['rate'] = args.rate
+    if args.duration:
+        scenario['duration'] = args.duration
+
+    loop = asyncio.get_event_loop()
+    config = worker.getConfigFromEnvironment()
+    recorder = LatencyRecorder()
+    client = FakeRabbitMQClient(onSettle=recorder.onSettle)
+    backpressure = ConsumerBackpressure(client, config['WORKER_PREFETCH_COUNT'])
+    worker.usecases['consumerBackpressure'] = backpressure
+    worker.setupUseCaseDependencies(loop, config, backpressure)
+    worker.usecases['retryPolicy'] = None
+    worker.usecases['retryPolicies'] = {}
+    worker.usecases['ackBatchers'] = []
+    on_message = worker.alerts_consumer
+    if config['PIPELINE_ENABLED']:
+        worker.setupAlertPipeline(config)
+        on_message = worker.pipeline_alerts_consumer
+    consumer = BoundedConsumer(
+        on_message, maxInFlight=config['WORKER_MAX_IN_FLIGHT'],
+        ackBatcher=worker.getAckBatcher(config, config['WORKER_PREFETCH_COUNT'])
+    )
+    if config['WORKER_ADAPTIVE_PREFETCH']:
+        asyncio.ensure_future(worker.getAdaptivePrefetch(config, consumer).run())
+    await worker.startConsuming(client, consumer, config['WORKER_PREFETCH_COUNT'])
+
+    startedAt = perf_counter()
+    published = await publishAtRate(client, scenario, args.body_size)
+    drainDeadline = perf_counter() + args.drain_timeout
+    while recorder.settled < published and perf_counter() < drainDeadline:
+        await asyncio.sleep(0.01)
+    elapsed = perf_counter() - startedAt
+    settleFrames = client.settleFrames
+    for ackBatcher in worker.usecases['ackBatchers']:
+        await ackBatcher.close()
+    await client.close()
+    if worker.usecases.get('alertPipeline'):
+        await worker.usecases['alertPipeline'].stop()
+    for alertSender in worker.usecases['alertSenders']:
+        if hasattr(alertSender, 'close'):
+            await alertSender.close()
+
+    return {
+        'scenario': name,
+        'published': published,
+        'acked': recorder.acked,
+        'rejected': recorder.rejected,
+        'lost': published - recorder.settled,
+        'ackFrames': settleFrames,
+        'elapsedSeconds': round(elapsed, 3),
+        'alertsPerSecond': round(recorder.settled / elapsed, 2) if elapsed else 0.0,
+        'p50LatencyMs': round(percentile(recorder.latencies, 0.50) * 1000, 3),
+        'p99LatencyMs': round(percentile(recorder.latencies, 0.99) * 1000, 3),
+        # ru_maxrss is in kilobytes on linux
+        'prefetchCount': backpressure.prefetchCount,
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+    }
+
+
+def runInProcess(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from smtp_sink import startSMTPSink
+    from sms_gateway import startSMSGateway
+
+    controller = startSMTPSink(args.smtp_host, args.smtp_port, args.smtp_latency)
+    gateway = startSMSGateway(args.sms_host, args.sms_port, args.sms_latency)
+    try:
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(runScenario(args.scenario, args))
+    finally:
+        controller.stop()
+        gateway.stop()
+
+
+def getChildArgv(argv):
+    # the children print their result instead of writing --output
+    childArgv = []
+    skipNext = False
+    for arg in argv:
+        if skipNext:
+            skipNext = False
+        elif arg == '--output':
+            skipNext = True
+        elif not arg.startswith('--output='):
+            childArgv.append(arg)
+    return childArgv
+
+
+def getChildEnvironment():
+    # the children import alertman from this checkout, installed or not
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join(
+        path for path in (ROOT, env.get('PYTHONPATH')) if path
+    )
+    return env
+
+
+def runInSubprocesses(args, scenarios):
+    results = []
+    for name in scenarios:
+        command = [sys.executable, os.path.abspath(__file__), '--child'] + \
+            getChildArgv(sys.argv[1:]) + ['--scenario', name]
+        output = subprocess.check_output(command, env=getChildEnvironment(), cwd=ROOT)
+        results.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    return results
+
+
+def printReport(results):
+    columns = ('scenario', 'published', 'lost', 'ackFrames', 'alertsPerSecond',
+        'p50LatencyMs', 'p99LatencyMs', 'prefetchCount', 'peakRssMb')
+    print(' '.join('{:>16}'.format(column) for column in columns))
+    for result in results:
+        print(' '.join('{:>16}'.format(result[column]) for column in columns))
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='alertman throughput benchmarks')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+        help='scenario to run, can be repeated, defaults to all')
+    parser.add_argument('--rate', type=float, default=0, help='alerts per second')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to publish for')
+    parser.add_argument('--body-size', type=int, default=256)
+    parser.add_argument('--prefetch', type=int, default=500)
+    parser.add_argument('--max-in-flight', type=int, default=500)
+    parser.add_argument('--adaptive-prefetch', action='store_true',
+        help='let the worker tune its prefetch while the scenario runs')
+    parser.add_argument('--ack-batch-size', type=int, default=100,
+        help='0 acks every delivery on its own')
+    parser.add_argument('--smtp-host', default='127.0.0.1')
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    parser.add_argument('--smtp-latency', type=float, default=0.0)
+    parser.add_argument('--smtp-pool-size', type=int, default=8)
+    parser.add_argument('--sms-host', default='127.0.0.1')
+    parser.add_argument('--sms-port', type=int, default=8090)
+    parser.add_argument('--sms-latency', type=float, default=0.05,
+        help='seconds the sms gateway stub takes to answer a request')
+    parser.add_argument('--sms-pool-size', type=int, default=16)
+    parser.add_argument('--pipeline', action='store_true',
+        help='consume through the staged alert pipeline')
+    parser.add_argument('--pipeline-executor', default='none',
+        choices=('none', 'thread', 'process'))
+    parser.add_argument('--drain-timeout', type=float, default=60.0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    os.environ.update(getBenchmarkEnvironment(args))
+    if args.child:
+        # --scenario is repeated with the one this child has to run last
+        args.scenario = args.scenario[-1]
+        print(json.dumps(runInProcess(args)))
+        sys.exit(0)
+
+    results = runInSubprocesses(args, args.scenario or sorted(SCENARIOS))
+    printReport(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': time.time(), 'results': results}, f, indent=2)
@@ -0,0 +1,218 @@
+# Local stub of a generic http sms gateway for benchmarks and testing, speaks
+# the api SMSSender expects over keep-alive connections:
+#
+#   POST /messages       {"reference", "from", "to", "text", "callbackUrl"}
+#   POST /messages/bulk  {"messages": [...]}
+#
+# Every request is answered after an optional artificial latency, receivers
+# starting with "invalid" are rejected, and with --max-rate messages beyond
+# that rate get a 429 with a Retry-After. Delivery receipts are posted in
+# batches to the callbackUrl of the messages after --receipt-delay seconds.
+#
+#   $ python benchmarks/sms_gateway.py --port 8090 --latency 0.05
+import argparse
+import asyncio
+import itertools
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class SMSGatewayStub(object):
+    def __init__(self, latency=0.0, maxRate=0.0, receiptDelay=0.5):
+        self.latency = latency
+        self.maxRate = maxRate
+        self.receiptDelay = receiptDelay
+        self.requests = 0
+        self.messages = 0
+        self.connections = 0
+        self.throttled = 0
+        self.receiptsSent = 0
+        self._ids = itertools.count(1)
+        self._tokens = maxRate
+        self._refilledAt = time.monotonic()
+        self._receipts = {}
+        self._tasks = set()
+        self._server = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self._track(asyncio.current_task())
+        try:
+            while True:
+                request = await self._readRequest(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                status, headers, payload = await self._respond(method, path, body)
+                data = json.dumps(payload).encode('utf-8')
+                head = ['HTTP/1.1 {}'.format(status), 'Content-Type: application/json',
+                    'Content-Length: {}'.format(len(data))]
+                head.extend('{}: {}'.format(name, value) for name, value in headers.items())
+                writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self.handle, host, port)
+        self._track(asyncio.ensure_future(self.postReceipts()))
+
+    async def close(self):
+        # connections and the receipt poster are cancelled and awaited, so
+        # nothing is left pending when the loop stops
+        if self._server is not None:
+            self._server.close()
+        tasks = [task for task in self._tasks if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def _track(self, task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _readRequest(self, reader):
+        requestLine = await reader.readline()
+        if not requestLine:
+            return None
+        contentLength = 0
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                contentLength = int(value.strip())
+        body = await reader.readexactly(contentLength)
+        method, path = requestLine.decode('latin-1').split()[:2]
+        return method, path, body
+
+    async def _respond(self, method, path, body):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method != 'POST':
+            return '405 Method Not Allowed', {}, {'error': 'method not allowed'}
+        payload = json.loads(body.decode('utf-8'))
+        if path.endswith('/messages/bulk'):
+            messages = payload.get('messages', [])
+        elif path.endswith('/messages'):
+            messages = [payload]
+        else:
+            return '404 Not Found', {}, {'error': 'not found'}
+        if not self._takeTokens(len(messages)):
+            self.throttled += 1
+            return '429 Too Many Requests', {'Retry-After': '1'}, {'error': 'rate limited'}
+
+        results = [self._accept(message) for message in messages]
+        if path.endswith('/messages/bulk'):
+            return '200 OK', {}, {'results': results}
+        if results[0]['status'] != 'accepted':
+            return '400 Bad Request', {}, results[0]
+        return '202 Accepted', {}, results[0]
+
+    def _accept(self, message):
+        self.messages += 1
+        result = {'reference': message.get('reference')}
+        if str(message.get('to', '')).startswith('invalid'):
+            result.update(status='rejected', error='invalid receiver')
+            return result
+        result.update(id='msg-{}'.format(next(self._ids)), status='accepted')
+        if message.get('callbackUrl'):
+            self._receipts.setdefault(message['callbackUrl'], []).append({
+                'id': result['id'], 'reference': result['reference'], 'status': 'delivered'
+            })
+        return result
+
+    def _takeTokens(self, count):
+        if not self.maxRate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(self.maxRate, self._tokens + (now - self._refilledAt) * self.maxRate)
+        self._refilledAt = now
+        if self._tokens < count:
+            return False
+        self._tokens -= count
+        return True
+
+    async def postReceipts(self):
+        while True:
+            await asyncio.sleep(self.receiptDelay)
+            receipts, self._receipts = self._receipts, {}
+            for callbackUrl, batch in receipts.items():
+                try:
+                    await postJSON(callbackUrl, batch)
+                    self.receiptsSent += len(batch)
+                except Exception as exc:
+                    print("sms gateway could not post receipts to {}: {}".format(callbackUrl, exc))
+
+
+async def postJSON(url, payload):
+    url = urlsplit(url)
+    reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    try:
+        data = json.dumps(payload).encode('utf-8')
+        writer.write('POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                (url.path or '/') + ('?' + url.query if url.query else ''),
+                url.netloc, len(data)).encode('latin-1') + data)
+        await writer.drain()
+        await reader.read()
+    finally:
+        writer.close()
+
+
+def startSMSGateway(host='127.0.0.1', port=8090, latency=0.0, maxRate=0.0, receiptDelay=0.5):
+    # runs on its own event loop in a thread, like the smtp sink, so the
+    # gateway never competes with the event loop being benchmarked
+    gateway = SMSGatewayStub(latency, maxRate, receiptDelay)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(gateway.start(host, port))
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(gateway.close())
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+
+    def stop():
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    gateway.stop = stop
+    return gateway
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='alertman sms gateway stub')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds to wait before answering every request')
+    parser.add_argument('--max-rate', type=float, default=0.0,
+        help='messages per second accepted, 0 for no limit')
+    parser.add_argument('--receipt-delay', type=float, default=0.5)
+    args = parser.parse_args()
+
+    gateway = startSMSGateway(args.host, args.port, args.latency, args.max_rate,
+        args.receipt_delay)
+    print("sms gateway listening on {}:{}".format(args.host, args.port))
+    try:
+        while True:
+            time.sleep(10)
+            print("sms gateway received {} messages in {} requests over {} connections".format(
+                gateway.messages, gateway.requests, gateway.connections))
+    except KeyboardInterrupt:
+        gateway.stop()
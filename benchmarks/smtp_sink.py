@@ -0,0 +1,62 @@
+# Local smtp sink for benchmarks, accepts any login and every message after
+# an optional artificial latency, so EmailSender can be driven without a
+# real smtp provider.
+#
+#   $ python benchmarks/smtp_sink.py --port 8025 --latency 0.05
+import argparse
+import asyncio
+import logging
+import time
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+
+class LatencySinkHandler(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = 0
+        self.recipients = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.messages += 1
+        self.recipients += len(envelope.rcpt_tos)
+        return '250 Message accepted for delivery'
+
+
+def acceptAnyLogin(server, session, envelope, mechanism, authData):
+    return AuthResult(success=True)
+
+
+def startSMTPSink(host='127.0.0.1', port=8025, latency=0.0):
+    # aiosmtpd logs every session, far too noisy under benchmark load
+    logging.getLogger('mail.log').setLevel(logging.ERROR)
+    # the controller runs the sink on its own event loop in a thread, so its
+    # latency never blocks the event loop of the code being benchmarked
+    handler = LatencySinkHandler(latency)
+    controller = Controller(
+        handler, hostname=host, port=port,
+        authenticator=acceptAnyLogin, auth_require_tls=False
+    )
+    controller.start()
+    return controller
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='alertman smtp sink')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds to wait before accepting every message')
+    args = parser.parse_args()
+
+    controller = startSMTPSink(args.host, args.port, args.latency)
+    print("smtp sink listening on {}:{}".format(args.host, args.port))
+    try:
+        while True:
+            time.sleep(10)
+            print("smtp sink received {} messages".format(controller.handler.messages))
+    except KeyboardInterrupt:
+        controller.stop()
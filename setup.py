@@ -81,9 +81,17 @@ DEV_REQUIRES = [
 ] + TEST_REQUIRES
 
 
+# optional faster wire codecs, picked up automatically when installed
+FAST_REQUIRES = [
+    "orjson",
+    "msgpack",
+]
+
+
 EXTRAS_REQUIRE = {
     'dev': DEV_REQUIRES,
-    'test': TEST_REQUIRES
+    'test': TEST_REQUIRES,
+    'fast': FAST_REQUIRES
 }
 
 PACKAGE_DATA = {
@@ -188,6 +196,8 @@ setup(
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
     entry_points={
-        'console_scripts': [],
+        'console_scripts': [
+            'alertman-loadgen = alertman.loadgen:main',
+        ],
     },
 )
@@ -0,0 +1,127 @@
+import asyncio
+
+from alertman.consumer import AckBatcher
+
+
+# Records the settle frames like an aio_pika 10 delivery, whose ack, reject
+# and nack are coroutines.
+class FakeDelivery(object):
+    def __init__(self, deliveryTag, frames):
+        self.delivery_tag = deliveryTag
+        self._frames = frames
+
+    async def ack(self, multiple=False):
+        self._frames.append(('ack', self.delivery_tag, multiple))
+
+    async def reject(self, requeue=False):
+        self._frames.append(('reject', self.delivery_tag, requeue))
+
+    async def nack(self, multiple=False, requeue=True):
+        self._frames.append(('nack', self.delivery_tag, requeue))
+
+
+def runBatcher(scenario, maxBatch=100, flushInterval=0.01):
+    frames = []
+
+    async def run():
+        batcher = AckBatcher(maxBatch=maxBatch, flushInterval=flushInterval)
+        tracked = {}
+
+        def track(*tags):
+            for tag in tags:
+                tracked[tag] = batcher.track(FakeDelivery(tag, frames))
+
+        await scenario(batcher, track, tracked, frames)
+        # let the scheduled ack coroutines run
+        await asyncio.sleep(0)
+        return batcher.stats()
+
+    stats = asyncio.run(run())
+    return frames, stats
+
+
+def test_completed_prefix_is_acked_once_with_multiple():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2, 3)
+        await tracked[1].ack()
+        await tracked[2].ack()
+        await tracked[3].ack()
+
+    frames, stats = runBatcher(scenario)
+    assert frames == [('ack', 3, True)]
+    assert stats == {'ready': 0, 'acked': 3, 'batches': 1}
+
+
+def test_ack_waits_for_the_delivery_in_progress_before_it():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2, 3)
+        await tracked[3].ack()
+        await tracked[2].ack()
+        await asyncio.sleep(0)
+        assert frames == []
+        await tracked[1].ack()
+
+    frames, _ = runBatcher(scenario, flushInterval=10)
+    assert frames == [('ack', 3, True)]
+
+
+def test_full_batch_acks_the_contiguous_prefix_only():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2, 3, 4)
+        await tracked[1].ack()
+        await tracked[2].ack()
+        await tracked[4].ack()
+
+    frames, stats = runBatcher(scenario, maxBatch=2, flushInterval=10)
+    assert frames == [('ack', 2, True)]
+    assert stats['ready'] == 1
+
+
+def test_rejected_delivery_is_skipped_by_the_multiple_ack():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2, 3)
+        await tracked[2].reject(requeue=True)
+        await tracked[1].ack()
+        await tracked[3].ack()
+
+    frames, stats = runBatcher(scenario, flushInterval=10)
+    assert frames == [('reject', 2, True), ('ack', 3, True)]
+    assert stats['acked'] == 2
+
+
+def test_straggler_behind_slow_delivery_is_acked_alone_after_an_interval():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2)
+        await tracked[2].ack()
+        # one tick to notice it, the next one acks it on its own
+        await asyncio.sleep(0.05)
+        assert frames == [('ack', 2, False)]
+        await tracked[1].ack()
+
+    frames, stats = runBatcher(scenario)
+    assert frames == [('ack', 2, False), ('ack', 1, True)]
+    assert stats['acked'] == 2
+
+
+def test_delivery_tags_starting_over_drop_the_old_channel_state():
+    async def scenario(batcher, track, tracked, frames):
+        track(5, 6)
+        await tracked[6].ack()
+        # reopened channel, tags start over
+        track(1)
+        await tracked[1].ack()
+
+    frames, stats = runBatcher(scenario, flushInterval=10)
+    assert frames == [('ack', 1, True)]
+    assert stats['ready'] == 0
+
+
+def test_close_acks_whatever_is_ready():
+    async def scenario(batcher, track, tracked, frames):
+        track(1, 2, 3)
+        await tracked[2].ack()
+        await tracked[3].ack()
+        await batcher.close()
+
+    frames, _ = runBatcher(scenario, flushInterval=10)
+    assert sorted(frames) == [('ack', 2, False), ('ack', 3, False)]
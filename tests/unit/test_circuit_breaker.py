@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+from aiosmtplib import SMTPRecipientRefused, SMTPServerDisconnected
+
+from alertman.usecases.circuit_breaker import (
+    CircuitBreaker, CircuitBreakerSender, CircuitOpenError, isBackendFailure
+)
+from alertman.usecases.send_sms import SMSGatewayError
+
+
+class FailingSender(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+    async def send(self, alert):
+        raise self.exc
+
+
+def sendTimes(exc, times):
+    breaker = CircuitBreaker('test', failureThreshold=3, resetTimeout=60.0)
+    sender = CircuitBreakerSender(FailingSender(exc), breaker)
+
+    async def run():
+        for _ in range(times):
+            with pytest.raises(type(exc)):
+                await sender.send(None)
+
+    asyncio.run(run())
+    return breaker
+
+
+@pytest.mark.parametrize('exc', [
+    SMTPServerDisconnected('gone'),
+    asyncio.TimeoutError(),
+    ConnectionResetError(),
+    SMSGatewayError(503, 'unavailable', 1.0),
+    SMSGatewayError(429, 'throttled', 1.0),
+])
+def test_backend_failures_open_the_circuit(exc):
+    assert isBackendFailure(exc)
+    assert sendTimes(exc, 3).state == 'open'
+
+
+@pytest.mark.parametrize('exc', [
+    SMTPRecipientRefused(550, 'no such user', 'nobody@example.com'),
+    SMSGatewayError('rejected', 'invalid number'),
+    SMSGatewayError(400, 'bad request'),
+    ValueError('could not render'),
+])
+def test_refusals_leave_the_circuit_closed(exc):
+    assert not isBackendFailure(exc)
+    assert sendTimes(exc, 10).state == 'closed'
+
+
+def test_open_circuit_rejects_without_calling_the_backend():
+    breaker = sendTimes(SMTPServerDisconnected('gone'), 3)
+    sender = CircuitBreakerSender(FailingSender(AssertionError()), breaker)
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(sender.send(None))
@@ -0,0 +1,127 @@
+import asyncio
+
+from alertman.usecases.process_alert import (
+    ADDED, PENDING, SENT, AlertDeduplicator, AlertProcessor, AlertRequest,
+    DedupClaimPending, InMemoryDedupBackend, SQLiteDedupBackend
+)
+
+
+def runBackend(tmp_path, scenario, **kwargs):
+    async def run():
+        backend = SQLiteDedupBackend(str(tmp_path / 'dedup.sqlite3'), **kwargs)
+        try:
+            return await scenario(backend)
+        finally:
+            await backend.close()
+
+    return asyncio.run(run())
+
+
+def test_key_is_a_duplicate_until_it_expires(tmp_path):
+    async def scenario(backend):
+        added = [await backend.add(b'key')]
+        await backend.confirm(b'key')
+        added.append(await backend.add(b'key'))
+        await asyncio.sleep(0.1)
+        # long before the next sweep, the insert takes the expired key over
+        added.append(await backend.add(b'key'))
+        return added
+
+    assert runBackend(tmp_path, scenario, ttl=0.05, sweepInterval=3600) == [ADDED, SENT, ADDED]
+
+
+def test_pending_key_is_taken_over_once_it_expires(tmp_path):
+    async def scenario(backend):
+        added = [await backend.add(b'key'), await backend.add(b'key')]
+        await asyncio.sleep(0.1)
+        added.append(await backend.add(b'key'))
+        return added
+
+    assert runBackend(tmp_path, scenario, pendingTtl=0.05) == [ADDED, PENDING, ADDED]
+
+
+def test_discarded_key_can_be_added_again(tmp_path):
+    async def scenario(backend):
+        await backend.add(b'key')
+        await backend.discard(b'key')
+        return await backend.add(b'key')
+
+    assert runBackend(tmp_path, scenario) == ADDED
+
+
+def test_keys_survive_a_restart(tmp_path):
+    async def first(backend):
+        await backend.add(b'key')
+        await backend.confirm(b'key')
+
+    async def second(backend):
+        return await backend.add(b'key')
+
+    runBackend(tmp_path, first)
+    assert runBackend(tmp_path, second) == SENT
+
+
+class RecordingSender(object):
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, alert):
+        self.sent.append(alert.alertID)
+
+    def getRenderer(self):
+        return None
+
+
+class AcceptingValidator(object):
+    def validate(self, alertRequest):
+        return True
+
+
+def getAlertRequest():
+    return AlertRequest({
+        'sender': 'alertman', 'receiver': '+15550100', 'subject': '', 'body': 'disk full'
+    }, 'sms')
+
+
+def test_redelivery_after_a_crash_is_still_sent(tmp_path):
+    path = str(tmp_path / 'dedup.sqlite3')
+
+    async def crashAfterClaim():
+        # the worker claims the alert and dies before it is sent
+        deduplicator = AlertDeduplicator(SQLiteDedupBackend(path, pendingTtl=0.05))
+        processor = AlertProcessor(RecordingSender(), AcceptingValidator(), deduplicator)
+        await processor.prepare(getAlertRequest())
+        await deduplicator.close()
+
+    async def redeliver():
+        sender = RecordingSender()
+        deduplicator = AlertDeduplicator(SQLiteDedupBackend(path, pendingTtl=0.05))
+        processor = AlertProcessor(sender, AcceptingValidator(), deduplicator)
+        try:
+            outcomes = []
+            for _ in range(3):
+                try:
+                    await processor.process(getAlertRequest())
+                    outcomes.append('processed')
+                except DedupClaimPending:
+                    outcomes.append('retried')
+                    await asyncio.sleep(0.1)
+            return outcomes, len(sender.sent)
+        finally:
+            await deduplicator.close()
+
+    asyncio.run(crashAfterClaim())
+    # held back while the claim is pending, sent once, then a duplicate
+    assert asyncio.run(redeliver()) == (['retried', 'processed', 'processed'], 1)
+
+
+def test_memory_backend_expires_pending_keys_behind_sent_ones():
+    async def run():
+        backend = InMemoryDedupBackend(ttl=3600, pendingTtl=0.05)
+        await backend.add(b'sent')
+        await backend.confirm(b'sent')
+        await backend.add(b'pending')
+        await asyncio.sleep(0.1)
+        return await backend.add(b'sent'), await backend.add(b'pending')
+
+    assert asyncio.run(run()) == (SENT, ADDED)
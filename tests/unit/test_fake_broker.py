@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from aio_pika.exceptions import ChannelPreconditionFailed, MessageProcessError
+
+from alertman.fake_broker import FakeRabbitMQClient
+
+
+def runClient(scenario):
+    async def run():
+        client = FakeRabbitMQClient()
+        try:
+            return await scenario(client)
+        finally:
+            await client.close()
+
+    return asyncio.run(run())
+
+
+async def consumeInto(client, delivered, prefetchCount):
+    async def on_message(message):
+        delivered.append(message)
+
+    await client.consume('alerts', 'alerts_exchange', on_message, {
+        'bindingKey': 'alerts', 'set_qos': prefetchCount
+    })
+
+
+async def publish(client, count):
+    for index in range(count):
+        await client.publish({'index': index}, 'alerts_exchange', 'alerts')
+    # let the consumer take what its prefetch allows
+    for _ in range(count + 2):
+        await asyncio.sleep(0)
+
+
+def test_settle_is_a_coroutine_and_only_allowed_once():
+    async def scenario(client):
+        delivered = []
+        await consumeInto(client, delivered, 10)
+        await publish(client, 1)
+        await delivered[0].ack()
+        with pytest.raises(MessageProcessError):
+            await delivered[0].ack()
+        return client.unackedCount
+
+    assert runClient(scenario) == 0
+
+
+def test_unknown_delivery_tag_fails_like_the_broker():
+    async def scenario(client):
+        delivered = []
+        await consumeInto(client, delivered, 10)
+        await publish(client, 2)
+        await delivered[1].ack(multiple=True)
+        # already covered by the multiple ack
+        with pytest.raises(ChannelPreconditionFailed):
+            await delivered[0].ack()
+
+    runClient(scenario)
+
+
+def test_running_consumer_keeps_its_prefetch():
+    async def scenario(client):
+        delivered = []
+        await consumeInto(client, delivered, 2)
+        await client.set_qos(5)
+        await publish(client, 6)
+        return len(delivered), client.queueDepth('alerts')
+
+    assert runClient(scenario) == (2, 4)
+
+
+def test_requeued_delivery_gets_a_new_delivery_tag():
+    async def scenario(client):
+        delivered = []
+        await consumeInto(client, delivered, 10)
+        await publish(client, 1)
+        await delivered[0].reject(requeue=True)
+        await publish(client, 0)
+        return [(message.delivery_tag, message.redelivered) for message in delivered]
+
+    assert runClient(scenario) == [(1, False), (2, True)]
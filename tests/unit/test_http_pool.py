@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from alertman.usecases.http_pool import HTTPConnectionClosed, HTTPConnectionPool
+
+
+# Serves canned responses, one per request, from a list shared by all the
+# connections. A response of None closes the connection without answering.
+class CannedServer(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.connections = 0
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                headers = dict(
+                    line.split(': ', 1) for line in head.decode('latin-1').split('\r\n')[1:-2]
+                )
+                body = await reader.readexactly(int(headers.get('Content-Length', 0)))
+                self.requests.append((head.split(b'\r\n', 1)[0], body))
+                response = self.responses.pop(0)
+                if response is None:
+                    break
+                writer.write(response)
+                await writer.drain()
+                if b'Connection: close' in response or b'Content-Length' not in response \
+                        and b'chunked' not in response:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def runPool(responses, scenario):
+    async def run():
+        server = CannedServer(responses)
+        listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        pool = HTTPConnectionPool('127.0.0.1', port, maxSize=1)
+        try:
+            return await scenario(pool), server
+        finally:
+            pool.close()
+            listener.close()
+            await listener.wait_closed()
+
+    return asyncio.run(run())
+
+
+def test_keep_alive_connection_is_reused():
+    response = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    async def scenario(pool):
+        first = await pool.request('POST', '/messages', body=b'{}')
+        second = await pool.request('POST', '/messages', body=b'{}')
+        return first.body, second.body, pool.idleSize
+
+    result, server = runPool([response, response], scenario)
+    assert result == (b'ok', b'ok', 1)
+    assert server.connections == 1
+    assert server.requests[0] == (b'POST /messages HTTP/1.1', b'{}')
+
+
+def test_chunked_body_is_joined_and_trailers_skipped():
+    response = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+        b'5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+
+    async def scenario(pool):
+        response = await pool.request('GET', '/')
+        return response.body, pool.idleSize
+
+    result, _ = runPool([response], scenario)
+    assert result == (b'hello world', 1)
+
+
+def test_close_delimited_body_is_read_to_the_end_and_not_reused():
+    response = b'HTTP/1.1 200 OK\r\n\r\n{"id": 1}'
+
+    async def scenario(pool):
+        response = await pool.request('POST', '/messages', body=b'{}')
+        return response.json(), pool.idleSize
+
+    result, _ = runPool([response], scenario)
+    assert result == ({'id': 1}, 0)
+
+
+def test_connection_close_response_is_not_reused():
+    response = b'HTTP/1.1 204 No Content\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+
+    async def scenario(pool):
+        response = await pool.request('POST', '/messages', body=b'{}')
+        return response.status, pool.idleSize
+
+    result, _ = runPool([response], scenario)
+    assert result == (204, 0)
+
+
+def test_request_is_not_replayed_once_written():
+    ok = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    async def scenario(pool):
+        await pool.request('POST', '/messages', body=b'{}')
+        # the server reads the next request, then drops the connection
+        with pytest.raises(HTTPConnectionClosed):
+            await pool.request('POST', '/messages', body=b'{"n": 2}')
+
+    _, server = runPool([ok, None], scenario)
+    assert len(server.requests) == 2
+
+
+def test_malformed_status_line_drops_the_connection():
+    ok = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+
+    async def scenario(pool):
+        with pytest.raises(HTTPConnectionClosed):
+            await pool.request('POST', '/messages', body=b'{}')
+        idleAfterFailure = pool.idleSize
+        response = await pool.request('POST', '/messages', body=b'{}')
+        return idleAfterFailure, response.body
+
+    result, server = runPool([b'garbage\r\n\r\n', ok], scenario)
+    assert result == (0, b'ok')
+    assert server.connections == 2
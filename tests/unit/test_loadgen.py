@@ -0,0 +1,35 @@
+from alertman.loadgen import LatencyReservoir, LoadProfile
+
+
+def test_burst_profile_fires_one_burst_per_interval_before_the_duration():
+    profile = LoadProfile('burst', duration=10, burstSize=100, burstInterval=1)
+    assert profile.total == 1000
+    assert profile.due(0) == 100
+    assert profile.due(9.5) == 1000
+    assert profile.due(60) == 1000
+
+
+def test_burst_profile_without_duration_is_a_single_burst():
+    profile = LoadProfile('burst', duration=0, burstSize=100, burstInterval=1)
+    assert profile.total == 100
+    assert profile.due(5) == 100
+
+
+def test_burst_profile_with_a_partial_last_interval():
+    profile = LoadProfile('burst', duration=2.5, burstSize=10, burstInterval=1)
+    assert profile.total == 30
+
+
+def test_fixed_and_ramp_profiles_add_up_to_their_rate():
+    assert LoadProfile('fixed', rate=100, duration=10).total == 1000
+    assert LoadProfile('ramp', rate=100, duration=10, rampFrom=0).total == 500
+
+
+def test_latency_reservoir_is_bounded_and_keeps_the_max():
+    reservoir = LatencyReservoir(size=100)
+    for value in range(10000):
+        reservoir.add(value / 10000.0)
+    assert len(reservoir) == 10000
+    assert len(reservoir._sample) == 100
+    assert reservoir.max == 0.9999
+    assert 0.3 < reservoir.percentile(0.5) < 0.7
@@ -0,0 +1,30 @@
+import logging
+
+from alertman.log import RateLimitFilter
+
+
+def makeRecord(msg, *args):
+    return logging.LogRecord('alertman.test', logging.ERROR, __file__, 1, msg, args, None)
+
+
+def test_repeats_of_a_message_are_suppressed_past_the_burst():
+    ratelimit = RateLimitFilter(interval=60, burst=2)
+    passed = [ratelimit.filter(makeRecord("could not send: %s", index)) for index in range(5)]
+    assert passed == [True, True, False, False, False]
+
+
+def test_tracked_messages_are_bounded():
+    ratelimit = RateLimitFilter(interval=60, burst=2, maxKeys=10)
+    for index in range(100):
+        ratelimit.filter(makeRecord("message {}".format(index)))
+    assert len(ratelimit._windows) == 10
+
+
+def test_expired_windows_are_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr('alertman.log.time.monotonic', lambda: now[0])
+    ratelimit = RateLimitFilter(interval=1, burst=2)
+    ratelimit.filter(makeRecord("first"))
+    now[0] += 5
+    ratelimit.filter(makeRecord("second"))
+    assert [key[2] for key in ratelimit._windows] == ["second"]
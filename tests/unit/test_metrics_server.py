@@ -0,0 +1,51 @@
+import asyncio
+
+from alertman.metrics import MetricsRegistry, startMetricsServer
+
+
+def runMetricsServer(scenario, **kwargs):
+    async def run():
+        registry = MetricsRegistry()
+        registry.counter('alertman_test_total', 'Test counter').labels().inc()
+        server = await startMetricsServer('127.0.0.1', 0, registry, **kwargs)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(run())
+
+
+async def send(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+def test_metrics_are_served():
+    async def scenario(port):
+        return await send(port, b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+    response = runMetricsServer(scenario)
+    assert response.startswith(b'HTTP/1.1 200 OK')
+    assert b'alertman_test_total 1' in response
+
+
+def test_slow_request_is_dropped():
+    async def scenario(port):
+        return await send(port, b'GET /metrics HTTP/1.1\r\n')
+
+    assert runMetricsServer(scenario, readTimeout=0.05) == b''
+
+
+def test_too_many_headers_are_refused():
+    async def scenario(port):
+        return await send(port, b'GET /metrics HTTP/1.1\r\n' + b'X-Header: 1\r\n' * 10 + b'\r\n')
+
+    response = runMetricsServer(scenario, maxHeaderLines=5)
+    assert response.startswith(b'HTTP/1.1 431')
@@ -0,0 +1,155 @@
+import asyncio
+import os
+
+import pytest
+
+from alertman.usecases.outbox import (
+    INDEX_ENTRY, RECORD_HEADER, SENT, OutboxSpool, SpoolSegment
+)
+
+
+PAYLOADS = [b'first alert', b'second alert', b'third alert']
+
+
+def runSpool(directory, scenario, segmentBytes=64 * 1024 * 1024):
+    async def run():
+        spool = OutboxSpool(str(directory), segmentBytes=segmentBytes, fsyncInterval=0)
+        spool.open()
+        try:
+            return await scenario(spool)
+        finally:
+            await spool.close()
+
+    return asyncio.run(run())
+
+
+async def appendAll(spool, payloads=PAYLOADS):
+    await asyncio.gather(*[spool.append(payload) for payload in payloads])
+
+
+async def takePending(spool):
+    payloads = []
+    while spool._pendingRecords:
+        payloads.append(spool.read(await spool.next()))
+    return payloads
+
+
+def getSegmentPaths(directory):
+    logs = sorted(name for name in os.listdir(str(directory)) if name.endswith('.log'))
+    return [
+        (os.path.join(str(directory), name), os.path.join(str(directory), name[:-4] + '.idx'))
+        for name in logs
+    ]
+
+
+def test_pending_records_survive_a_reopen_in_append_order(tmp_path):
+    runSpool(tmp_path, appendAll)
+    assert runSpool(tmp_path, takePending) == PAYLOADS
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    runSpool(tmp_path, appendAll)
+    logPath, _ = getSegmentPaths(tmp_path)[0]
+    size = os.path.getsize(logPath)
+    # the header and half the payload of a record that never made it
+    with open(logPath, 'ab') as logFile:
+        logFile.write(RECORD_HEADER.pack(100, 0) + b'x' * 50)
+
+    assert runSpool(tmp_path, takePending) == PAYLOADS
+    assert os.path.getsize(logPath) == size
+
+
+def test_records_missing_from_the_index_are_recovered_from_the_log(tmp_path):
+    runSpool(tmp_path, appendAll)
+    _, indexPath = getSegmentPaths(tmp_path)[0]
+    # the process died before the index entry of the last record was kept
+    with open(indexPath, 'r+b') as indexFile:
+        indexFile.seek(2 * INDEX_ENTRY.size)
+        indexFile.write(b'\0' * INDEX_ENTRY.size)
+
+    assert runSpool(tmp_path, takePending) == PAYLOADS
+
+
+def test_crc_mismatch_ends_the_recovered_log(tmp_path):
+    runSpool(tmp_path, appendAll)
+    logPath, indexPath = getSegmentPaths(tmp_path)[0]
+    os.unlink(indexPath)
+    # flip a byte inside the payload of the second record
+    corruptAt = RECORD_HEADER.size * 2 + len(PAYLOADS[0]) + 3
+    with open(logPath, 'r+b') as logFile:
+        logFile.seek(corruptAt)
+        byte = logFile.read(1)
+        logFile.seek(corruptAt)
+        logFile.write(bytes([byte[0] ^ 0xff]))
+
+    assert runSpool(tmp_path, takePending) == PAYLOADS[:1]
+    assert os.path.getsize(logPath) == RECORD_HEADER.size + len(PAYLOADS[0])
+
+
+def test_completed_records_stay_completed_after_a_reopen(tmp_path):
+    async def completeSecond(spool):
+        await appendAll(spool)
+        records = [await spool.next() for _ in PAYLOADS]
+        spool.complete(records[1], SENT)
+        spool.requeue(records[2])
+        spool.requeue(records[0])
+        return spool.pendingCount
+
+    assert runSpool(tmp_path, completeSecond) == 2
+    assert runSpool(tmp_path, takePending) == [PAYLOADS[0], PAYLOADS[2]]
+
+
+def test_requeued_record_is_handed_out_again_first(tmp_path):
+    async def scenario(spool):
+        await appendAll(spool)
+        first = await spool.next()
+        spool.requeue(first)
+        return await takePending(spool)
+
+    assert runSpool(tmp_path, scenario) == PAYLOADS
+
+
+def test_segment_is_deleted_once_nothing_is_pending_in_it(tmp_path):
+    async def scenario(spool):
+        # every flush fills a segment, so every record gets one of its own
+        for payload in PAYLOADS:
+            await spool.append(payload)
+        segmentsBefore = len(getSegmentPaths(tmp_path))
+        for _ in PAYLOADS:
+            spool.complete(await spool.next(), SENT)
+        return segmentsBefore, len(getSegmentPaths(tmp_path)), spool.pendingCount
+
+    before, after, pending = runSpool(tmp_path, scenario, segmentBytes=1)
+    assert before == len(PAYLOADS) + 1
+    # only the active segment is left
+    assert (after, pending) == (1, 0)
+
+
+def test_segment_bases_continue_after_a_reopen(tmp_path):
+    runSpool(tmp_path, appendAll, segmentBytes=1)
+    runSpool(tmp_path, appendAll, segmentBytes=1)
+    bases = [
+        int(os.path.basename(logPath)[len('segment-'):-len('.log')])
+        for logPath, _ in getSegmentPaths(tmp_path)
+    ]
+    assert bases == sorted(set(bases))
+    assert runSpool(tmp_path, takePending) == PAYLOADS + PAYLOADS
+
+
+def test_directory_is_used_by_one_spool_at_a_time(tmp_path):
+    async def scenario(spool):
+        other = OutboxSpool(str(tmp_path))
+        with pytest.raises(Exception):
+            other.open()
+
+    runSpool(tmp_path, scenario)
+
+
+def test_segment_recover_counts_pending_entries(tmp_path):
+    runSpool(tmp_path, appendAll)
+    segment = SpoolSegment(str(tmp_path), 0)
+    segment.recover()
+    try:
+        assert (segment.count, segment.pending) == (len(PAYLOADS), len(PAYLOADS))
+    finally:
+        segment.close()
@@ -0,0 +1,66 @@
+import asyncio
+
+from alertman.domain.email import EmailMessage
+from alertman.usecases.send_email import RecipientBatcher
+
+
+class FakeSMTP(object):
+    def __init__(self):
+        self.sent = []
+
+    async def sendmail(self, sender, receivers, message):
+        self.sent.append(list(receivers))
+        return {}, 'ok'
+
+
+# Hands out sessions which fail to close after their first failCloses uses.
+class FakePool(object):
+    def __init__(self, failCloses=0):
+        self.smtp = FakeSMTP()
+        self.messagesSent = 0
+        self.failCloses = failCloses
+
+    def session(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, excType, exc, traceback):
+        if self.failCloses:
+            self.failCloses -= 1
+            raise ConnectionResetError('lost while closing')
+
+
+def sendToAll(pool, receivers):
+    async def run():
+        batcher = RecipientBatcher(pool, window=0.001, maxRecipients=2)
+        results = await asyncio.gather(*[
+            batcher.send(EmailMessage('alertman@example.com', receiver, 'disk full', 'body'))
+            for receiver in receivers
+        ], return_exceptions=True)
+        await batcher.close()
+        return results
+
+    return asyncio.run(run())
+
+
+def test_receivers_are_sent_in_chunks():
+    pool = FakePool()
+    results = sendToAll(pool, ['a@example.com', 'b@example.com', 'c@example.com'])
+    assert results == [None, None, None]
+    assert pool.smtp.sent == [['a@example.com', 'b@example.com'], ['c@example.com']]
+
+
+def test_session_failing_to_close_fails_no_sent_chunk():
+    pool = FakePool(failCloses=1)
+    email = EmailMessage('alertman@example.com', 'a@example.com', 'disk full', 'body')
+
+    async def run():
+        batcher = RecipientBatcher(pool)
+        future = asyncio.get_running_loop().create_future()
+        await batcher._sendChunks([(email, ['a@example.com'], [future])])
+        return future.result()
+
+    assert asyncio.run(run()) is None
+    assert pool.smtp.sent == [['a@example.com']]
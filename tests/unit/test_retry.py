@@ -0,0 +1,53 @@
+import asyncio
+
+from alertman.retry import ATTEMPTS_HEADER, DEFERRALS_HEADER, RetryPolicy
+from alertman.usecases.circuit_breaker import CircuitOpenError
+from alertman.usecases.send_sms import SMSGatewayError
+
+
+class RecordingClient(object):
+    def __init__(self):
+        self.published = []
+
+    async def declare_queue(self, queue, options):
+        pass
+
+    async def publish_raw(self, body, exchange, routingKey, options):
+        self.published.append((routingKey, options['headers']))
+
+
+class Message(object):
+    content_type = 'application/json'
+    body = b'{}'
+
+    def __init__(self, headers=None):
+        self.headers = headers
+
+
+def retryUntilParked(reason, **kwargs):
+    client = RecordingClient()
+    policy = RetryPolicy(client, 'alerts', delays=(1000, 5000), **kwargs)
+
+    async def run():
+        message = Message()
+        while await policy.retry(message, ['sms'], reason):
+            message = Message(client.published[-1][1])
+
+    asyncio.run(run())
+    return client.published
+
+
+def test_throttled_gateway_uses_up_attempts():
+    published = retryUntilParked(SMSGatewayError(503, 'unavailable', 2.0), maxAttempts=3)
+    # retries wait at least as long as the gateway asked for
+    assert [queue for queue, _ in published] == [
+        'alerts.retry.5000ms', 'alerts.retry.5000ms', 'alerts.parking'
+    ]
+    assert published[-1][1][ATTEMPTS_HEADER] == 3
+
+
+def test_open_circuit_uses_up_deferrals_not_attempts():
+    published = retryUntilParked(CircuitOpenError('sms', 0.5), maxAttempts=3, maxDeferrals=4)
+    assert len(published) == 4
+    assert published[-1][0] == 'alerts.parking'
+    assert (published[-1][1][ATTEMPTS_HEADER], published[-1][1][DEFERRALS_HEADER]) == (0, 4)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+from alertman.domain.sms import SMSMessage
+from alertman.usecases.send_sms import DeliveryReceipts, SMSSender, startReceiptServer
+
+
+def runReceiptServer(scenario, **kwargs):
+    async def run():
+        receipts = DeliveryReceipts()
+        receipts.track('m-1', 'alert-1')
+        server = await startReceiptServer(receipts, port=0, **kwargs)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await scenario(port), len(receipts)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    return asyncio.run(run())
+
+
+async def send(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    statusLine = await reader.readline()
+    writer.close()
+    return statusLine.split(b' ', 2)[1].decode('latin-1')
+
+
+def post(path, payload, headers=''):
+    body = json.dumps(payload).encode('utf-8')
+    return ('POST {} HTTP/1.1\r\nHost: localhost\r\n{}Content-Length: {}\r\n\r\n'.format(
+        path, headers, len(body)).encode('latin-1') + body)
+
+
+def test_receipts_are_matched_to_tracked_messages():
+    async def scenario(port):
+        return await send(port, post('/sms/receipts', [
+            {'id': 'm-1', 'status': 'delivered'}, {'id': 'unknown', 'status': 'failed'}
+        ]))
+
+    assert runReceiptServer(scenario) == ('204', 0)
+
+
+def test_token_is_required_when_set():
+    receipt = {'id': 'm-1', 'status': 'delivered'}
+
+    async def scenario(port):
+        return [
+            await send(port, post('/sms/receipts', receipt)),
+            await send(port, post('/sms/receipts?token=wrong', receipt)),
+            await send(port, post('/sms/receipts', receipt, 'Authorization: Bearer secret\r\n')),
+        ]
+
+    statuses, pending = runReceiptServer(scenario, token='secret')
+    assert statuses == ['401', '401', '204']
+    assert pending == 0
+
+
+def test_token_in_the_query_string():
+    async def scenario(port):
+        return await send(port, post('/sms/receipts?token=secret', {'id': 'm-1'}))
+
+    assert runReceiptServer(scenario, token='secret') == ('204', 0)
+
+
+def test_oversized_body_is_refused_without_reading_it():
+    async def scenario(port):
+        return await send(port,
+            b'POST / HTTP/1.1\r\nContent-Length: 10000000\r\n\r\n{')
+
+    assert runReceiptServer(scenario, maxBodyBytes=1024) == ('413', 1)
+
+
+def test_slow_request_times_out():
+    async def scenario(port):
+        return await send(port, b'POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n{')
+
+    assert runReceiptServer(scenario, readTimeout=0.05) == ('408', 1)
+
+
+def test_other_methods_and_bad_bodies_are_refused():
+    async def scenario(port):
+        return [
+            await send(port, b'GET / HTTP/1.1\r\n\r\n'),
+            await send(port, b'POST / HTTP/1.1\r\nContent-Length: 3\r\n\r\n{{{'),
+        ]
+
+    assert runReceiptServer(scenario) == (['405', '400'], 1)
+
+
+def test_accepted_sms_without_a_json_body_is_not_sent_again():
+    async def run():
+        requests = []
+
+        async def handle(reader, writer):
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+            requests.append(await reader.readexactly(length))
+            writer.write(b'HTTP/1.1 202 Accepted\r\nContent-Length: 0\r\n\r\n')
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        sender = SMSSender({
+            'SMS_GATEWAY_URL': 'http://127.0.0.1:{}'.format(port), 'SMS_BULK_WINDOW': 0
+        }, asyncio.get_running_loop())
+        try:
+            await sender.send(SMSMessage('alertman', '+15550100', 'disk full', 'alert-1'))
+            return len(requests), len(sender.receipts)
+        finally:
+            await sender.close()
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(run()) == (1, 0)